@@ -2,6 +2,7 @@ from flask import Flask, request
 
 import logging
 import os
+import re
 import shutil
 
 
@@ -21,6 +22,16 @@ logger = logging.getLogger(__name__)
 
 LISTEN_PORT = 35968
 FILE_CACHE_DIRECTORY = '/home/data/file_cache'
+# The number of processes handling the requests (0: one per core). Each uploaded part is hashed synchronously before
+# it's stored: with one process, the parts uploaded at the same time would be hashed one after the other.
+PROCESS_COUNT = 0
+
+SHASUM_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+def part_path(shasum):
+    """The path a part is stored at (and served from by nginx, under /get/)"""
+    return os.path.join(FILE_CACHE_DIRECTORY, shasum[0], shasum[1], shasum[2], shasum)
 
 
 @app.route('/upload', methods=['POST'])
@@ -46,9 +57,8 @@ def upload():
 
         if uploaded_file_length == expected_length and uploaded_file_shasum == expected_shasum:
             ret['Size+shasum match'] = True
-            directory = os.path.join(FILE_CACHE_DIRECTORY, expected_shasum[0], expected_shasum[1], expected_shasum[2])
-            create_dir(directory)
-            new_path = os.path.join(directory, expected_shasum)
+            new_path = part_path(expected_shasum)
+            create_dir(os.path.dirname(new_path))
             shutil.move(uploaded_body_path, new_path)
             os.chmod(new_path, 0644)
             ret['path'] = new_path
@@ -56,12 +66,34 @@ def upload():
     return ret
 
 
+@app.route('/missing_parts', methods=['POST'])
+@json_endpoint
+def missing_parts():
+    """
+    Takes a list of shasums ({"shasums": [...]}), and returns those of the parts that aren't stored
+    ({"missing": [...]}). Saves a round trip per part to the clients that upload files.
+    """
+    body = request.get_json(force=True, silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get('shasums'), list):
+        return {'error': 'Expected {"shasums": [...]}'}, 400
+
+    shasums = body['shasums']
+    for shasum in shasums:
+        if not isinstance(shasum, basestring) or SHASUM_RE.match(shasum) is None:
+            return {'error': 'Invalid shasum: %r' % (shasum,)}, 400
+
+    return {
+        'missing': [shasum for shasum in shasums if not os.path.exists(part_path(shasum))],
+    }
+
+
 if __name__ == "__main__":
     parse_command_line()
     wsgi_app = WSGIContainer(app)
 
     http_server = HTTPServer(wsgi_app)
 
-    http_server.listen(LISTEN_PORT, address='127.0.0.1')
+    http_server.bind(LISTEN_PORT, address='127.0.0.1')
+    http_server.start(PROCESS_COUNT)
 
     IOLoop.instance().start()
@@ -4,6 +4,7 @@
 # Matthieu Riviere <mriviere@luna-technology.com>
 
 import logging
+import os
 
 import redis
 from twisted.internet import defer
@@ -61,9 +62,14 @@ class BackgroundDownloadWorker(object):
             try:
                 logger.info('Starting fetch of %s into %s' % (file_key, local_path))
                 yield self.cache_client.get_file(file_key, local_path, overwrite=True)
+                # The proxy updates its metadata with them
+                st = os.stat(local_path)
+                self.redis.hmset(key, {'file_size': st.st_size, 'mtime': repr(st.st_mtime)})
                 self.redis.lpush('bkgrd_dl:succeeded', key)
                 self.redis.lrem('bkgrd_dl:processing', 0, key)
                 self.redis.hset(key, 'state', 'SUCCESS')
+                # Wakes up the proxy waiting for the job
+                self.redis.publish('%s:done' % key, 'SUCCESS')
                 logger.info('SUCCESS: Fetch of %s into %s' % (file_key, local_path))
 
                 defer.returnValue(True)
@@ -75,6 +81,7 @@ class BackgroundDownloadWorker(object):
         self.redis.lpush('bkgrd_dl:failed', key)
         self.redis.lrem('bkgrd_dl:processing', 0, key)
         self.redis.hset(key, 'state', 'FAILURE')
+        self.redis.publish('%s:done' % key, 'FAILURE')
         logger.error('FAILURE: Fetch of %s into %s' % (file_key, local_path))
 
         defer.returnValue(False)
@@ -21,10 +21,12 @@ import sys
 import traceback
 import zlib
 
+from concurrent.futures import ThreadPoolExecutor
 import redis
 
 # Tornado-related stuff
 
+from tornado.concurrent import run_on_executor
 from tornado.ioloop import IOLoop
 from tornado.options import parse_command_line
 import tornado.web
@@ -39,6 +41,9 @@ VERSION = u'fileserver-4'
 
 MAX_WORKERS = 4
 
+# Where the blocking reads of the files are made, out of the IOLoop
+file_executor = ThreadPoolExecutor(MAX_WORKERS)
+
 logger = logging.getLogger(__name__)
 
 from seekscale_commons.base import create_dir
@@ -57,13 +62,20 @@ def json_error(e):
 
 
 def tornado_json_endpoint(func):
+    """
+    Sends what the handler returns as a JSON response: a dict, or a (dict, status code) tuple. The handler can also be
+    a coroutine, and send the response itself: then it returns None once it's finished.
+    """
     @wraps(func)
+    @tornado.gen.coroutine
     def inner(*args, **kwargs):
         s = args[0]
         try:
-            ret = func(*args, **kwargs)
+            ret = yield tornado.gen.maybe_future(func(*args, **kwargs))
 
-            if isinstance(ret, dict):
+            if ret is None and s._finished:
+                return
+            elif isinstance(ret, dict):
                 s.write(json_response(ret))
                 s.finish()
                 return
@@ -304,9 +316,11 @@ class TouchFile(tornado.web.RequestHandler):
         if not os.path.exists(dirname):
             create_dir(dirname)
 
+        created = False
         if not os.path.exists(path):
             with open(path, 'wb') as _:
                 pass
+            created = True
 
         r = self.application.redis
         key = 'file_metadata:' + base64.b64encode(path.encode('UTF-8'))
@@ -326,7 +340,12 @@ class TouchFile(tornado.web.RequestHandler):
             logger.warn('Warning: could not delete key from redis: %s' % traceback.format_exc())
             r.disabled = True
 
-        return {}
+        st = os.stat(path)
+        return {
+            'created': created,
+            'file_size': st.st_size,
+            'mtime': st.st_mtime,
+        }
 
 
 class PutFileHandler(tornado.web.RequestHandler):
@@ -355,10 +374,11 @@ class PutFileHandler(tornado.web.RequestHandler):
             logger.warn('Warning: could not delete key from redis: %s' % traceback.format_exc())
             r.disabled = True
 
-        file_size = os.path.getsize(path)
+        st = os.stat(path)
         ret = {
             'path': path,
-            'file_size': file_size
+            'file_size': st.st_size,
+            'mtime': st.st_mtime,
         }
 
         return ret
@@ -378,6 +398,87 @@ class PutFileHandler(tornado.web.RequestHandler):
         return self.get_data(path, f)
 
 
+class WriteRangesHandler(tornado.web.RequestHandler):
+    """
+    Writes some ranges of an existing file, and sets its size. The client only sends what it modified in the file.
+
+    Parameters: path, size (the new size of the file), ranges (JSON list of [offset, length]), the data of the ranges
+    (concatenated) as the 'data' file, and base_size/base_mtime: the version of the file the client modified. If the
+    file isn't that version any more, nothing is written and the status code is 409: the client must upload the
+    whole file.
+    """
+    # Tolerance on the comparison of mtimes, that went through JSON
+    MTIME_TOLERANCE = 0.001
+
+    def get_data(self, path, size, base_size, base_mtime, ranges, f):
+        if f is None or len(f) == 0:
+            raise RuntimeError("No data uploaded.")
+        data = f[0].body
+
+        if sum(length for _, length in ranges) != len(data):
+            return {u'Error': u"The data doesn't match the ranges"}, 400
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            return {u'Error': u"File doesn't exist"}, 409
+
+        if not stat.S_ISREG(st.st_mode) or st.st_size != base_size or \
+                abs(st.st_mtime - base_mtime) > self.MTIME_TOLERANCE:
+            logger.info(u"\"%s\" was modified since the version the ranges apply to" % path)
+            return {u'Error': u"File was modified"}, 409
+
+        with open(path, 'r+b') as fh:
+            fh.truncate(size)
+            position = 0
+            for offset, length in ranges:
+                fh.seek(offset)
+                fh.write(data[position:position+length])
+                position += length
+
+        r = self.application.redis
+        key = 'file_metadata:' + base64.b64encode(path.encode('UTF-8'))
+        try:
+            if not hasattr(r, 'disabled'):
+                r.delete(key)
+        except Exception:
+            logger.warn('Warning: could not delete key from redis: %s' % traceback.format_exc())
+            r.disabled = True
+
+        file_dir = os.path.dirname(path)
+        dir_key = 'listdir:' + base64.b64encode(file_dir.encode('UTF-8'))
+        try:
+            if not hasattr(r, 'disabled'):
+                r.delete(dir_key)
+        except Exception:
+            logger.warn('Warning: could not delete key from redis: %s' % traceback.format_exc())
+            r.disabled = True
+
+        st = os.stat(path)
+        ret = {
+            'path': path,
+            'file_size': st.st_size,
+            'mtime': st.st_mtime,
+            'written_bytes': len(data),
+        }
+
+        return ret
+
+    @tornado_json_endpoint
+    def post(self):
+        param_path = self.get_argument('path')
+        path = translate_path(param_path)
+        size = int(self.get_argument('size'))
+        base_size = int(self.get_argument('base_size'))
+        base_mtime = float(self.get_argument('base_mtime'))
+        ranges = json.loads(self.get_argument('ranges'))
+        logger.info(u"Request to write %d ranges of \"%s\"" % (len(ranges), path))
+
+        f = self.request.files.get('data')
+
+        return self.get_data(path, size, base_size, base_mtime, ranges, f)
+
+
 class GetFile(tornado.web.RequestHandler):
     @tornado.web.asynchronous
     @tornado.gen.coroutine
@@ -398,6 +499,67 @@ class GetFile(tornado.web.RequestHandler):
             raise tornado.web.HTTPError(404, 'Invalid file')
 
 
+class GetRange(tornado.web.RequestHandler):
+    """
+    Reads a range of a file. It's read in the executor, and sent by pieces of READ_SIZE bytes.
+
+    Parameters: file, offset, length, and size/mtime: the version of the file the client wants a range of. If the
+    file isn't that version any more, the status code is 409.
+    """
+    READ_SIZE = 1024*1024
+
+    executor = file_executor
+
+    @run_on_executor
+    def open_version(self, path, size, mtime):
+        """
+        :return: the file opened for reading, or None if it isn't the requested version
+        """
+        f = open(path, 'rb')
+        st = os.fstat(f.fileno())
+        if st.st_size != size or abs(st.st_mtime - mtime) > WriteRangesHandler.MTIME_TOLERANCE:
+            f.close()
+            return None
+        return f
+
+    @run_on_executor
+    def read_at(self, f, offset, length):
+        f.seek(offset)
+        return f.read(length)
+
+    @tornado_json_endpoint
+    @tornado.gen.coroutine
+    def post(self):
+        param_path = self.get_argument('file')
+        path = translate_path(param_path)
+        offset = int(self.get_argument('offset'))
+        length = int(self.get_argument('length'))
+        size = int(self.get_argument('size'))
+        mtime = float(self.get_argument('mtime'))
+        logger.info(u"Request for %d bytes at %d of \"%s\"" % (length, offset, path))
+
+        try:
+            f = yield self.open_version(path, size, mtime)
+        except IOError:
+            raise tornado.gen.Return(({u'Error': u'Invalid file'}, 404))
+        if f is None:
+            logger.info(u"\"%s\" was modified since the version the range was requested of" % path)
+            raise tornado.gen.Return(({u'Error': u'File was modified'}, 409))
+
+        try:
+            end = min(offset + length, size)
+            while offset < end:
+                data = yield self.read_at(f, offset, min(self.READ_SIZE, end - offset))
+                if not data:
+                    break
+                offset += len(data)
+                self.write(data)
+                yield tornado.gen.Task(self.flush)
+        finally:
+            f.close()
+        self.finish()
+
+
 def tornado_app():
     twa = tornado.web.Application([
         (r'^/status.json$', StatusHandler),
@@ -405,7 +567,9 @@ def tornado_app():
         (r'^/file_metadata.json$', FileMetadataHandler),
         (r'^/delete_file.json$', DeleteHandler),
         (r'^/put$', PutFileHandler),
+        (r'^/write_ranges.json$', WriteRangesHandler),
         (r'^/get$', GetFile),
+        (r'^/get_range$', GetRange),
         (r'^/touch_file.json$', TouchFile),
     ])
 
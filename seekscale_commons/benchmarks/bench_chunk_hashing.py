@@ -0,0 +1,129 @@
+#!/usr/bin/env python2
+# coding: utf-8
+
+# Copyright Luna Technology 2016
+# Matthieu Riviere <mriviere@luna-technology.com>
+
+"""
+Measures how fast (in MB/s) the chunks of a file are read and hashed before being uploaded, depending on the number of
+threads of the hash thread pool, and how long the reactor is stalled meanwhile.
+
+The "reactor" variant is the historical implementation (the chunk is read in a thread, then hashed on the reactor
+thread). The "pool" variants use read_chunk_at, with 1 thread up to one per core. The network isn't involved: this is
+the upper bound of the upload throughput of a single file.
+
+The file is written just before, so it's probably read from the page cache.
+
+Usage: python benchmarks/bench_chunk_hashing.py [file_size_in_mb] [chunk_size_in_mb]
+"""
+
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from twisted.internet import reactor, task, threads
+from twisted.internet.defer import inlineCallbacks
+
+from seekscale_commons.cache_client import twisted_client
+from seekscale_commons.cache_client.twisted_client import ChunkWindow, sha256sum_str
+
+
+def read_chunk(path, offset, length):
+    with open(path, 'rb') as fh:
+        fh.seek(offset)
+        return fh.read(length)
+
+
+def read_then_hash_on_reactor(path, offset, length):
+    d = threads.deferToThread(read_chunk, path, offset, length)
+    d.addCallback(lambda chunk: (chunk, sha256sum_str(chunk)))
+    return d
+
+
+class StallMonitor(object):
+    """Measures the longest time the reactor didn't run a 10ms periodic call"""
+    INTERVAL = 0.01
+
+    def __init__(self):
+        self.last = None
+        self.max_stall = 0.0
+        self.call = task.LoopingCall(self.tick)
+
+    def tick(self):
+        now = time.time()
+        if self.last is not None:
+            self.max_stall = max(self.max_stall, now - self.last - self.INTERVAL)
+        self.last = now
+
+    def start(self):
+        self.last = None
+        self.max_stall = 0.0
+        self.call.start(self.INTERVAL)
+
+    def stop(self):
+        self.call.stop()
+
+
+@inlineCallbacks
+def run(name, read_and_hash, path, file_size, chunk_size, window_size):
+    monitor = StallMonitor()
+    monitor.start()
+    start = time.time()
+
+    window = ChunkWindow(window_size)
+    yield window.run(
+        lambda offset=offset: read_and_hash(path, offset, min(chunk_size, file_size - offset))
+        for offset in xrange(0, file_size, chunk_size)
+    )
+
+    duration = time.time() - start
+    monitor.stop()
+    print '%-10s %8.1f MB/s  max reactor stall %6.1f ms' % (
+        name, file_size / duration / 1024 / 1024, monitor.max_stall * 1000)
+
+
+@inlineCallbacks
+def run_all(path, file_size, chunk_size):
+    cores = multiprocessing.cpu_count()
+
+    yield run('reactor', read_then_hash_on_reactor, path, file_size, chunk_size, cores * 2)
+
+    thread_counts = sorted(set([1, 2, 4, 8, 16, cores]))
+    for thread_count in thread_counts:
+        if thread_count > cores:
+            break
+        twisted_client.stop_hash_threadpool()
+        twisted_client.HASH_POOL_SIZE = thread_count
+        yield run('pool x%d' % thread_count, twisted_client.read_chunk_at, path, file_size, chunk_size,
+                  thread_count * 2)
+    twisted_client.stop_hash_threadpool()
+
+
+def main():
+    file_size = int(sys.argv[1]) * 1024 * 1024 if len(sys.argv) > 1 else 512 * 1024 * 1024
+    chunk_size = int(sys.argv[2]) * 1024 * 1024 if len(sys.argv) > 2 else twisted_client.CHUNK_SIZE_IN_MB * 1024 * 1024
+
+    fd, path = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            for _ in xrange(0, file_size, 16 * 1024 * 1024):
+                fh.write(os.urandom(16 * 1024 * 1024))
+        file_size = os.path.getsize(path)
+
+        print '%d MB file, chunks of %d MB, %d cores' % (
+            file_size / 1024 / 1024, chunk_size / 1024 / 1024, multiprocessing.cpu_count())
+
+        d = run_all(path, file_size, chunk_size)
+        d.addErrback(lambda error: error.printTraceback())
+        d.addBoth(lambda _: reactor.stop())
+        reactor.run()
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -18,9 +18,12 @@ import redis
 from twisted.internet import defer
 from twisted.internet.error import ReactorNotRunning
 
-from twisted_client import create_agent, upload, download_with_tmp_files, reactor
+from transfer_control import get_transfer_control
+from twisted_client import ChunkWindow, create_agent, upload, download_part, download_to_file, reactor, \
+    CACHE_SERVER, CONNECTION_COUNT
 
 from ..base import create_dir, download
+from ..twisted_redis import AsyncRedis
 
 
 class CacheClient3(object):
@@ -37,8 +40,16 @@ class CacheClient3(object):
 
     all_keys_metakey = 'renderfarm:cacheclient3:keyset'
 
-    def __init__(self, redis_host='10.91.0.1', ssl_cert=None, ssl_key=None, ssl_ca=None, concurrency_level=None):
+    def __init__(self, redis_host='10.91.0.1', ssl_cert=None, ssl_key=None, ssl_ca=None, concurrency_level=None,
+                 window_size=CONNECTION_COUNT, adaptive=True):
+        """
+        :param concurrency_level: the maximum number of requests in flight, for all the files
+        :param window_size: the maximum number of chunk transfers kept in flight for each file
+        :param adaptive: whether the number of requests in flight adapts to the link (see TransferControl), up to
+        concurrency_level. Otherwise, there are always concurrency_level of them.
+        """
         self.redis_host = redis_host
+        self.window_size = window_size
 
         if ssl_cert is not None:
             self.cacheclient_cert = ssl_cert
@@ -55,19 +66,29 @@ class CacheClient3(object):
         else:
             self.cacheclient_ca = os.path.join(self.client_certs_dir, 'ca.crt')
 
-        # Setup connections to redis
+        # Setup connections to redis. The async client is the one to use from the reactor.
         self.redis = redis.StrictRedis(host=self.redis_host, port=6379, db=0)
+        self.async_redis = AsyncRedis(self.redis)
 
         self.get_certs()
 
         self.http_agent = create_agent(self.cacheclient_ca, self.cacheclient_cert, self.cacheclient_key)
 
-        if concurrency_level is not None:
+        if adaptive:
+            self.transfer_control = get_transfer_control(
+                CACHE_SERVER,
+                max_concurrency=concurrency_level if concurrency_level is not None else CONNECTION_COUNT,
+            )
+        else:
+            self.transfer_control = None
+
+        if concurrency_level is not None and not adaptive:
             deferred_semaphore = defer.DeferredSemaphore(concurrency_level)
         else:
             deferred_semaphore = None
 
         self.http_agent.deferred_semaphore = deferred_semaphore
+        self.http_agent.transfer_control = self.transfer_control
 
         self.log = logging.getLogger(__name__)
 
@@ -149,15 +170,33 @@ class CacheClient3(object):
         self.redis.set(key, json.dumps(manifest))
         self.redis.sadd(self.all_keys_metakey, key)
 
+    def has_file_async(self, key):
+        """Same as has_file, without blocking the reactor. Returns a Deferred."""
+        d = self.get_file_manifest_async(key)
+        d.addCallback(lambda manifest: manifest is not None)
+        return d
+
+    def get_file_manifest_async(self, key):
+        """Same as get_file_manifest, without blocking the reactor. Returns a Deferred."""
+        return self.async_redis.run(self.get_file_manifest, key)
+
+    def set_file_manifest_async(self, key, manifest):
+        """Same as set_file_manifest, without blocking the reactor. Returns a Deferred."""
+        def queue_commands(pipe):
+            pipe.set(key, json.dumps(manifest))
+            pipe.sadd(self.all_keys_metakey, key)
+        return self.async_redis.pipeline(queue_commands)
+
     def add_file(self, key, path):
-        d = upload(path, agent=self.http_agent)
+        d = upload(path, agent=self.http_agent, window=self.create_window())
 
         obj = self
 
         def store_result(res):
             # Store the manifest in redis so we can retrieve the file later
-            obj.set_file_manifest(key, res)
-            obj.log.info("File %s stored under key %s." % (path, key))
+            d = obj.set_file_manifest_async(key, res)
+            d.addCallback(lambda _: obj.log.info("File %s stored under key %s." % (path, key)))
+            return d
         d.addCallback(store_result)
 
         def handleError(error):
@@ -178,13 +217,16 @@ class CacheClient3(object):
             self.log.error("Could not get a key for file")
             return defer.fail(None)
 
-        d = defer.succeed(None)
+        d = self.has_file_async(key)
 
-        if not self.has_file(key):
-            d.addCallback(lambda x: self.add_file(key, path))
+        def cbAddFile(has_file):
+            if not has_file:
+                return self.add_file(key, path)
+        d.addCallback(cbAddFile)
 
-        def handleSuccess(_):
-            manifest = self.get_file_manifest(key)
+        d.addCallback(lambda _: self.get_file_manifest_async(key))
+
+        def handleSuccess(manifest):
             if manifest is None:
                 self.log.warn('Manifest for %s is still none after uploading file. Something is wrong.' % path)
 
@@ -197,7 +239,11 @@ class CacheClient3(object):
 
         return d
 
-    def get_file(self, key, target_path, overwrite=True):
+    def get_file(self, key, target_path, overwrite=True, progress=None):
+        """
+        Downloads a file to target_path.
+        :param progress: called with (the number of bytes received, the size of the file) as the download progresses
+        """
         # Ensure target_path an absolute path
         target_path = os.path.abspath(target_path)
 
@@ -208,12 +254,14 @@ class CacheClient3(object):
             return
 
         # Get the manifest
-        manifest = self.get_file_manifest(key)
-
-        if manifest is None:
-            return defer.fail(RuntimeError(u"Unknown key"))
+        d = self.get_file_manifest_async(key)
 
-        d = download_with_tmp_files(manifest, target_path, agent=self.http_agent)
+        def cbDownload(manifest):
+            if manifest is None:
+                raise RuntimeError(u"Unknown key")
+            return download_to_file(manifest, target_path, agent=self.http_agent, progress=progress,
+                                    window=self.create_window())
+        d.addCallback(cbDownload)
 
         def handleError(error):
             self.log.error(u"An error occured while downloading the file: %s" % error.getTraceback())
@@ -222,6 +270,19 @@ class CacheClient3(object):
 
         return d
 
+    def create_window(self):
+        return ChunkWindow(self.window_size, transfer_control=self.transfer_control)
+
+    def get_part(self, shasum, length=None):
+        """Downloads a single part of a file, listed in its manifest. Returns a Deferred that fires with its content."""
+        return download_part(shasum, agent=self.http_agent, length=length)
+
+    def get_transfer_stats(self):
+        """:return: the stats of the TransferControl, or None if the transfers don't adapt to the link"""
+        if self.transfer_control is None:
+            return None
+        return self.transfer_control.get_stats()
+
     def clear(self):
         """Resets the entire cache"""
         self.redis.flushall()
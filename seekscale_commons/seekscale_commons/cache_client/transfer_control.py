@@ -0,0 +1,264 @@
+# coding: utf-8
+
+# Copyright Luna Technology 2016
+# Matthieu Riviere <mriviere@luna-technology.com>
+
+"""Adaptive control of the transfers to the cache server
+
+How many transfers to keep in flight depends on the link: its bandwidth, its RTT, and whatever else shares it. Instead
+of a fixed value, a TransferControl measures the goodput of the requests to a destination, and adjusts it as it goes
+(AIMD):
+
+- the transfers are accounted for by rounds, of as many transfers as there are in flight
+- as long as the goodput of a round grows, the next one has more transfers in flight: twice as many at first, then
+  one more at a time
+- after a failure, or if the goodput collapses, there are fewer of them
+- on a plateau, it stays there, and tries one more every now and then
+
+The RTT is measured on the small requests (eg. checking whether a chunk exists), for the stats.
+
+The size of the chunks doesn't adapt: the chunks are addressed by their checksum, and the same content must always be
+cut the same way to be deduplicated.
+"""
+
+import collections
+import logging
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.python import failure
+
+
+logger = logging.getLogger(__name__)
+
+# The goodput must grow by that much for a round to count as better than the previous one...
+GROWTH_THRESHOLD = 0.05
+# ... and drop by that much to count as a collapse
+DROP_THRESHOLD = 0.25
+# The factor applied to the number of transfers after a failure or a collapse
+DECREASE_FACTOR = 0.7
+# The number of rounds on a plateau before trying one more transfer in flight
+PROBE_INTERVAL = 8
+# The number of RTT samples the minimum RTT is taken from
+RTT_SAMPLES = 100
+
+
+class TransferControl(object):
+    """
+    Limits and measures the requests to one destination. The number of them in flight adapts to the link.
+    """
+
+    def __init__(self, destination, initial_concurrency=4, min_concurrency=1, max_concurrency=50, clock=reactor):
+        self.destination = destination
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.clock = clock
+
+        self.concurrency = max(min(initial_concurrency, max_concurrency), min_concurrency)
+        self.running = 0
+        self.waiting = collections.deque()
+        self.starting = False
+
+        # Doubles the number of transfers in flight each round until the goodput stops growing
+        self.slow_start = True
+        self.probing = False
+        self.plateau_rounds = 0
+
+        # The goodput (in bytes per second) of the last round that had as many transfers in flight as allowed
+        self.goodput = None
+        self.rtt_samples = collections.deque(maxlen=RTT_SAMPLES)
+
+        # The current round
+        self.round_transfers = 0
+        self.round_bytes = 0
+        self.round_failures = 0
+        self.round_saturated = False
+        self.round_busy_time = 0.0
+        self.busy_since = None
+
+        self.listeners = []
+
+        self.total_bytes = 0
+        self.total_failures = 0
+        self.total_rounds = 0
+        self.total_increases = 0
+        self.total_decreases = 0
+
+    def run(self, size, f, *args, **kwargs):
+        """
+        Calls f(*args, **kwargs) once there's room for one more request in flight.
+        :param size: the number of bytes the request transfers. The duration of a request with a size of 0 is taken
+        as a RTT sample. None if it isn't known: the request is limited, but not measured.
+        :return: a Deferred that fires with the result of f
+        """
+        if self.running >= self.concurrency:
+            self.round_saturated = True
+
+        d = Deferred()
+        self.waiting.append((d, size, f, args, kwargs))
+        self.start_waiting()
+        return d
+
+    def start_waiting(self):
+        # A request that completes right away calls start_waiting() again: the loop below goes on instead
+        if self.starting:
+            return
+        self.starting = True
+        try:
+            while self.waiting and self.running < self.concurrency:
+                d, size, f, args, kwargs = self.waiting.popleft()
+                if self.running == 0:
+                    self.busy_since = self.clock.seconds()
+                self.running += 1
+
+                request_d = maybeDeferred(f, *args, **kwargs)
+                request_d.addBoth(self.finished, size, self.clock.seconds())
+                request_d.chainDeferred(d)
+        finally:
+            self.starting = False
+
+    def finished(self, result, size, start_time):
+        now = self.clock.seconds()
+        self.running -= 1
+        if self.running == 0:
+            self.round_busy_time += now - self.busy_since
+            self.busy_since = None
+
+        failed = isinstance(result, failure.Failure)
+        if failed:
+            self.round_failures += 1
+            self.total_failures += 1
+
+        if size is None:
+            pass
+        elif size == 0:
+            if not failed:
+                self.rtt_samples.append(now - start_time)
+        else:
+            self.round_transfers += 1
+            if not failed:
+                self.round_bytes += size
+                self.total_bytes += size
+            if self.round_transfers >= self.concurrency:
+                self.end_round(now)
+
+        self.start_waiting()
+        return result
+
+    def end_round(self, now):
+        busy_time = self.round_busy_time
+        if self.busy_since is not None:
+            busy_time += now - self.busy_since
+            self.busy_since = now
+
+        goodput = self.round_bytes / busy_time if busy_time > 0 else None
+        failures = self.round_failures
+        saturated = self.round_saturated
+
+        self.round_transfers = 0
+        self.round_bytes = 0
+        self.round_failures = 0
+        self.round_saturated = self.running >= self.concurrency
+        self.round_busy_time = 0.0
+        self.total_rounds += 1
+
+        if failures:
+            self.slow_start = False
+            self.decrease('%d failed requests' % failures)
+        elif goodput is None or not saturated:
+            # There weren't enough requests to fill the link: that says nothing about it
+            pass
+        elif self.goodput is None or goodput > self.goodput * (1 + GROWTH_THRESHOLD):
+            self.probing = False
+            self.plateau_rounds = 0
+            self.increase()
+        elif goodput < self.goodput * (1 - DROP_THRESHOLD):
+            self.slow_start = False
+            self.decrease('goodput dropped from %.1f to %.1f MB/s' % (
+                self.goodput / (1024*1024), goodput / (1024*1024)))
+        else:
+            self.slow_start = False
+            if self.probing:
+                # One more transfer in flight didn't help
+                self.probing = False
+                self.set_concurrency(self.concurrency - 1)
+            self.plateau_rounds += 1
+            if self.plateau_rounds >= PROBE_INTERVAL:
+                self.plateau_rounds = 0
+                self.probing = True
+                self.increase()
+
+        if saturated and goodput is not None:
+            self.goodput = goodput
+
+        stats = self.get_stats()
+        for listener in self.listeners:
+            listener(stats)
+
+    def increase(self):
+        if self.slow_start:
+            self.set_concurrency(self.concurrency * 2)
+        else:
+            self.set_concurrency(self.concurrency + 1)
+
+    def decrease(self, reason):
+        self.probing = False
+        self.plateau_rounds = 0
+        if self.set_concurrency(int(self.concurrency * DECREASE_FACTOR)):
+            logger.info('Fewer transfers in flight to %s (%s): %d' % (self.destination, reason, self.concurrency))
+
+    def set_concurrency(self, concurrency):
+        """:return: whether the number of transfers in flight changed"""
+        concurrency = max(min(concurrency, self.max_concurrency), self.min_concurrency)
+        if concurrency == self.concurrency:
+            return False
+
+        if concurrency > self.concurrency:
+            self.total_increases += 1
+        else:
+            self.total_decreases += 1
+        self.concurrency = concurrency
+        self.start_waiting()
+        return True
+
+    def min_rtt(self):
+        """:return: the minimum RTT of the last small requests, in seconds, or None if there wasn't any"""
+        if not self.rtt_samples:
+            return None
+        return min(self.rtt_samples)
+
+    def add_listener(self, listener):
+        """Calls listener with the stats at the end of each round"""
+        self.listeners.append(listener)
+
+    def get_stats(self):
+        return {
+            'destination': self.destination,
+            'concurrency': self.concurrency,
+            'running': self.running,
+            'waiting': len(self.waiting),
+            'slow_start': self.slow_start,
+            'goodput': self.goodput,
+            'min_rtt': self.min_rtt(),
+            'total_bytes': self.total_bytes,
+            'total_failures': self.total_failures,
+            'total_rounds': self.total_rounds,
+            'total_increases': self.total_increases,
+            'total_decreases': self.total_decreases,
+        }
+
+
+# destination -> TransferControl
+_transfer_controls = {}
+
+
+def get_transfer_control(destination, **kwargs):
+    """
+    :return: the TransferControl of a destination, shared by all the clients of this process. The other arguments are
+    those of TransferControl, and are only used the first time.
+    """
+    transfer_control = _transfer_controls.get(destination)
+    if transfer_control is None:
+        transfer_control = TransferControl(destination, **kwargs)
+        _transfer_controls[destination] = transfer_control
+    return transfer_control
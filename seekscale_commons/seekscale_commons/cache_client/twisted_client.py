@@ -10,17 +10,17 @@ from cStringIO import StringIO
 import hashlib
 import json
 import logging
-import math
+import multiprocessing
 import os
-import shutil
 import sys
-import tempfile
 
 from twisted.internet import reactor, threads
-from twisted.internet.defer import Deferred, DeferredList, inlineCallbacks, returnValue
+from twisted.internet.defer import Deferred, inlineCallbacks, maybeDeferred, returnValue, succeed
 from twisted.internet.protocol import Protocol
 from twisted.internet.ssl import Certificate, PrivateCertificate, optionsForClientTLS
+from twisted.python import failure
 from twisted.python.filepath import FilePath
+from twisted.python.threadpool import ThreadPool
 from twisted.web.client import Agent
 from twisted.web.client import BrowserLikePolicyForHTTPS, _requireSSL
 from twisted.web.client import readBody
@@ -38,6 +38,18 @@ logger = logging.getLogger(__name__)
 CHUNK_SIZE_IN_MB = 5
 CONNECTION_COUNT = 50
 
+# The destination of all the requests below
+CACHE_SERVER = 'entrypoint.seekscale.com:34968'
+
+# The number of threads the chunks to upload are read and hashed in. hashlib releases the GIL while it hashes a chunk,
+# so they are hashed in parallel, one per core.
+HASH_POOL_SIZE = multiprocessing.cpu_count()
+
+_hash_threadpool = None
+
+# The maximum number of shasums sent in one /missing_parts request
+MISSING_PARTS_BATCH_SIZE = 1000
+
 
 def sha256sum_str(data):
     """Returns that SHA256 checksum of a binary string"""
@@ -46,6 +58,112 @@ def sha256sum_str(data):
     return sha256.hexdigest()
 
 
+class ChunkWindow(object):
+    """
+    Runs the transfers of the chunks of a file, keeping up to size of them in flight at all times: a new one starts as
+    soon as one finishes, instead of waiting for a whole batch. One slow chunk doesn't leave the link idle.
+
+    Also measures the throughput of the file.
+    """
+
+    def __init__(self, size=CONNECTION_COUNT, clock=reactor, transfer_control=None):
+        """
+        :param transfer_control: the TransferControl of the destination, if any. There are no more transfers in flight
+        than it currently allows.
+        """
+        self.size = size
+        self.clock = clock
+        self.transfer_control = transfer_control
+
+        self.transferred_bytes = 0
+        self.start_time = None
+        self.end_time = None
+
+    def run(self, tasks):
+        """
+        :param tasks: an iterable of callables, that return a Deferred. The next one is called as soon as there's room
+        in the window.
+        :return: a Deferred that fires with the list of their results, in order. After a failure, no task is started
+        any more, and it fails with the first failure once the tasks in flight are over.
+        """
+        # The throughput is the one of all the runs
+        if self.start_time is None:
+            self.start_time = self.clock.seconds()
+        self.end_time = None
+
+        tasks = iter(tasks)
+        results = []
+        done = Deferred()
+        state = {
+            'running': 0,
+            'filling': False,
+            'failure': None,
+        }
+
+        def succeeded(result, index):
+            results[index] = result
+
+        def failed(error):
+            if state['failure'] is None:
+                state['failure'] = error
+
+        def finished(_):
+            state['running'] -= 1
+            fill()
+
+        def fill():
+            # A task that completes right away calls fill() again: the loop below goes on instead
+            if state['filling']:
+                return
+            state['filling'] = True
+            try:
+                while state['running'] < self.limit() and state['failure'] is None:
+                    try:
+                        task = next(tasks)
+                    except StopIteration:
+                        break
+
+                    index = len(results)
+                    results.append(None)
+                    state['running'] += 1
+                    d = maybeDeferred(task)
+                    d.addCallbacks(succeeded, failed, callbackArgs=(index,))
+                    d.addBoth(finished)
+            except Exception:
+                failed(failure.Failure())
+            finally:
+                state['filling'] = False
+
+            if state['running'] == 0 and not done.called:
+                self.end_time = self.clock.seconds()
+                if state['failure'] is not None:
+                    done.errback(state['failure'])
+                else:
+                    done.callback(results)
+
+        fill()
+        return done
+
+    def limit(self):
+        """:return: the number of transfers to keep in flight"""
+        if self.transfer_control is None:
+            return self.size
+        return min(self.size, self.transfer_control.concurrency)
+
+    def add_bytes(self, length):
+        """Accounts for length bytes transferred"""
+        self.transferred_bytes += length
+
+    def throughput(self):
+        """:return: the throughput of the transfers so far, in bytes per second"""
+        if self.start_time is None:
+            return 0.0
+        end_time = self.end_time if self.end_time is not None else self.clock.seconds()
+        if end_time <= self.start_time:
+            return 0.0
+        return self.transferred_bytes / (end_time - self.start_time)
+
+
 class BrowserLikePolicyForHTTPSWithClientCertificate(BrowserLikePolicyForHTTPS):
     """Extend the default HTTPS certificate policy to send a given SSL certificate"""
     def __init__(self, trustRoot=None, clientCertificate=None):
@@ -60,42 +178,59 @@ class BrowserLikePolicyForHTTPSWithClientCertificate(BrowserLikePolicyForHTTPS):
             clientCertificate=self._clientCertificate)
 
 
-class _ReadBodyToTempFileProtocol(Protocol):
-    def __init__(self, status, message, deferred):
+class _WriteBodyAtOffsetProtocol(Protocol):
+    """
+    Writes a response body to a file at a given offset as it's received, and checks its length and SHA256 checksum
+    once it's complete.
+    """
+    def __init__(self, path, offset, length, shasum, deferred, progress=None):
         self.deferred = deferred
-        self.status = status
-        self.message = message
+        self.length = length
+        self.shasum = shasum
+        self.progress = progress
 
-        fd, self.tempfile = tempfile.mkstemp()
-        self.fh = os.fdopen(fd, 'wb')
+        self.sha256 = hashlib.sha256()
+        self.received = 0
+
+        self.fh = open(path, 'r+b')
+        self.fh.seek(offset)
 
     def dataReceived(self, data):
+        # Never write past the part, over the next one
+        remaining = max(self.length - self.received, 0)
+        self.received += len(data)
+        if len(data) > remaining:
+            data = data[:remaining]
+
         self.fh.write(data)
+        self.sha256.update(data)
+        if self.progress is not None:
+            self.progress(len(data))
 
     def connectionLost(self, reason):
         self.fh.close()
-        if reason.check(ResponseDone):
-            self.deferred.callback(self.tempfile)
-        else:
-            try:
-                os.remove(self.tempfile)
-            except Exception:
-                logger.warn('Could not cleanup temporary file %s')
+        if not reason.check(ResponseDone):
             self.deferred.errback(reason)
+        elif self.received != self.length:
+            self.deferred.errback(RuntimeError('Got %d bytes instead of %d for part %s' % (
+                self.received, self.length, self.shasum)))
+        elif self.sha256.hexdigest() != self.shasum:
+            self.deferred.errback(RuntimeError('Bad checksum for part %s' % self.shasum))
+        else:
+            self.deferred.callback(self.length)
 
 
-def readBodyToTempFile(response):
+def readBodyToFile(response, path, offset, length, shasum, progress=None):
     """
-    Same as the standard twisted.web.client.readBody, except it yields the path to a
-    temporary file where the response has been written.
-    :param response:
-    :return:
+    Same as the standard twisted.web.client.readBody, except it writes the response to path at offset, and checks it
+    is length bytes long with the SHA256 checksum shasum. Yields the length.
+    :param progress: called with the number of bytes written, each time some are
     """
     def cancel(deferred):
         getattr(protocol.transport, 'abortConnection', lambda: None)()
 
     d = Deferred(cancel)
-    protocol = _ReadBodyToTempFileProtocol(response.code, response.phrase, d)
+    protocol = _WriteBodyAtOffsetProtocol(path, offset, length, shasum, d, progress=progress)
     response.deliverBody(protocol)
     return d
 
@@ -117,12 +252,33 @@ def create_agent(ca_cert, client_cert, client_key):
     return agent
 
 
-def upload_part(data, shasum, uid, offset, length, agent=None):
+def run_request(agent, f, size=None):
+    """
+    Runs f, that makes a request with agent, within the limits of the agent: its TransferControl, or else its
+    semaphore, if it has any.
+    :param size: see TransferControl.run
+    """
+    transfer_control = getattr(agent, 'transfer_control', None)
+    if transfer_control is not None:
+        return transfer_control.run(size, f)
+    if agent.deferred_semaphore is not None:
+        return agent.deferred_semaphore.run(f)
+    return f()
+
+
+def upload_part(data, shasum, uid, offset, length, agent=None, check=True):
+    """
+    :param check: whether to check that the part doesn't exist yet, before uploading it. Not needed when it's known to
+    be missing (see find_missing_parts).
+    """
     file_size = length
     file_shasum = shasum
 
     # Check if the chunk already exists
-    d0 = check_part(file_shasum, agent=agent)
+    if check:
+        d0 = check_part(file_shasum, agent=agent)
+    else:
+        d0 = succeed(False)
 
     def cbCheckPart(has_file):
         if has_file:
@@ -163,12 +319,7 @@ def upload_part(data, shasum, uid, offset, length, agent=None):
 
                 return d
 
-            if agent.deferred_semaphore is not None:
-                d2 = agent.deferred_semaphore.run(run_upload_part)
-            else:
-                d2 = run_upload_part()
-
-            return d2
+            return run_request(agent, run_upload_part, size=length)
 
     def cbBuildReturnValue(_):
         return {
@@ -184,7 +335,7 @@ def upload_part(data, shasum, uid, offset, length, agent=None):
     return d0
 
 
-def download_part(shasum, agent=None):
+def download_part(shasum, agent=None, length=None):
     def run_download_part():
         d = agent.request(
             'GET',
@@ -208,24 +359,23 @@ def download_part(shasum, agent=None):
 
         return d
 
-    if agent.deferred_semaphore is not None:
-        d2 = agent.deferred_semaphore.run(run_download_part)
-    else:
-        d2 = run_download_part()
-
-    return d2
+    return run_request(agent, run_download_part, size=length)
 
 
-def download_part_to_disk(shasum, agent=None):
-    def run_download_part_to_disk():
+def download_part_to_file(part, path, agent=None, progress=None):
+    """
+    Downloads a part listed in a manifest, and writes it to path at its offset.
+    :param progress: see readBodyToFile
+    """
+    def run_download_part_to_file():
         d = agent.request(
             'GET',
-            'https://entrypoint.seekscale.com:34968/get/%s' % str(shasum)
+            'https://entrypoint.seekscale.com:34968/get/%s' % str(part['shasum'])
         )
 
         def cbResponse(response):
             if response.code != 200:
-                # Always ready the body
+                # Always read the body
                 body_d = readBody(response)
 
                 def raiseError(_):
@@ -234,19 +384,14 @@ def download_part_to_disk(shasum, agent=None):
                 body_d.addBoth(raiseError)
                 return body_d
             else:
-                tmp_file = readBodyToTempFile(response)
-                return tmp_file
+                return readBodyToFile(response, path, part['offset'], part['length'], part['shasum'],
+                                      progress=progress)
 
         d.addCallback(cbResponse)
 
         return d
 
-    if agent.deferred_semaphore is not None:
-        d2 = agent.deferred_semaphore.run(run_download_part_to_disk)
-    else:
-        d2 = run_download_part_to_disk()
-
-    return d2
+    return run_request(agent, run_download_part_to_file, size=part['length'])
 
 
 def check_part(shasum, agent=None):
@@ -262,134 +407,229 @@ def check_part(shasum, agent=None):
 
         return d
 
-    if agent.deferred_semaphore is not None:
-        d2 = agent.deferred_semaphore.run(run_check_part)
-    else:
-        d2 = run_check_part()
-
-    return d2
-
-
-def read_chunk(fh, length):
-    d = threads.deferToThread(fh.read, length)
-
-    def cb(chunk):
-        if chunk == '':
-            return None
-        else:
-            return chunk, sha256sum_str(chunk)
-    d.addCallback(cb)
-
-    return d
+    return run_request(agent, run_check_part, size=0)
 
 
-@inlineCallbacks
-def upload(path, agent=None):
+def get_hash_threadpool():
     """
-    Splits and upload the file given by path
-    Returns a Deferred that fires the manifest object.
+    The thread pool where the chunks are read and hashed. It is started on the first call, and stopped with the
+    reactor. It is separate from the thread pool of the reactor: hashing big files doesn't hold up the other work sent
+    to threads, and at most HASH_POOL_SIZE chunks are hashed at the same time.
     """
-    total_size = os.path.getsize(path)
-    chunk_size = CHUNK_SIZE_IN_MB*1024*1024
+    global _hash_threadpool
+    if _hash_threadpool is None:
+        _hash_threadpool = ThreadPool(minthreads=1, maxthreads=HASH_POOL_SIZE, name='chunk_hashing')
+        _hash_threadpool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', stop_hash_threadpool)
+    return _hash_threadpool
 
-    parts = int(math.ceil(float(total_size)/float(chunk_size)))
-    logger.info("%d parts" % parts)
 
-    uid = 0
-    offset = 0
-    final_data = []
+def stop_hash_threadpool():
+    """Stops the threads of the pool: the process can't exit while they run"""
+    global _hash_threadpool
+    if _hash_threadpool is not None:
+        _hash_threadpool.stop()
+        _hash_threadpool = None
 
-    with open(path, 'rb') as f:
 
-        while offset < total_size:
-            tasks = []
-            queued_tasks = 0
+def missing_parts(shasums, agent=None):
+    """
+    Asks the cache server which of a list of parts it doesn't have, in one request.
+    Returns a Deferred that fires with the list of the shasums of the missing ones.
+    """
+    def run_missing_parts():
+        d = agent.request(
+            'POST',
+            'https://entrypoint.seekscale.com:34968/missing_parts',
+            Headers({'Content-Type': ['application/json']}),
+            FileBodyProducer(StringIO(json.dumps({'shasums': shasums}))))
 
-            while queued_tasks < CONNECTION_COUNT and offset < total_size:
+        def cbResponse(response):
+            body_d = readBody(response)
+            if response.code != 200:
+                def raiseError(_):
+                    raise RuntimeError('Bad status code (%d) while checking parts' % response.code)
+                body_d.addBoth(raiseError)
+            else:
+                body_d.addCallback(lambda body: json.loads(body)['missing'])
+            return body_d
+        d.addCallback(cbResponse)
 
-                if offset + chunk_size <= total_size:
-                    length = chunk_size
-                else:
-                    length = total_size - offset
+        return d
 
-                deferred_data = read_chunk(f, length)
-                data, shasum = yield deferred_data
-                d = upload_part(data, shasum, uid, offset, length, agent=agent)
-                queued_tasks += 1
-                tasks.append(d)
+    # A small request: its duration is a RTT sample
+    return run_request(agent, run_missing_parts, size=0)
 
-                offset += length
-                uid += 1
 
-            final_data += yield DeferredList(tasks)
+@inlineCallbacks
+def find_missing_parts(shasums, agent=None):
+    """
+    Same as missing_parts, by batches of MISSING_PARTS_BATCH_SIZE.
+    Returns a Deferred that fires with the set of the shasums of the missing parts, or None if the cache server
+    couldn't tell (eg. it doesn't have the /missing_parts endpoint): each part must be checked with check_part then.
+    """
+    shasums = sorted(set(shasums))
+    missing = set()
+    try:
+        for i in xrange(0, len(shasums), MISSING_PARTS_BATCH_SIZE):
+            batch_missing = yield missing_parts(shasums[i:i+MISSING_PARTS_BATCH_SIZE], agent=agent)
+            missing.update(batch_missing)
+    except Exception:
+        logger.warning("Could not check the parts in bulk, checking them one by one", exc_info=True)
+        returnValue(None)
+    returnValue(missing)
+
+
+def _read_chunk_at(path, offset, length):
+    with open(path, 'rb') as fh:
+        fh.seek(offset)
+        chunk = fh.read(length)
+    return chunk, sha256sum_str(chunk)
+
+
+def read_chunk_at(path, offset, length):
+    """
+    Reads and hashes a chunk of a file in the hash thread pool, in one go: the chunk is only read once, and nothing of
+    it is done on the reactor thread. Each chunk is read through its own file handle, so that several can be read at
+    the same time.
+    Returns a Deferred that fires with (the chunk, its SHA256 checksum)
+    """
+    return threads.deferToThreadPool(reactor, get_hash_threadpool(), _read_chunk_at, path, offset, length)
 
-    for (r, res) in final_data:
-        if r is not True:
-            returnValue(res)
 
-        returnValue([b for (a, b) in final_data])
+@inlineCallbacks
+def upload(path, agent=None, window=None, chunk_size=CHUNK_SIZE_IN_MB*1024*1024):
+    """
+    Splits and upload the file given by path
+    Returns a Deferred that fires the manifest object.
 
+    The parts are read and hashed by batches of as many as the window keeps in flight, and the cache server is asked
+    which ones of a batch it's missing in one go (see find_missing_parts). The missing ones are uploaded from memory:
+    each part is only read once. The next batch is read and hashed while the previous one is uploaded, so at most two
+    batches are held in memory.
+    :param window: the ChunkWindow that runs the uploads of the parts
+    :param chunk_size: the size of the parts. It mustn't depend on anything else than the content: the parts are
+    addressed by their checksum, and the same content must be cut the same way to be deduplicated.
+    """
+    if window is None:
+        window = ChunkWindow()
 
-@inlineCallbacks
-def download_with_tmp_files(manifest, output_path, agent=None):
+    total_size = os.path.getsize(path)
+    chunks = [
+        (uid, offset, min(chunk_size, total_size - offset))
+        for uid, offset in enumerate(xrange(0, total_size, chunk_size))
+    ]
+    logger.info("%d parts of %d bytes" % (len(chunks), chunk_size))
+
+    @inlineCallbacks
+    def upload_chunk(uid, offset, length, data, shasum, check):
+        part = yield upload_part(data, shasum, uid, offset, length, agent=agent, check=check)
+        window.add_bytes(length)
+        returnValue(part)
+
+    manifest = []
+    uploaded_count = 0
+    # The parts being uploaded, or already uploaded: the same content twice in a file is only uploaded once
+    uploading = set()
+    bulk_check = True
+    # The uploads of the previous batch
+    uploads = None
+    try:
+        for i in xrange(0, len(chunks), window.size):
+            batch = chunks[i:i+window.size]
+            hashed = yield ChunkWindow(HASH_POOL_SIZE * 2).run(
+                lambda offset=offset, length=length: read_chunk_at(path, offset, length)
+                for _, offset, length in batch
+            )
+
+            missing = None
+            if bulk_check:
+                missing = yield find_missing_parts([shasum for _, shasum in hashed], agent=agent)
+                # Don't ask again for the next batches
+                bulk_check = missing is not None
+
+            to_upload = []
+            for (uid, offset, length), (data, shasum) in zip(batch, hashed):
+                if missing is None:
+                    to_upload.append((uid, offset, length, data, shasum, True))
+                elif shasum in missing and shasum not in uploading:
+                    uploading.add(shasum)
+                    to_upload.append((uid, offset, length, data, shasum, False))
+                else:
+                    manifest.append({
+                        'uid': uid,
+                        'offset': offset,
+                        'length': length,
+                        'shasum': shasum,
+                    })
+            # Only the parts to upload are kept
+            del hashed
+
+            if uploads is not None:
+                uploaded = yield uploads
+                manifest.extend(uploaded)
+                uploaded_count += len(uploaded)
+            uploads = window.run(
+                lambda args=args: upload_chunk(*args)
+                for args in to_upload
+            )
+
+        if uploads is not None:
+            uploaded = yield uploads
+            manifest.extend(uploaded)
+            uploaded_count += len(uploaded)
+    finally:
+        if uploads is not None:
+            # After a failure, what happens to the uploads still in flight doesn't matter any more
+            uploads.addErrback(lambda _: None)
+    manifest.sort(key=lambda part: part['uid'])
+
+    logger.info("Uploaded %d of %d parts, %d bytes at %.1f MB/s" % (
+        uploaded_count, len(chunks), window.transferred_bytes, window.throughput() / (1024*1024)))
+
+    returnValue(manifest)
+
+
+def download_to_file(manifest, output_path, agent=None, progress=None, window=None):
     """
-    Downloads the file described by the manifest object to path output_path
+    Downloads the file described by the manifest object to path output_path.
+    The output file is created with its final size, and each part is written at its offset as it's received: the
+    file is only written once. The checksum of each part is checked on the fly.
     Returns a Deferred that fires when the download has completed. (it fires nothing)
     :param manifest:
     :param output_path:
     :param agent:
+    :param progress: called with (the number of bytes received, the size of the file) as the download progresses
+    :param window: the ChunkWindow that runs the downloads of the parts
     :return:
     """
-    sorted_manifest = sorted(manifest, key=lambda k: k['uid'])
-    final_data = []
+    if window is None:
+        window = ChunkWindow()
 
-    tasks = []
-    queued_tasks = 0
-    for part in sorted_manifest:
-        d = download_part_to_disk(part['shasum'], agent=agent)
-        tasks.append(d)
-        queued_tasks += 1
-
-        if queued_tasks >= CONNECTION_COUNT:
-            final_data += yield DeferredList(tasks, consumeErrors=True)
-
-            tasks = []
-            queued_tasks = 0
-
-    # Process the remaining tasks
-    if queued_tasks > 0:
-        final_data += yield DeferredList(tasks, consumeErrors=True)
+    sorted_manifest = sorted(manifest, key=lambda k: k['uid'])
+    total_size = sum(part['length'] for part in sorted_manifest)
 
-    def build_output_file(data):
-        success = True
-        result = None
+    with open(output_path, 'wb') as f:
+        f.truncate(total_size)
 
-        # Check if all the parts were successful
-        for (r, res) in data:
-            if r is not True:
-                result = res
-                success = False
-                break
+    received = [0]
 
-        # If we have all the parts, combine them into the output file
-        if success:
-            with open(output_path, 'wb') as f:
-                for (r, res) in data:
-                    with open(res, 'rb') as f_source:
-                        shutil.copyfileobj(f_source, f, 10240)
-            logger.info("Downloaded file size: %d" % os.path.getsize(output_path))
+    def part_progress(length):
+        received[0] += length
+        window.add_bytes(length)
+        if progress is not None:
+            progress(received[0], total_size)
 
-        # Whatever the result, we clean up all the successful temporary files
-        for (r, res) in data:
-            if r is True:
-                try:
-                    os.remove(res)
-                except Exception:
-                    logger.warn('Could not cleanup temporary file %s' % res)
+    d = window.run(
+        lambda part=part: download_part_to_file(part, output_path, agent=agent, progress=part_progress)
+        for part in sorted_manifest
+    )
 
-        returnValue(result)
+    def log_throughput(_):
+        logger.info("Downloaded %d bytes at %.1f MB/s" % (total_size, window.throughput() / (1024*1024)))
+    d.addCallback(log_throughput)
 
-    build_output_file(final_data)
+    return d
 
 
 #
@@ -428,7 +668,7 @@ def main_download(manifest_file, output_path):
 
     with open(manifest_file, 'rb') as f:
         manifest = json.loads(f.read())
-    d = download_with_tmp_files(manifest, output_path, agent=agent)
+    d = download_to_file(manifest, output_path, agent=agent)
 
     def handleError(error):
         print "An error occured while downloading the file:", error
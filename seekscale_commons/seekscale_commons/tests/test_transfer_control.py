@@ -0,0 +1,109 @@
+# coding: utf-8
+
+# Copyright Luna Technology 2016
+# Matthieu Riviere <mriviere@luna-technology.com>
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from seekscale_commons.cache_client.transfer_control import TransferControl, PROBE_INTERVAL
+
+
+MB = 1024*1024
+
+
+class TestTransferControl(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.control = TransferControl('cache', initial_concurrency=2, max_concurrency=8, clock=self.clock)
+        self.started = []
+
+    def request(self):
+        d = defer.Deferred()
+        self.started.append(d)
+        return d
+
+    def run_round(self, size, duration, failed=0):
+        """Runs a round with one more request waiting than allowed, all finishing after duration seconds"""
+        count = self.control.concurrency
+        self.started = []
+        for _ in xrange(count):
+            self.control.run(size, self.request)
+        self.control.run(None, self.request)
+        self.clock.advance(duration)
+        for i, d in enumerate(self.started[:count]):
+            if i < failed:
+                d.errback(RuntimeError('Connection reset'))
+            else:
+                d.callback(None)
+        # Let the one that was waiting go, so that the next round starts from nothing
+        self.started[count].callback(None)
+        self.flushLoggedErrors(RuntimeError)
+
+    def test_limits_the_requests_in_flight(self):
+        results = []
+        for i in xrange(3):
+            self.control.run(MB, self.request).addCallback(results.append)
+        assert len(self.started) == 2
+
+        self.started[0].callback('a')
+        assert len(self.started) == 3
+        assert results == ['a']
+
+    def test_slow_start(self):
+        # Twice as many requests each time the goodput grows...
+        self.run_round(MB, 1)
+        assert self.control.concurrency == 4
+        self.run_round(MB, 1)
+        assert self.control.concurrency == 8
+
+    def test_plateau(self):
+        self.run_round(MB, 1)
+        assert self.control.concurrency == 4
+        # ... and it stays there once it doesn't grow any more
+        self.run_round(MB, 2)
+        assert self.control.concurrency == 4
+        assert not self.control.slow_start
+
+        # Then it tries one more once in a while, and goes back if that didn't help
+        for _ in xrange(PROBE_INTERVAL - 2):
+            self.run_round(MB, 2)
+            assert self.control.concurrency == 4
+        self.run_round(MB, 2)
+        assert self.control.concurrency == 5
+        self.run_round(MB, 2.5)
+        assert self.control.concurrency == 4
+
+    def test_failures(self):
+        self.run_round(MB, 1)
+        self.run_round(MB, 1)
+        assert self.control.concurrency == 8
+
+        self.run_round(MB, 1, failed=1)
+        assert self.control.concurrency == 5
+        assert not self.control.slow_start
+
+    def test_app_limited(self):
+        # Never more than one request at a time: the goodput isn't that of the link
+        for _ in xrange(4):
+            self.control.run(MB, self.request)
+            self.clock.advance(1)
+            self.started[-1].callback(None)
+        assert self.control.concurrency == 2
+        assert self.control.goodput is None
+
+    def test_min_rtt(self):
+        # Measured on the requests without a size
+        self.control.run(0, self.request)
+        self.clock.advance(0.05)
+        self.started[0].callback(None)
+        self.run_round(MB, 1)
+        assert self.control.min_rtt() == 0.05
+
+    def test_listener(self):
+        stats = []
+        self.control.add_listener(stats.append)
+        self.run_round(MB, 1)
+        assert len(stats) == 1
+        assert stats[0]['concurrency'] == 4
+        assert stats[0]['goodput'] == 2*MB
@@ -0,0 +1,306 @@
+# coding: utf-8
+
+# Copyright Luna Technology 2016
+# Matthieu Riviere <mriviere@luna-technology.com>
+
+import json
+import os
+import shutil
+import tempfile
+
+from twisted.internet import defer, task
+from twisted.python import failure
+from twisted.trial import unittest
+from twisted.web.client import ResponseDone, ResponseFailed
+
+from seekscale_commons.cache_client import twisted_client
+from seekscale_commons.cache_client.transfer_control import TransferControl
+from seekscale_commons.cache_client.twisted_client import ChunkWindow, download_to_file, read_chunk_at, \
+    sha256sum_str, stop_hash_threadpool, upload
+
+
+class TestChunkWindow(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.window = ChunkWindow(2, clock=self.clock)
+        self.started = []
+
+    def transfer(self, i):
+        d = defer.Deferred()
+        self.started.append((i, d))
+        return d
+
+    def tasks(self, count):
+        return [lambda i=i: self.transfer(i) for i in xrange(count)]
+
+    def test_refills_as_each_transfer_finishes(self):
+        results = []
+        self.window.run(self.tasks(4)).addCallback(results.append)
+        assert [i for i, _ in self.started] == [0, 1]
+
+        # No need to wait for the first one
+        self.started[1][1].callback('b')
+        assert [i for i, _ in self.started] == [0, 1, 2]
+
+        self.started[0][1].callback('a')
+        self.started[2][1].callback('c')
+        assert results == []
+        self.started[3][1].callback('d')
+        assert results == [['a', 'b', 'c', 'd']]
+
+    def test_synchronous_tasks(self):
+        results = []
+        self.window.run([lambda i=i: i for i in xrange(1000)]).addCallback(results.append)
+        assert results == [range(1000)]
+
+    def test_failure(self):
+        failures = []
+        self.window.run(self.tasks(4)).addErrback(failures.append)
+        self.started[0][1].errback(RuntimeError('Part unavailable'))
+
+        # No new transfer, but the one in flight is waited for
+        assert len(self.started) == 2
+        assert failures == []
+        self.started[1][1].callback('b')
+        assert len(failures) == 1
+        assert failures[0].check(RuntimeError)
+
+    def test_transfer_control(self):
+        self.window.transfer_control = TransferControl('cache', initial_concurrency=1, clock=self.clock)
+        self.window.run(self.tasks(3))
+        assert len(self.started) == 1
+
+        self.window.transfer_control.concurrency = 4
+        self.started[0][1].callback(None)
+        # Still no more than the size of the window
+        assert len(self.started) == 3
+
+    def test_throughput(self):
+        self.window.run(self.tasks(1))
+        self.clock.advance(2)
+        self.window.add_bytes(1000)
+        assert self.window.throughput() == 500.0
+
+        self.started[0][1].callback(None)
+        self.clock.advance(2)
+        assert self.window.throughput() == 500.0
+
+
+class FakeResponse(object):
+    """Stands for a twisted.web response: delivers its body in small pieces"""
+    phrase = 'OK'
+
+    def __init__(self, body, code=200, error=None):
+        self.body = body
+        self.code = code
+        self.error = error
+
+    def deliverBody(self, protocol):
+        for i in xrange(0, len(self.body), 3):
+            protocol.dataReceived(self.body[i:i+3])
+        protocol.connectionLost(failure.Failure(self.error or ResponseDone()))
+
+
+class FakeAgent(object):
+    """Stands for the agent of create_agent: serves the parts it knows, by shasum, and stores the uploaded ones"""
+    deferred_semaphore = None
+    transfer_control = None
+
+    def __init__(self, parts, has_missing_parts=True):
+        self.parts = parts
+        self.has_missing_parts = has_missing_parts
+        self.requests = []
+
+    def request(self, method, uri, headers=None, body=None):
+        shasum = uri.rsplit('/', 1)[1]
+        self.requests.append((method, shasum))
+
+        if shasum == 'missing_parts':
+            if not self.has_missing_parts:
+                return defer.succeed(FakeResponse('', code=404))
+            shasums = json.loads(body._inputFile.read())['shasums']
+            return defer.succeed(FakeResponse(json.dumps({
+                'missing': [shasum for shasum in shasums if shasum not in self.parts],
+            })))
+
+        if shasum == 'upload':
+            data = body._inputFile.read()
+            self.parts[sha256sum_str(data)] = FakeResponse(data)
+            return defer.succeed(FakeResponse('{}'))
+
+        response = self.parts.get(shasum)
+        if response is None:
+            response = FakeResponse('', code=404)
+        return defer.succeed(response)
+
+
+def manifest_of(parts):
+    manifest = []
+    offset = 0
+    for uid, data in enumerate(parts):
+        manifest.append({'uid': uid, 'offset': offset, 'length': len(data), 'shasum': sha256sum_str(data)})
+        offset += len(data)
+    return manifest
+
+
+class TestDownloadToFile(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'output')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def agent_for(self, parts):
+        return FakeAgent(dict((sha256sum_str(data), FakeResponse(data)) for data in parts))
+
+    @defer.inlineCallbacks
+    def test_parts_are_written_at_their_offset(self):
+        parts = ['first part', 'second part', 'end']
+        manifest = manifest_of(parts)
+        progress = []
+
+        # The order of the manifest doesn't matter
+        yield download_to_file(list(reversed(manifest)), self.path, agent=self.agent_for(parts),
+                               progress=lambda received, total: progress.append((received, total)))
+
+        with open(self.path, 'rb') as fh:
+            assert fh.read() == ''.join(parts)
+        assert progress[-1] == (24, 24)
+        assert [received for received, _ in progress] == sorted(received for received, _ in progress)
+
+    @defer.inlineCallbacks
+    def test_bad_checksum(self):
+        parts = ['first part', 'second part']
+        manifest = manifest_of(parts)
+        agent = self.agent_for(parts)
+        agent.parts[manifest[1]['shasum']] = FakeResponse('SECOND PART')
+
+        try:
+            yield download_to_file(manifest, self.path, agent=agent)
+        except RuntimeError, e:
+            assert 'Bad checksum' in str(e)
+        else:
+            self.fail('The download should have failed')
+
+    @defer.inlineCallbacks
+    def test_longer_part_does_not_overwrite_the_next_one(self):
+        parts = ['first part', 'second part']
+        manifest = manifest_of(parts)
+        agent = self.agent_for(parts)
+        agent.parts[manifest[0]['shasum']] = FakeResponse('first part, and more')
+
+        try:
+            yield download_to_file(manifest, self.path, agent=agent)
+        except RuntimeError, e:
+            assert 'Got 20 bytes instead of 10' in str(e)
+        else:
+            self.fail('The download should have failed')
+
+        # The second part wasn't downloaded after the failure
+        with open(self.path, 'rb') as fh:
+            assert fh.read() == 'first part' + '\0' * 11
+
+    @defer.inlineCallbacks
+    def test_interrupted_part(self):
+        parts = ['first part']
+        agent = FakeAgent({sha256sum_str(parts[0]): FakeResponse('first', error=ResponseFailed([]))})
+
+        try:
+            yield download_to_file(manifest_of(parts), self.path, agent=agent)
+        except ResponseFailed:
+            pass
+        else:
+            self.fail('The download should have failed')
+
+
+class TestReadChunkAt(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'input')
+        with open(self.path, 'wb') as fh:
+            fh.write('first part, second part')
+        self.addCleanup(stop_hash_threadpool)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @defer.inlineCallbacks
+    def test_chunks_are_read_and_hashed(self):
+        chunks = yield defer.gatherResults([read_chunk_at(self.path, 0, 11), read_chunk_at(self.path, 12, 100)])
+        assert chunks == [
+            ('first part,', sha256sum_str('first part,')),
+            ('second part', sha256sum_str('second part')),
+        ]
+
+
+class TestUpload(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'input')
+        # Parts of 10 bytes, the first one twice
+        self.parts = ['first part', 'other part', 'first part', 'end']
+        with open(self.path, 'wb') as fh:
+            fh.write(''.join(self.parts))
+        self.addCleanup(stop_hash_threadpool)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def agent_with(self, parts, **kwargs):
+        agent = FakeAgent(dict((sha256sum_str(data), FakeResponse(data)) for data in parts), **kwargs)
+        agent.transfer_control = TransferControl('cache', initial_concurrency=1, max_concurrency=1)
+        return agent
+
+    def uploads(self, agent):
+        return [shasum for method, shasum in agent.requests if shasum == 'upload']
+
+    @defer.inlineCallbacks
+    def test_only_missing_parts_are_uploaded(self):
+        agent = self.agent_with([self.parts[1]])
+        manifest = yield upload(self.path, agent=agent, chunk_size=10)
+
+        assert manifest == manifest_of(self.parts)
+        # A single check for all the parts, and no check of each part
+        assert [method for method, _ in agent.requests if method != 'POST'] == []
+        assert len([shasum for _, shasum in agent.requests if shasum == 'missing_parts']) == 1
+        # The first part is only uploaded once
+        assert len(self.uploads(agent)) == 2
+
+    @defer.inlineCallbacks
+    def test_each_part_is_read_once(self):
+        reads = []
+
+        def read_chunk_at(path, offset, length):
+            reads.append(offset)
+            return real_read_chunk_at(path, offset, length)
+        real_read_chunk_at, twisted_client._read_chunk_at = twisted_client._read_chunk_at, read_chunk_at
+        self.addCleanup(setattr, twisted_client, '_read_chunk_at', real_read_chunk_at)
+
+        agent = self.agent_with([self.parts[1]])
+        manifest = yield upload(self.path, agent=agent, window=ChunkWindow(2), chunk_size=10)
+
+        assert manifest == manifest_of(self.parts)
+        assert sorted(reads) == [0, 10, 20, 30]
+        # One check for each batch of as many parts as the window has
+        assert len([shasum for _, shasum in agent.requests if shasum == 'missing_parts']) == 2
+        # The first part is only uploaded once
+        assert len(self.uploads(agent)) == 2
+
+    @defer.inlineCallbacks
+    def test_nothing_to_upload(self):
+        agent = self.agent_with(self.parts)
+        manifest = yield upload(self.path, agent=agent, chunk_size=10)
+
+        assert manifest == manifest_of(self.parts)
+        assert agent.requests == [('POST', 'missing_parts')]
+
+    @defer.inlineCallbacks
+    def test_without_bulk_check(self):
+        agent = self.agent_with([self.parts[1]], has_missing_parts=False)
+        manifest = yield upload(self.path, agent=agent, chunk_size=10)
+
+        assert manifest == manifest_of(self.parts)
+        # Each part is checked instead
+        assert len([method for method, _ in agent.requests if method == 'HEAD']) == 4
+        assert len(self.uploads(agent)) == 2
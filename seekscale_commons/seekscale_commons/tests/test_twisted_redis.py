@@ -0,0 +1,85 @@
+# coding: utf-8
+
+# Copyright Luna Technology 2016
+# Matthieu Riviere <mriviere@luna-technology.com>
+
+import threading
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from seekscale_commons.twisted_redis import AsyncRedis, RedisChannelWaiter, stop_threadpool
+
+
+class FakePipeline(object):
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def get(self, key):
+        self.commands.append(key)
+
+    def execute(self):
+        return [self.client.get(key) for key in self.commands]
+
+
+class FakeRedis(object):
+    """Stands for a redis.StrictRedis: records the thread each command runs in"""
+    def __init__(self):
+        self.data = {'a': '1', 'b': '2'}
+        self.threads = []
+
+    def get(self, key):
+        self.threads.append(threading.current_thread())
+        return self.data.get(key)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class TestAsyncRedis(unittest.TestCase):
+    def setUp(self):
+        self.client = FakeRedis()
+        self.redis = AsyncRedis(self.client)
+        self.addCleanup(stop_threadpool)
+
+    @defer.inlineCallbacks
+    def test_command(self):
+        value = yield self.redis.get('a')
+        self.assertEqual(value, '1')
+        self.assertNotEqual(self.client.threads, [threading.current_thread()])
+
+    @defer.inlineCallbacks
+    def test_pipeline(self):
+        values = yield self.redis.pipeline(lambda pipe: [pipe.get(key) for key in ('a', 'b', 'c')])
+        self.assertEqual(values, ['1', '2', None])
+
+    @defer.inlineCallbacks
+    def test_errors(self):
+        def fail():
+            raise RuntimeError('Connection refused')
+        yield self.assertFailure(self.redis.run(fail), RuntimeError)
+
+
+class TestRedisChannelWaiter(unittest.TestCase):
+    def setUp(self):
+        self.waiter = RedisChannelWaiter(FakeRedis(), 'job:*:done')
+        # Don't start the subscriber thread: messages are delivered by hand
+        self.waiter.thread = object()
+
+    def test_message_fires_the_waiters_of_the_channel(self):
+        first = self.waiter.wait('job:1:done')
+        second = self.waiter.wait('job:1:done')
+        other = self.waiter.wait('job:2:done')
+
+        self.waiter.message_received('job:1:done', 'SUCCESS')
+        self.assertEqual(self.successResultOf(first), 'SUCCESS')
+        self.assertEqual(self.successResultOf(second), 'SUCCESS')
+        self.assertNoResult(other)
+        self.assertEqual(self.waiter.waiters.keys(), ['job:2:done'])
+
+    def test_forget(self):
+        d = self.waiter.wait('job:1:done')
+        self.waiter.forget('job:1:done')
+        self.waiter.message_received('job:1:done', 'SUCCESS')
+        self.assertNoResult(d)
@@ -0,0 +1,161 @@
+# coding: utf-8
+
+# Copyright Luna Technology 2016
+# Matthieu Riviere <mriviere@luna-technology.com>
+
+"""Non-blocking access to redis from a Twisted reactor
+
+redis.StrictRedis blocks on each command: called from the reactor thread, one slow reply stalls everything the
+reactor does. AsyncRedis runs the commands in a thread pool instead, and returns Deferreds:
+
+    r = AsyncRedis(redis.StrictRedis(host='127.0.0.1'))
+    value = yield r.get('some:key')
+    results = yield r.pipeline(lambda pipe: [pipe.get(key) for key in keys])
+
+All the AsyncRedis of a process share the same bounded thread pool (THREAD_POOL_SIZE threads). Blocking commands
+(BLPOP, SUBSCRIBE...) must not go through it: RedisChannelWaiter has its own thread.
+"""
+
+import logging
+import threading
+import time
+
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import threads
+from twisted.python.threadpool import ThreadPool
+
+
+logger = logging.getLogger(__name__)
+
+THREAD_POOL_SIZE = 4
+
+_threadpool = None
+
+
+def get_threadpool():
+    """The thread pool where the redis commands run. It is started on the first call, and stopped with the reactor."""
+    global _threadpool
+    if _threadpool is None:
+        _threadpool = ThreadPool(minthreads=1, maxthreads=THREAD_POOL_SIZE, name='redis')
+        _threadpool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', stop_threadpool)
+    return _threadpool
+
+
+def stop_threadpool():
+    """Stops the threads of the pool: the process can't exit while they run"""
+    global _threadpool
+    if _threadpool is not None:
+        _threadpool.stop()
+        _threadpool = None
+
+
+class AsyncRedis(object):
+    """
+    Wraps a redis.StrictRedis: its commands are available under the same names, and return Deferreds.
+    """
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+
+    def run(self, f, *args, **kwargs):
+        """
+        Runs a function in the redis thread pool. Used to run several commands (or decode their results) in one go.
+        :return: a Deferred that fires with the result of f
+        """
+        return threads.deferToThreadPool(reactor, get_threadpool(), f, *args, **kwargs)
+
+    def __getattr__(self, name):
+        command = getattr(self.redis, name)
+
+        def run_command(*args, **kwargs):
+            return self.run(command, *args, **kwargs)
+        return run_command
+
+    def pipeline(self, queue_commands, transaction=True):
+        """
+        Sends several commands in a single round trip.
+        :param queue_commands: called with the pipeline, to queue the commands
+        :return: a Deferred that fires with the list of the results of the commands
+        """
+        def execute():
+            pipe = self.redis.pipeline(transaction=transaction)
+            queue_commands(pipe)
+            return pipe.execute()
+        return self.run(execute)
+
+    def register_script(self, script):
+        """
+        :return: a function that runs the Lua script, and returns a Deferred
+        """
+        registered_script = self.redis.register_script(script)
+
+        def run_script(keys=None, args=None):
+            return self.run(registered_script, keys=keys, args=args)
+        return run_script
+
+
+class RedisChannelWaiter(object):
+    """
+    Waits for the next message published on redis channels matching a pattern.
+
+    A single connection is subscribed to the pattern, in a dedicated thread. The messages published while it is
+    disconnected are lost: the callers must have another way to notice what they wait for.
+    """
+    RECONNECT_DELAY = 1
+
+    def __init__(self, redis_client, pattern):
+        self.redis = redis_client
+        self.pattern = pattern
+
+        # channel -> Deferreds waiting for its next message
+        self.waiters = {}
+
+        self.thread = None
+        self.running = False
+
+    def wait(self, channel):
+        """
+        :return: a Deferred that fires with the data of the next message published on channel
+        """
+        if self.thread is None:
+            self.start()
+
+        d = defer.Deferred()
+        self.waiters.setdefault(channel, []).append(d)
+        return d
+
+    def forget(self, channel):
+        """Stops waiting on a channel. The Deferreds returned by wait() for it won't fire."""
+        self.waiters.pop(channel, None)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.listen, name='redis-subscriber')
+        self.thread.daemon = True
+        self.thread.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+
+    def stop(self):
+        self.running = False
+
+    def listen(self):
+        """Runs in the dedicated thread"""
+        while self.running:
+            pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.psubscribe(self.pattern)
+                while self.running:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is not None:
+                        reactor.callFromThread(self.message_received, message['channel'], message['data'])
+            except Exception:
+                logger.warning('Lost the subscription to %s' % self.pattern, exc_info=True)
+                time.sleep(self.RECONNECT_DELAY)
+            finally:
+                pubsub.close()
+
+    def message_received(self, channel, data):
+        for d in self.waiters.pop(channel, []):
+            d.callback(data)
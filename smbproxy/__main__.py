@@ -5,12 +5,14 @@
 # Matthieu Riviere <mriviere@luna-technology.com>
 
 import argparse
+import sys
 
 from twisted.python import log
 
 from smbproxy4 import settings
 from smbproxy4.logger import plainJSONStdOutLogger
 from smbproxy4.smbproxy4 import init
+from smbproxy4.supervisor import run_supervisor
 
 
 def main():
@@ -31,6 +33,10 @@ def main():
 
     parser.add_argument('--force-host', dest='force_host', default=None)
 
+    parser.add_argument('--workers', dest='workers', type=int, default=settings.WORKERS)
+    # Internal: set by the supervisor on the command line of its workers
+    parser.add_argument('--inherited-fd', dest='inherited_fd', type=int, default=None, help=argparse.SUPPRESS)
+
     parsed_args = parser.parse_args()
 
     if parsed_args.shares_root is not None:
@@ -42,6 +48,18 @@ def main():
     if parsed_args.force_host is not None:
         settings.FORCE_HOST = parsed_args.force_host
 
+    if parsed_args.inherited_fd is None and parsed_args.workers > 1:
+        settings.WORKERS = parsed_args.workers
+        run_supervisor(
+            parsed_args.listen_address,
+            parsed_args.listen_port,
+            parsed_args.workers,
+            [sys.executable, sys.argv[0]] + sys.argv[1:] + ['--workers', str(parsed_args.workers)],
+        )
+        return
+
+    settings.WORKERS = parsed_args.workers
+
     init(
         parsed_args.listen_address,
         parsed_args.listen_port,
@@ -50,6 +68,7 @@ def main():
         parsed_args.metadata_proxy_address,
         parsed_args.metadata_proxy_port,
         settings,
+        inherited_fd=parsed_args.inherited_fd,
     )
 
 
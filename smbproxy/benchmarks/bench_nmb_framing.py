@@ -0,0 +1,88 @@
+#!/usr/bin/env python2
+# coding: utf-8
+
+# Copyright Luna Technology 2016
+# Matthieu Riviere <mriviere@luna-technology.com>
+
+"""
+Measures the throughput (in MB/s, for a single connection) of the NMB framing done in ProxyServerProtocol.
+
+The "string" variant is the historical implementation (the receive buffer is a string that gets concatenated with
+each incoming chunk, then sliced for each frame). The "buffer" variant uses NMBReceiveBuffer.
+
+Usage: python benchmarks/bench_nmb_framing.py [frame_size_in_kb] [tcp_chunk_size_in_kb] [total_size_in_mb]
+"""
+
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from nmb.nmb_structs import DirectTCPSessionMessage, NMBReceiveBuffer
+
+
+def build_stream(frame_size, total_size):
+    frame = struct.pack('>I', frame_size) + os.urandom(frame_size)
+    return frame * max(1, total_size / len(frame))
+
+
+def split_in_chunks(stream, chunk_size):
+    return [stream[i:i+chunk_size] for i in xrange(0, len(stream), chunk_size)]
+
+
+def frame_with_string(chunks):
+    data_buf = ''
+    frames = 0
+    for data in chunks:
+        data_buf = data_buf + data
+        while True:
+            data_nmb = DirectTCPSessionMessage()
+            length = data_nmb.decode(data_buf, 0)
+            if length == 0:
+                break
+            raw_chunk = data_buf[:length]
+            data_buf = data_buf[length:]
+            frames += 1
+    return frames
+
+
+def frame_with_buffer(chunks):
+    data_buf = NMBReceiveBuffer()
+    frames = 0
+    for data in chunks:
+        data_buf.append(data)
+        while True:
+            data_nmb = DirectTCPSessionMessage()
+            length = data_nmb.decode_from_buffer(data_buf)
+            if length == 0:
+                break
+            raw_chunks = data_nmb.raw_chunks
+            frames += 1
+    return frames
+
+
+def run(name, func, chunks, total_size):
+    start = time.time()
+    frames = func(chunks)
+    duration = time.time() - start
+    print '%-8s %6d frames  %8.1f MB/s' % (name, frames, total_size / duration / 1024 / 1024)
+
+
+def main():
+    frame_size = int(sys.argv[1]) * 1024 if len(sys.argv) > 1 else 8 * 1024 * 1024
+    chunk_size = int(sys.argv[2]) * 1024 if len(sys.argv) > 2 else 64 * 1024
+    total_size = int(sys.argv[3]) * 1024 * 1024 if len(sys.argv) > 3 else 256 * 1024 * 1024
+
+    stream = build_stream(frame_size, total_size)
+    chunks = split_in_chunks(stream, chunk_size)
+    print 'Frames of %d KB, received in TCP chunks of %d KB, %d MB total' % (
+        frame_size / 1024, chunk_size / 1024, len(stream) / 1024 / 1024)
+
+    run('string', frame_with_string, chunks, len(stream))
+    run('buffer', frame_with_buffer, chunks, len(stream))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python2
+# coding: utf-8
+
+# Copyright Luna Technology 2016
+# Matthieu Riviere <mriviere@luna-technology.com>
+
+"""
+Measures how many SMB2 packets per second the proxy decodes (header, plus the body of the intercepted commands).
+
+The "legacy" variant is the historical implementation (format strings and struct.calcsize on each packet, the body
+unpacked with struct.unpack). The "dispatch" variant uses smb2_dispatcher with the handlers of the proxy.
+
+The traffic is replayed from a capture of the client side of a SMB2 connection: the raw TCP stream from the client to
+the server (eg. Wireshark's "Follow TCP stream", saved as raw data, or the output of tcpflow). Without a capture, a
+synthetic mix of requests is used.
+
+Usage: python benchmarks/bench_smb2_parsing.py [capture_file] [repeat]
+"""
+
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from nmb.nmb_structs import DirectTCPSessionMessage, NMBReceiveBuffer
+from smb.smb2_constants import *
+from smb.smb2_structs import SMB2Message
+from smbproxy4.smb2_dispatcher import parse_smb2_message
+from smbproxy4.smbproxy4 import SMB2_REQUEST_HANDLERS
+
+
+LEGACY_BODY_FORMATS = {
+    SMB2_COM_CREATE: '<HBBIQQIIIIIHHII',
+    SMB2_COM_QUERY_DIRECTORY: '<HBBI16sHHI',
+    SMB2_COM_TREE_CONNECT: '<HHHH',
+    SMB2_COM_SET_INFO: '<HBBIHHI16s',
+    SMB2_COM_CLOSE: '<HHI16s',
+}
+
+
+def legacy_parse(buf):
+    smb_message = SMB2Message()
+
+    HEADER_STRUCT_FORMAT = '<4sHHIHHI'
+    HEADER_STRUCT_SIZE = struct.calcsize(HEADER_STRUCT_FORMAT)
+    HEADER_SIZE = 64
+    ASYNC_HEADER_STRUCT_FORMAT = '<IQQQ16s'
+    ASYNC_HEADER_STRUCT_SIZE = struct.calcsize(ASYNC_HEADER_STRUCT_FORMAT)
+    SYNC_HEADER_STRUCT_FORMAT = '<IQIIQ16s'
+    SYNC_HEADER_STRUCT_SIZE = struct.calcsize(SYNC_HEADER_STRUCT_FORMAT)
+
+    protocol, struct_size, smb_message.credit_charge, smb_message.status, smb_message.command,\
+        smb_message.credit_re, smb_message.flags = struct.unpack(HEADER_STRUCT_FORMAT, buf[:HEADER_STRUCT_SIZE])
+
+    if smb_message.flags & SMB2_FLAGS_ASYNC_COMMAND:
+        smb_message.next_command_offset, smb_message.mid, smb_message.async_id, smb_message.session_id, \
+            smb_message.signature = \
+            struct.unpack(
+                ASYNC_HEADER_STRUCT_FORMAT,
+                buf[HEADER_STRUCT_SIZE:HEADER_STRUCT_SIZE+ASYNC_HEADER_STRUCT_SIZE]
+            )
+    else:
+        smb_message.next_command_offset, smb_message.mid, smb_message.pid, smb_message.tid, smb_message.session_id,\
+            smb_message.signature = \
+            struct.unpack(
+                SYNC_HEADER_STRUCT_FORMAT,
+                buf[HEADER_STRUCT_SIZE:HEADER_STRUCT_SIZE+SYNC_HEADER_STRUCT_SIZE]
+            )
+
+    if smb_message.next_command_offset > 0:
+        smb_message.raw_data = buf[:smb_message.next_command_offset]
+        smb_message.data = buf[HEADER_SIZE:smb_message.next_command_offset]
+    else:
+        smb_message.raw_data = buf
+        smb_message.data = buf[HEADER_SIZE:]
+
+    body_format = LEGACY_BODY_FORMATS.get(smb_message.command)
+    if body_format is not None:
+        body_size = struct.calcsize(body_format)
+        struct.unpack(body_format, smb_message.data[:body_size])
+
+    return len(smb_message.raw_data), smb_message
+
+
+def dispatch_parse(buf):
+    length, smb_message = parse_smb2_message(buf)
+    SMB2_REQUEST_HANDLERS.decode_body(smb_message)
+    return length, smb_message
+
+
+def smb2_request(command, body, mid):
+    header = struct.pack(
+        '<4sHHIHHIIQIIQ16s',
+        '\xFESMB', 64, 1, 0, command, 1, 0, 0, mid, 0, 1, 1, '\0' * 16
+    )
+    message = header + body
+    return struct.pack('>I', len(message)) + message
+
+
+def synthetic_traffic(count):
+    name = u'renders\\shot_010\\frame_0001.exr'.encode('UTF-16LE')
+    create = struct.pack('<HBBIQQIIIIIHHII', 57, 0, 0, 0, 0, 0, 0x80, 0, 7, 1, 0, 64 + 56, len(name), 0, 0) + name
+    read = struct.pack('<HBBIQ16sIIIHH', 49, 0, 0, 65536, 0, 'f' * 16, 0, 0, 0, 0, 0) + '\0'
+    write = struct.pack('<HHIQ16sIIHHI', 49, 64 + 48, 4096, 0, 'f' * 16, 0, 0, 0, 0, 0) + '\0' * 4096
+    query_info = struct.pack('<HBBIHHII16s', 41, 1, 5, 4096, 0, 0, 0, 0, 'f' * 16)
+    query_directory = struct.pack('<HBBI16sHHI', 33, 37, 0, 0, 'f' * 16, 64 + 32, 2, 65536) + u'*'.encode('UTF-16LE')
+    close = struct.pack('<HHI16s', 24, 0, 0, 'f' * 16)
+
+    # A typical mix: mostly reads and writes, a few opens, directory listings and metadata requests
+    mix = [
+        (SMB2_COM_CREATE, create),
+        (SMB2_COM_QUERY_INFO, query_info),
+        (SMB2_COM_READ, read),
+        (SMB2_COM_READ, read),
+        (SMB2_COM_READ, read),
+        (SMB2_COM_WRITE, write),
+        (SMB2_COM_WRITE, write),
+        (SMB2_COM_QUERY_DIRECTORY, query_directory),
+        (SMB2_COM_CLOSE, close),
+    ]
+
+    return ''.join(smb2_request(command, body, mid) for mid, (command, body) in
+                   enumerate(mix[i % len(mix)] for i in xrange(count)))
+
+
+def decode_frames(stream):
+    buf = NMBReceiveBuffer()
+    buf.append(stream)
+
+    frames = []
+    while True:
+        packet = DirectTCPSessionMessage()
+        if packet.decode_from_buffer(buf) == 0:
+            break
+        if packet.data[:4] == '\xFESMB':
+            frames.append(packet.data)
+    return frames
+
+
+def run(name, parse, frames, repeat):
+    messages = 0
+    start = time.time()
+    for _ in xrange(repeat):
+        for data in frames:
+            while True:
+                _, message = parse(data)
+                messages += 1
+                if message.next_command_offset > 0:
+                    data = data[message.next_command_offset:]
+                else:
+                    break
+    duration = time.time() - start
+    print '%-8s %8d messages  %10.0f packets/s' % (name, messages, messages / duration)
+
+
+def main():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'rb') as fh:
+            stream = fh.read()
+    else:
+        stream = synthetic_traffic(10000)
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    frames = decode_frames(stream)
+    print '%d SMB2 packets, replayed %d times' % (len(frames), repeat)
+
+    run('legacy', legacy_parse, frames, repeat)
+    run('dispatch', dispatch_parse, frames, repeat)
+
+
+if __name__ == '__main__':
+    main()
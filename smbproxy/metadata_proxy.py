@@ -38,6 +38,14 @@ FILE_LISTDIR_REQUEST_TIMEOUT = 45
 
 logger = logging.getLogger(__name__)
 
+# Telemetry counters, reported by /status.json
+stats = {
+    'file_metadata.cache_hit': 0,
+    'file_metadata.cache_miss': 0,
+    'list_dir.cache_hit': 0,
+    'list_dir.cache_miss': 0,
+}
+
 
 def json_response(obj):
     obj['status'] = 'Ok'
@@ -112,17 +120,58 @@ def make_backend_post_request(req_path, data, callback, timeout=20):
     )
 
 
+class BackendRequestCoalescer(object):
+    """
+    Sends only one backend request for identical requests in flight: the response is given to all of them.
+    """
+    def __init__(self):
+        self.in_flight = {}
+        self.total_requests = 0
+        self.total_coalesced = 0
+
+    def post(self, key, req_path, data, callback, timeout=20):
+        """
+        :param key: identifies the identical requests
+        :param callback: called with (response, coalesced). coalesced is False for the request that was actually
+        sent, True for the ones that were attached to it.
+        """
+        callbacks = self.in_flight.get(key)
+        if callbacks is not None:
+            self.total_coalesced += 1
+            callbacks.append(callback)
+            return
+
+        self.total_requests += 1
+        self.in_flight[key] = [callback]
+        make_backend_post_request(req_path, data, lambda response: self.handle_response(key, response), timeout)
+
+    def handle_response(self, key, response):
+        callbacks = self.in_flight.pop(key)
+        for i, callback in enumerate(callbacks):
+            try:
+                callback(response, i > 0)
+            except Exception:
+                logger.exception('Exception while sending a backend response')
+
+
+backend_requests = BackendRequestCoalescer()
+
+
 class StatusHandler(tornado.web.RequestHandler):
     @tornado_json_endpoint
     def get(self):
         ret = {
+            'stats': stats,
+            'backend_requests_in_flight': len(backend_requests.in_flight),
+            'total_backend_requests': backend_requests.total_requests,
+            'total_coalesced_backend_requests': backend_requests.total_coalesced,
         }
         return ret
 
 
 class FileMetadataHandler(tornado.web.RequestHandler):
     @tornado_json_endpoint
-    def handle_response(self, response):
+    def handle_response(self, response, coalesced=False):
         if response.error:
             print "Error:", response.error
             if response.error.code != 599:
@@ -132,6 +181,11 @@ class FileMetadataHandler(tornado.web.RequestHandler):
         else:
             jd = json.loads(response.body)
 
+            if coalesced:
+                # The request that was actually sent already stored the response
+                jd['act'] = 'CACHE_MISS_COALESCED'
+                return jd
+
             # Format and store the response in the cache
             set_cached_file_metadata(jd)
 
@@ -154,13 +208,16 @@ class FileMetadataHandler(tornado.web.RequestHandler):
             # First, check if we have the data in cache
             v = get_cached_file_metadata(param_path)
             if v is not None:
+                stats['file_metadata.cache_hit'] += 1
                 v['act'] = 'CACHE_HIT'
                 self.write(json_response(v))
                 self.finish()
                 return
 
+        stats['file_metadata.cache_miss'] += 1
         post_data = {'path': param_path.encode('UTF-8')}
-        make_backend_post_request(
+        backend_requests.post(
+            ('/file_metadata.json', param_path, force_refresh),
             '/file_metadata.json',
             post_data,
             self.handle_response,
@@ -170,7 +227,7 @@ class FileMetadataHandler(tornado.web.RequestHandler):
 
 class ListDirHandler(tornado.web.RequestHandler):
     @tornado_json_endpoint
-    def handle_response(self, response):
+    def handle_response(self, response, coalesced=False):
         if response.error:
             print "Error:", response.error
             if response.error.code != 599:
@@ -180,6 +237,11 @@ class ListDirHandler(tornado.web.RequestHandler):
         else:
             jd = json.loads(response.body)
 
+            if coalesced:
+                # The request that was actually sent already stored the response
+                jd['act'] = 'CACHE_MISS_COALESCED'
+                return jd
+
             # Format and store all the data in the cache
             set_cached_list_dir(jd)
             jd['act'] = 'CACHE_MISS'
@@ -201,13 +263,16 @@ class ListDirHandler(tornado.web.RequestHandler):
             # First, check if we have the data in cache
             v = get_cached_list_dir(param_path)
             if v is not None:
+                stats['list_dir.cache_hit'] += 1
                 v['act'] = 'CACHE_HIT'
                 self.write(json_response(v))
                 self.finish()
                 return
 
+        stats['list_dir.cache_miss'] += 1
         post_data = {'dir': param_path.encode('UTF-8')}
-        make_backend_post_request(
+        backend_requests.post(
+            ('/list_dir.json', param_path, force_refresh),
             '/list_dir.json',
             post_data,
             self.handle_response,
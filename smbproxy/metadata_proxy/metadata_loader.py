@@ -13,12 +13,15 @@ import zlib
 
 import redis
 
+from seekscale_commons.twisted_redis import AsyncRedis
+
 
 METADATA_VALIDITY_DURATION = 60
 
 logger = logging.getLogger(__name__)
 
 redis_conn = None
+async_redis_conn = None
 
 
 def get_redis_conn():
@@ -30,6 +33,15 @@ def get_redis_conn():
     return redis_conn
 
 
+def get_async_redis_conn():
+    """The redis connection to use from a Twisted reactor"""
+    global async_redis_conn
+    if async_redis_conn is None:
+        async_redis_conn = AsyncRedis(get_redis_conn())
+
+    return async_redis_conn
+
+
 def compute_file_metadata_key(path):
     encoded_path = base64.b64encode(path.encode('UTF-8'))
     return "seekscale:metadata:file_metadata:%s" % encoded_path
@@ -95,6 +107,15 @@ def get_cached_list_dir(directory, max_age=METADATA_VALIDITY_DURATION):
     return None
 
 
+def get_cached_list_dir_async(directory, max_age=METADATA_VALIDITY_DURATION):
+    """
+    Same as get_cached_list_dir, without blocking the reactor: the queries and the decoding run in the redis thread
+    pool.
+    :return: a Deferred
+    """
+    return get_async_redis_conn().run(get_cached_list_dir, directory, max_age)
+
+
 def set_cached_list_dir(data):
     """
     Updates the cache for a /list_dir response.
@@ -141,6 +162,14 @@ def get_cached_file_metadata(path, max_age=METADATA_VALIDITY_DURATION):
     return None
 
 
+def get_cached_file_metadata_async(path, max_age=METADATA_VALIDITY_DURATION):
+    """
+    Same as get_cached_file_metadata, without blocking the reactor.
+    :return: a Deferred
+    """
+    return get_async_redis_conn().run(get_cached_file_metadata, path, max_age)
+
+
 def set_cached_file_metadata(data):
     path = data['path']
 
@@ -154,6 +183,81 @@ def set_cached_file_metadata(data):
     redis_conn.set(key, v_raw)
 
 
+def replace_listed_file(dir_data, name, data):
+    """
+    Replaces the entry of a file in a directory listing, or removes it if the file doesn't exist any more.
+    :param dir_data: a list_dir response, or the listing stored in the cache (without files_metadata)
+    :param name: the name of the file in the directory
+    :param data: the file_metadata.json data of the file
+    :return: (a copy of dir_data with the new entry, the name of the file in the listing). Paths are case insensitive:
+    the name can have a different case in the listing.
+    """
+    listed_name = name
+    for child in dir_data['files']:
+        if child.lower() == name.lower():
+            listed_name = child
+            break
+
+    dir_data = dict(dir_data)
+    files = list(dir_data['files'])
+    if data['exists'] and listed_name not in files:
+        files.append(listed_name)
+    elif not data['exists'] and listed_name in files:
+        files.remove(listed_name)
+    dir_data['files'] = files
+
+    if 'files_metadata' in dir_data:
+        files_metadata = dict(dir_data['files_metadata'])
+        files_metadata.pop(listed_name, None)
+        if data['exists']:
+            files_metadata[listed_name] = data
+        dir_data['files_metadata'] = files_metadata
+
+    return dir_data, listed_name
+
+
+def update_cached_file(directory, data):
+    """
+    Updates the cache after a file was changed or deleted: replaces its metadata, and its entry in the cached listing
+    of its parent directory if there's one. The listing keeps its update time.
+    :param directory: the parent directory of the file
+    :param data: the file_metadata.json data of the file
+    :return: None
+    """
+    path = data['path']
+    data = dict(data, _update_time=time.time())
+    v_raw = zlib.compress(json.dumps(data))
+
+    dir_key = compute_list_dir_key(directory)
+
+    def update(pipe):
+        dir_raw = pipe.get(dir_key)
+
+        pipe.multi()
+        pipe.set(compute_file_metadata_key(path), v_raw)
+
+        if dir_raw is not None:
+            dir_data, listed_name = replace_listed_file(
+                json.loads(zlib.decompress(dir_raw)), ntpath.basename(path), data)
+            pipe.set(dir_key, zlib.compress(json.dumps(dir_data)))
+
+            # get_cached_list_dir looks the children up by their name in the listing
+            listed_path = ntpath.join(directory, listed_name)
+            if listed_path != path:
+                pipe.set(compute_file_metadata_key(listed_path), v_raw)
+
+    # Don't overwrite a listing stored in the meantime by the metadata proxy
+    get_redis_conn().transaction(update, dir_key)
+
+
+def update_cached_file_async(directory, data):
+    """
+    Same as update_cached_file, without blocking the reactor.
+    :return: a Deferred
+    """
+    return get_async_redis_conn().run(update_cached_file, directory, data)
+
+
 def flush_metadata_cache():
     redis_conn = get_redis_conn()
     redis_conn.flushall()
@@ -1,4 +1,5 @@
 
+import collections
 import struct
 
 class NMBError(Exception): pass
@@ -11,7 +12,7 @@ class NotConnectedError(NMBError):
     pass
 
 
-class NMBSessionMessage:
+class NMBSessionMessage(object):
 
     HEADER_STRUCT_FORMAT = '>BBH'
     HEADER_STRUCT_SIZE = struct.calcsize(HEADER_STRUCT_FORMAT)
@@ -23,6 +24,22 @@ class NMBSessionMessage:
         self.type = 0
         self.flags = 0
         self.data = ''
+        # When decoded from a NMBReceiveBuffer, the raw chunks (header included) that make up the message
+        self.raw_chunks = None
+
+    def _get_data(self):
+        if self._data is None:
+            # Message decoded from a NMBReceiveBuffer. Only assemble the payload when somebody actually needs it.
+            if len(self.raw_chunks) == 1:
+                self._data = memoryview(self.raw_chunks[0])[self.HEADER_STRUCT_SIZE:]
+            else:
+                self._data = memoryview(''.join(self.raw_chunks))[self.HEADER_STRUCT_SIZE:]
+        return self._data
+
+    def _set_data(self, data):
+        self._data = data
+
+    data = property(_get_data, _set_data)
 
     def decode(self, data, offset):
         data_len = len(data)
@@ -44,6 +61,74 @@ class NMBSessionMessage:
         return self.HEADER_STRUCT_SIZE + length
 
 
+class NMBReceiveBuffer(object):
+    """
+    A FIFO of the raw chunks received on a TCP connection.
+
+    Chunks are kept as they were received: appending is O(1), and popping a frame returns the chunks that make it
+    up, so a frame can be written to another transport without ever re-concatenating the pending data.
+    Only the chunks at the frame boundaries are sliced.
+    """
+
+    def __init__(self):
+        self.chunks = collections.deque()
+        # Read offset in the first chunk
+        self.offset = 0
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def append(self, data):
+        if data:
+            self.chunks.append(data)
+            self.length += len(data)
+
+    def peek(self, size):
+        """Returns (as a string) the first size bytes of the buffer, or less if not enough data is available"""
+        pieces = []
+        offset = self.offset
+        remaining = size
+        for chunk in self.chunks:
+            if remaining <= 0:
+                break
+            piece = chunk[offset:offset+remaining]
+            pieces.append(piece)
+            remaining -= len(piece)
+            offset = 0
+
+        if len(pieces) == 1:
+            return pieces[0]
+        return ''.join(pieces)
+
+    def pop(self, size):
+        """Removes size bytes from the buffer. Returns them as a list of strings."""
+        if size > self.length:
+            raise NMBError('Cannot pop %d bytes from a %d bytes buffer' % (size, self.length))
+
+        pieces = []
+        remaining = size
+        while remaining > 0:
+            chunk = self.chunks[0]
+            available = len(chunk) - self.offset
+            if available <= remaining:
+                # The whole (remaining part of the) chunk belongs to the frame
+                if self.offset == 0:
+                    pieces.append(chunk)
+                else:
+                    pieces.append(chunk[self.offset:])
+                self.chunks.popleft()
+                self.offset = 0
+                remaining -= available
+            else:
+                pieces.append(chunk[self.offset:self.offset+remaining])
+                self.offset += remaining
+                remaining = 0
+
+        self.length -= size
+        return pieces
+
+
 class DirectTCPSessionMessage(NMBSessionMessage):
 
     HEADER_STRUCT_FORMAT = '>I'
@@ -67,3 +152,27 @@ class DirectTCPSessionMessage(NMBSessionMessage):
 
         self.data = data[offset+self.HEADER_STRUCT_SIZE:offset+self.HEADER_STRUCT_SIZE+length]
         return self.HEADER_STRUCT_SIZE + length
+
+    def decode_from_buffer(self, buf):
+        """
+        Decodes the next message of a NMBReceiveBuffer, and consumes it from the buffer.
+        The payload is exposed as a memoryview in self.data, the raw message in self.raw_chunks.
+        :param buf: a NMBReceiveBuffer
+        :return: the length of the decoded message, or 0 if the buffer doesn't hold a complete message yet
+        """
+        if len(buf) < self.HEADER_STRUCT_SIZE:
+            # Not enough data for decoding
+            return 0
+
+        length = struct.unpack(self.HEADER_STRUCT_FORMAT, buf.peek(self.HEADER_STRUCT_SIZE))[0]
+
+        if length >> 24 != 0:
+            raise NMBError("Invalid protocol header for Direct TCP session message")
+
+        if len(buf) < self.HEADER_STRUCT_SIZE + length:
+            return 0
+
+        self.reset()
+        self.raw_chunks = buf.pop(self.HEADER_STRUCT_SIZE + length)
+        self.data = None
+        return self.HEADER_STRUCT_SIZE + length
@@ -11,6 +11,7 @@ import traceback
 
 from fs_cache import FSCacheHTTPConnector
 import logger
+import ssl_agent
 
 
 REPR_DICT_SIZE_THRESHOLD = 50
@@ -47,14 +48,30 @@ def get_debug_stats_struct(server_factory, listen_address, listen_port):
     output['Global']['listen_port'] = listen_port
 
     output['Global']['shutdown_requested'] = server_factory.shutdown_requested
+    output['Global']['reactor_lag'] = server_factory.reactor_lag.get_stats()
 
     output['FSLocalCacheClient'] = dict()
     output['FSLocalCacheClient']['active_actions'] = repr_dict(fslocalcacheclient.active_actions)
-
-    output['MetadataCache'] = dict()
-    output['MetadataCache']['size'] = len(metadata_cache.keys())
+    output['FSLocalCacheClient']['imports_in_flight'] = len(fslocalcacheclient.imports.in_flight)
+    output['FSLocalCacheClient']['total_imports'] = fslocalcacheclient.imports.total_started
+    output['FSLocalCacheClient']['total_coalesced_imports'] = fslocalcacheclient.imports.total_coalesced
+    if fslocalcacheclient.write_behind is not None:
+        output['FSLocalCacheClient']['write_behind'] = fslocalcacheclient.write_behind.get_stats()
+    if fslocalcacheclient.lazy_hydration is not None:
+        output['FSLocalCacheClient']['lazy_hydration'] = fslocalcacheclient.lazy_hydration.get_stats()
+
+    output['MetadataCache'] = metadata_cache.get_stats()
+    output['MetadataCache']['lookups'] = copy.copy(fscache.lookup_stats)
+    output['MetadataCache']['requests_in_flight'] = len(fscache.metadata_requests.in_flight)
+    output['MetadataCache']['total_requests'] = fscache.metadata_requests.total_started
+    output['MetadataCache']['total_coalesced_requests'] = fscache.metadata_requests.total_coalesced
+
+    if fscache.cache_client is not None:
+        output['CacheClient3'] = fscache.cache_client.get_transfer_stats()
 
     output['HTTPConnector'] = copy.copy(FSCacheHTTPConnector.requests_stats)
+    output['HTTPConnector']['connections'] = copy.copy(ssl_agent.connection_stats)
+    output['HTTPConnector']['connections']['reuse_rate'] = ssl_agent.connection_reuse_rate()
 
     output['Client'] = []
     for client in server_factory.clients:
@@ -68,6 +85,17 @@ def get_debug_stats_struct(server_factory, listen_address, listen_port):
             'server_pending_packets_queue_len': client.server_pending_packets_queue_len,
             'total_processed_client_packets': client.total_processed_client_packets,
             'total_processed_server_packets': client.total_processed_server_packets,
+            'total_fast_path_client_packets': client.total_fast_path_client_packets,
+            'total_fast_path_server_packets': client.total_fast_path_server_packets,
+            'total_interim_responses': client.total_interim_responses,
+            'total_skipped_sync_backs': client.total_skipped_sync_backs,
+            'pending_async_requests': len(client.async_requests),
+            'client_queued_bytes': client.client_flow.queued_bytes,
+            'client_paused': client.client_flow.paused,
+            'client_total_pause_time': client.client_flow.total_pause_time,
+            'server_queued_bytes': client.server_flow.queued_bytes,
+            'server_paused': client.server_flow.paused,
+            'server_total_pause_time': client.server_flow.total_pause_time,
         }
         output['Client'].append(cl_data)
 
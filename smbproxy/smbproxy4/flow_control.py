@@ -0,0 +1,98 @@
+# coding: utf-8
+
+# Copyright Luna Technology 2016
+# Matthieu Riviere <mriviere@luna-technology.com>
+
+import time
+
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import implementer
+
+from statsd_logging import StatsdClient
+
+
+@implementer(IPushProducer)
+class FlowController(object):
+    """
+    Stops reading from a connection while too much of its data is waiting in the proxy.
+
+    The producer (a transport) is paused when more than high_water_mark bytes are queued, and resumed once the queue
+    went back under low_water_mark bytes.
+    The controller is also the push producer of the connection the data is written to: when that connection can't
+    keep up, it pauses us, and we pause the producer too.
+    """
+
+    def __init__(self, name, high_water_mark=None, low_water_mark=None):
+        """
+        :param name: the name under which the metrics are reported
+        :param high_water_mark: the number of queued bytes above which the producer is paused. None to disable.
+        :param low_water_mark: the number of queued bytes under which the producer is resumed
+        """
+        self.name = name
+        self.high_water_mark = high_water_mark
+        self.low_water_mark = low_water_mark
+
+        self.producer = None
+        self.queued_bytes = 0
+
+        self.over_high_water_mark = False
+        self.consumer_paused = False
+
+        self.paused = False
+        self.pause_start = None
+        self.pause_count = 0
+        self.total_pause_time = 0.0
+
+        self.stats_client = StatsdClient.get()
+
+    def set_producer(self, producer):
+        self.producer = producer
+        self._update()
+
+    def queued(self, size):
+        """Accounts for bytes entering the queue"""
+        self.queued_bytes += size
+        if self.high_water_mark is not None and self.queued_bytes > self.high_water_mark:
+            self.over_high_water_mark = True
+            self._update()
+
+    def dequeued(self, size):
+        """Accounts for bytes leaving the queue"""
+        self.queued_bytes -= size
+        if self.over_high_water_mark and self.queued_bytes <= self.low_water_mark:
+            self.over_high_water_mark = False
+            self._update()
+
+    #
+    # IPushProducer, for the consumer of the data
+    #
+    def pauseProducing(self):
+        self.consumer_paused = True
+        self._update()
+
+    def resumeProducing(self):
+        self.consumer_paused = False
+        self._update()
+
+    def stopProducing(self):
+        pass
+
+    def _update(self):
+        if self.producer is None:
+            return
+
+        should_pause = self.over_high_water_mark or self.consumer_paused
+
+        if should_pause and not self.paused:
+            self.paused = True
+            self.pause_start = time.time()
+            self.pause_count += 1
+            self.stats_client.incr('flow_control.%s.pause_count' % self.name)
+            self.producer.pauseProducing()
+
+        elif not should_pause and self.paused:
+            self.paused = False
+            pause_time = time.time() - self.pause_start
+            self.total_pause_time += pause_time
+            self.stats_client.timing('flow_control.%s.pause_time' % self.name, int(pause_time * 1000))
+            self.producer.resumeProducing()
@@ -4,28 +4,35 @@
 # Matthieu Riviere <mriviere@luna-technology.com>
 
 import base64
+import copy
+from cStringIO import StringIO
 from datetime import datetime
+import hashlib
 import json
 import ntpath
 import os
 import random
 import tempfile
+import time
 import traceback
 import uuid
 
 import redis
 import requests
 import requests.exceptions
-from twisted.internet import defer, reactor
+from twisted.internet import defer, reactor, threads
 from twisted.python import failure
 import treq
 
 from seekscale_commons.cache_client import filecache_client3
+from seekscale_commons.twisted_redis import AsyncRedis, RedisChannelWaiter
 
 import logger
 from statsd_logging import StatsdClient
+from lru_cache import ExpiringLRUCache
 from metadata_proxy import metadata_loader
-from ssl_agent import create_agent
+from singleflight import SingleFlight
+from ssl_agent import create_agent, create_pool
 
 
 def get_traceback():
@@ -39,6 +46,43 @@ def sleep(seconds):
     return d
 
 
+def read_ranges(path, ranges):
+    """
+    :param ranges: an IntervalSet
+    :return: the concatenated content of the ranges of a file
+    """
+    pieces = []
+    with open(path, 'rb') as fh:
+        for start, end in ranges:
+            fh.seek(start)
+            pieces.append(fh.read(end - start))
+    return ''.join(pieces)
+
+
+def wait_at_most(d, seconds):
+    """
+    :return: a Deferred that fires with the result of d (or fails with its failure), or with None if d hasn't fired
+    after the given time. d itself isn't cancelled, it can be waited again.
+    """
+    result = defer.Deferred()
+    timer = reactor.callLater(seconds, result.callback, None)
+
+    def fire(value):
+        if not timer.active():
+            # Timed out: the result is left on d for the next wait
+            return value
+        timer.cancel()
+        if isinstance(value, failure.Failure):
+            # Handled by the caller from now on
+            result.errback(value)
+            return None
+        result.callback(value)
+        return value
+    d.addBoth(fire)
+
+    return result
+
+
 class FSCacheFileMetadata(object):
     def __init__(self, share_name, path, metadata, log):
         self.share_name = share_name
@@ -145,11 +189,20 @@ class FSCacheFileMetadata(object):
 
 class FSCacheHTTPConnector(object):
     """
-    The module that handles all HTTP connections to backend and metadata servers
+    The module that handles all HTTP connections to backend and metadata servers.
+
+    One connector is shared by all the operations of a FSCache: it holds the connection pools and the redis client.
+    Each operation gets a copy bound to its logging context, through bind().
     """
 
     # We use a semaphore to limit the number of concurrent outbound connections.
-    sem = defer.DeferredSemaphore(15)
+    MAX_CONCURRENT_REQUESTS = 15
+
+    # The gateway publishes the final state of a background download job on <job id>:done. In case the notification
+    # is missed, the state of the job is also checked every BACKGROUND_JOB_CHECK_INTERVAL seconds.
+    BACKGROUND_JOB_DONE_CHANNELS = 'bkgrd_dl:job:*:done'
+    BACKGROUND_JOB_CHECK_INTERVAL = 30
+    sem = defer.DeferredSemaphore(MAX_CONCURRENT_REQUESTS)
 
     # Telemetry counters
     requests_stats = {
@@ -191,13 +244,26 @@ class FSCacheHTTPConnector(object):
         self.cache_client = cache_client
 
         self.redis_host = redis_host
-        self.redis = redis.StrictRedis(host=self.redis_host, port=6379, db=0)
+        redis_client = redis.StrictRedis(host=self.redis_host, port=6379, db=0)
+        self.redis = AsyncRedis(redis_client)
+        self.background_jobs_done = RedisChannelWaiter(redis_client, self.BACKGROUND_JOB_DONE_CHANNELS)
 
+        # Keep as many connections open as we can have concurrent requests, so they can all be reused
         self.agent = create_agent(
             settings.ssl_ca,
             settings.ssl_cert,
-            settings.ssl_key
+            settings.ssl_key,
+            max_persistent_per_host=self.MAX_CONCURRENT_REQUESTS
         )
+        self.pool = create_pool(max_persistent_per_host=self.MAX_CONCURRENT_REQUESTS)
+
+    def bind(self, log):
+        """
+        :return: a connector using the same connections, that logs in the given context
+        """
+        bound_connector = copy.copy(self)
+        bound_connector.log = log
+        return bound_connector
 
     @classmethod
     def _get_semaphore(cls):
@@ -319,7 +385,7 @@ class FSCacheHTTPConnector(object):
             if ssl:
                 response = yield treq.post(url, agent=self.agent, **kwargs)
             else:
-                response = yield treq.post(url, **kwargs)
+                response = yield treq.post(url, pool=self.pool, **kwargs)
 
             try:
                 content = yield treq.content(response)
@@ -381,7 +447,9 @@ class FSCacheHTTPConnector(object):
     def _http_treq_req_with_retry_base(self, endpoint, host, port, ssl=False, req_timeout=10, **kwargs):
         """Make a request to the fileserver4. Retries it on error, after an increasing waiting time.
         Returns a Deferred that fires the content of the HTTP response.
-        Or error, fire a RuntimeError."""
+        Or error, fire a RuntimeError.
+        The files argument can be a callable that returns the files to send: it's called for each attempt, as a
+        file object that was sent once can't be sent again."""
         log = self.log.bind(
             http_request_type="async",
             http_request_series_id=str(uuid.uuid4()),
@@ -400,6 +468,7 @@ class FSCacheHTTPConnector(object):
             return d
 
         kwargs.update(timeout=req_timeout)
+        files = kwargs.pop('files', None)
 
         last_status_code = None
 
@@ -408,6 +477,10 @@ class FSCacheHTTPConnector(object):
                 # The actual delay in randomize within 0.75-1.25 times the hardcoded, to avoid thundering herd issues
                 retry_delay = ((random.random()*0.5)+0.75) * retry_delays[attempt]
                 yield wait(retry_delay)
+                if callable(files):
+                    kwargs['files'] = files()
+                elif files is not None:
+                    kwargs['files'] = files
                 r = yield self._http_treq_req_base(endpoint, host, port, log=log, ssl=ssl, **kwargs)
                 defer.returnValue(r)
             except Exception, e:
@@ -512,6 +585,10 @@ class FSCacheHTTPConnector(object):
 
     @defer.inlineCallbacks
     def http_write_file_queue(self, full_path, local_path):
+        """
+        Writes a local file through CacheClient3: the gateway downloads it from the cache in the background.
+        :return: the size and mtime of the written file on the fileserver, in a dict ({'file_size': ..., 'mtime': ...})
+        """
         timeout = 1200
 
         cache = self.cache_client
@@ -533,40 +610,65 @@ class FSCacheHTTPConnector(object):
                     jid = 'bkgrd_dl:job:%s' % str(uuid.uuid4())
                     file_path = full_path
                     file_key = cache_file_result['key']
-                    self.redis.hmset(jid, {
-                        'path': file_path,
-                        'key': file_key,
-                    })
-
-                    self.redis.lpush('bkgrd_dl:pending', jid)
-
-                    final_status = False
-                    for _ in range(timeout):
-                        # Check if the job is marked as done
-                        v = self.redis.hget(jid, 'state')
-                        if v is None:
-                            pass
-                        elif v == 'SUCCESS':
-                            final_status = True
-                            break
-                        elif v == 'FAILURE':
-                            err = RuntimeError('File transfer failed for file %s' % local_path)
-                            raise err
-
-                        yield sleep(1.0)
-
-                if final_status is False:
-                    err = RuntimeError('File transfer timed out for file %s' % local_path)
-                    raise err
+
+                    # Wait for the notification before the job can be done
+                    done_channel = '%s:done' % jid
+                    done = self.background_jobs_done.wait(done_channel)
+                    try:
+                        yield self.redis.hmset(jid, {
+                            'path': file_path,
+                            'key': file_key,
+                        })
+
+                        yield self.redis.lpush('bkgrd_dl:pending', jid)
+
+                        v = yield self.wait_for_background_job(jid, done, timeout)
+                    finally:
+                        self.background_jobs_done.forget(done_channel)
+
+                    if v == 'FAILURE':
+                        err = RuntimeError('File transfer failed for file %s' % local_path)
+                        raise err
+                    elif v != 'SUCCESS':
+                        err = RuntimeError('File transfer timed out for file %s' % local_path)
+                        raise err
+
+                    file_size, mtime = yield self.redis.hmget(jid, 'file_size', 'mtime')
 
                 self.incr_counter('cache_client.write.success')
-                defer.returnValue(True)
+                defer.returnValue({
+                    'file_size': int(file_size) if file_size is not None else None,
+                    'mtime': float(mtime) if mtime is not None else None,
+                })
 
             except Exception, e:
                 self.incr_counter('cache_client.write.failure')
                 self.register_operation_failure(e)
                 raise
 
+    @defer.inlineCallbacks
+    def wait_for_background_job(self, jid, done, timeout):
+        """
+        Waits for the gateway to process a background download job.
+        :param done: a Deferred that fires with the state of the job when the gateway notifies it
+        :return: the final state of the job (SUCCESS or FAILURE), or None if it timed out
+        """
+        deadline = time.time() + timeout
+
+        while True:
+            # Catches the notifications we missed
+            state = yield self.redis.hget(jid, 'state')
+            if state is not None:
+                defer.returnValue(state)
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                defer.returnValue(None)
+
+            state = yield wait_at_most(done, min(self.BACKGROUND_JOB_CHECK_INTERVAL, remaining))
+            if state is not None:
+                defer.returnValue(state)
+
     @defer.inlineCallbacks
     def http_get_file_through_cacheclient3(self, full_path, size, mtime):
         cache = self.cache_client
@@ -574,7 +676,8 @@ class FSCacheHTTPConnector(object):
         unverified_key = cache.key_from_metadata(full_path, size, mtime)
 
         # If we don't have anything, make a call to fileserver to upload the file to the cache
-        if not cache.has_file(unverified_key):
+        has_file = yield cache.has_file_async(unverified_key)
+        if not has_file:
             try:
                 file_key = yield self.http_get_file_cacheclient3(full_path)
             except Exception, e:
@@ -607,14 +710,73 @@ class FSCacheHTTPConnector(object):
         Writes a local file directly through the fileserver.
         :param full_path: the backend path where the file will get written
         :param local_path: the local path to read
-        :return: True if the operation succeeded, pass the exception if it didn't
+        :return: the size and mtime of the written file on the fileserver, in a dict ({'file_size': ..., 'mtime': ...}).
+        Pass the exception if the operation failed.
         """
         data = {'path': full_path}
         files = {'file': open(local_path, 'rb')}
 
         try:
-            yield self._http_treq_req_with_retry('put', req_timeout=60, data=data, files=files)
-            defer.returnValue(True)
+            rep = yield self._http_treq_req_with_retry('put', req_timeout=60, data=data, files=files)
+            defer.returnValue(json.loads(rep))
+        except Exception, e:
+            self.register_operation_failure(e)
+            raise
+
+    @defer.inlineCallbacks
+    def http_write_file_ranges_async(self, full_path, local_path, ranges, size, base_size, base_mtime):
+        """
+        Writes some ranges of a local file into the version of the fileserver, and sets its size.
+        :param full_path: the backend path of the file
+        :param local_path: the local path to read
+        :param ranges: an IntervalSet of the ranges to write, within the file
+        :param size: the new size of the file
+        :param base_size: the size of the version of the file that was modified
+        :param base_mtime: the mtime of the version of the file that was modified. If the file on the fileserver
+        isn't this version any more, the request fails with a 409 status code.
+        :return: the size and mtime of the written file on the fileserver, like http_write_file_async
+        """
+        content = yield threads.deferToThread(read_ranges, local_path, ranges)
+        if len(content) != ranges.total_length():
+            raise RuntimeError('%s was truncated while being written back' % local_path)
+
+        data = {
+            'path': full_path,
+            'size': str(size),
+            'base_size': str(base_size),
+            'base_mtime': repr(base_mtime),
+            'ranges': json.dumps([[start, end - start] for start, end in ranges]),
+        }
+        # A new body for each attempt
+        files = lambda: {'data': ('ranges', StringIO(content))}
+
+        try:
+            rep = yield self._http_treq_req_with_retry('write_ranges.json', req_timeout=60, data=data, files=files)
+            defer.returnValue(json.loads(rep))
+        except Exception, e:
+            self.register_operation_failure(e)
+            raise
+
+    @defer.inlineCallbacks
+    def http_get_file_range_async(self, full_path, offset, length, size, mtime):
+        """
+        Reads a range of a file directly through the fileserver.
+        :param size: the size of the version of the file to read
+        :param mtime: the mtime of the version of the file to read. If the file on the fileserver isn't this version
+        any more, the request fails with a 409 status code.
+        :return: a Deferred that fires with the content of the range
+        """
+        data = {
+            'file': full_path,
+            'offset': str(offset),
+            'length': str(length),
+            'size': str(size),
+            'mtime': repr(mtime),
+        }
+
+        try:
+            rep = yield self._http_treq_req_with_retry('get_range', req_timeout=60, data=data)
+            defer.returnValue(rep)
         except Exception, e:
             self.register_operation_failure(e)
             raise
@@ -639,12 +801,13 @@ class FSCacheHTTPConnector(object):
         """
         Touches a file on the studio fileserver.
         :param full_path:
-        :return: True if the operation succeeded, pass the exception if it didn't
+        :return: whether the file was created, and its size and mtime on the fileserver, in a dict
+        ({'created': ..., 'file_size': ..., 'mtime': ...}). Pass the exception if the operation failed.
         """
         data = {'file': full_path}
         try:
-            yield self._http_treq_req_with_retry('touch_file.json', data=data)
-            defer.returnValue(True)
+            rep = yield self._http_treq_req_with_retry('touch_file.json', data=data)
+            defer.returnValue(json.loads(rep))
         except Exception, e:
             self.register_operation_failure(e)
             raise
@@ -664,7 +827,17 @@ class FSCache(object):
             redis_host='127.0.0.1'
     ):
         self.next_id = 0
-        self.metadata_cache = {}
+        self.metadata_cache = ExpiringLRUCache(settings.METADATA_CACHE_MAX_ENTRIES)
+
+        # Identical metadata requests in flight are only sent once to the metadata proxy
+        self.metadata_requests = SingleFlight('metadata_requests')
+        # Lookups that missed metadata_cache, by whether they were found in the redis DB
+        self.lookup_stats = {
+            'file_metadata.cache_hit': 0,
+            'file_metadata.cache_miss': 0,
+            'list_dir.cache_hit': 0,
+            'list_dir.cache_miss': 0,
+        }
 
         self.http_connector_host = host
         self.http_connector_port = port
@@ -676,6 +849,9 @@ class FSCache(object):
         self.TMPDIR = os.path.join(self.settings.SHARES_ROOT, '.seekscale_tmp')
 
         self.redis_host = redis_host
+        self.http_connector = None
+
+        self.stats_client = StatsdClient.get()
 
         self.cache_host = settings.cache_host
         self.ssl_cert = settings.ssl_cert
@@ -688,24 +864,39 @@ class FSCache(object):
                 ssl_cert=self.ssl_cert,
                 ssl_key=self.ssl_key,
                 ssl_ca=self.ssl_ca,
-                concurrency_level=15
+                concurrency_level=settings.CACHECLIENT3_CONCURRENCY,
+                window_size=settings.CACHECLIENT3_WINDOW_SIZE,
+                adaptive=settings.CACHECLIENT3_ADAPTIVE,
             )
         except Exception:
             log = logger.logger.new()
             log.msg('Cannot initialize cache_client. Working without it.', level=logger.WARN)
             self.cache_client = None
 
+        if self.cache_client is not None and self.cache_client.transfer_control is not None:
+            self.cache_client.transfer_control.add_listener(self.report_transfer_control)
+
+    def report_transfer_control(self, stats):
+        """Exports the number of requests in flight CacheClient3 picked"""
+        self.stats_client.gauge('cacheclient3.concurrency', stats['concurrency'])
+        if stats['goodput'] is not None:
+            self.stats_client.gauge('cacheclient3.goodput', int(stats['goodput']))
+        if stats['min_rtt'] is not None:
+            self.stats_client.gauge('cacheclient3.min_rtt_ms', int(stats['min_rtt'] * 1000))
+
     def get_http_connector(self, log):
-        return FSCacheHTTPConnector(
-            self.http_connector_host,
-            self.http_connector_port,
-            self.metadata_proxy_host,
-            self.metadata_proxy_port,
-            log,
-            self.settings,
-            self.TMPDIR,
-            self.cache_client,
-            redis_host=self.redis_host)
+        if self.http_connector is None:
+            self.http_connector = FSCacheHTTPConnector(
+                self.http_connector_host,
+                self.http_connector_port,
+                self.metadata_proxy_host,
+                self.metadata_proxy_port,
+                logger.logger.new(),
+                self.settings,
+                self.TMPDIR,
+                self.cache_client,
+                redis_host=self.redis_host)
+        return self.http_connector.bind(log)
 
     @staticmethod
     def full_path_from_sharename(share_name, path):
@@ -727,18 +918,9 @@ class FSCache(object):
     #
     # The convenience functions that provide caching of everything
     #
-    def metadata_valid(self, share_name, path):
-        if (share_name, path,) not in self.metadata_cache:
-            return False
-        else:
-            metadata_validity_duration = self.get_metadata_max_age_for_path(share_name, path)
-
-            if (datetime.utcnow() - self.metadata_cache[(share_name, path,)]['_last_check_date']).total_seconds() > \
-                    metadata_validity_duration:
-                return False
-            else:
-                return True
-
+    # The metadata is cached at two levels: in the process (metadata_cache, see ExpiringLRUCache), and in the local
+    # redis DB (see metadata_loader), which is filled by the metadata proxy.
+    #
     def get_metadata_max_age_for_path(self, share_name, path):
         metadata_validity_duration = self.settings.MTIME_METADATA_REFRESH_THRESHOLD
 
@@ -751,27 +933,72 @@ class FSCache(object):
 
         return metadata_validity_duration
 
-    def set_metadata(self, share_name, path, data):
-        self.metadata_cache[(share_name, path,)] = data
-        self.metadata_cache[(share_name, path,)]['_last_check_date'] = datetime.utcnow()
+    @staticmethod
+    def metadata_expiry_time(data, max_age):
+        # The data expires max_age seconds after it was fetched from the gateway, like in the redis DB
+        return data.get('_update_time', time.time()) + max_age
+
+    def invalidate_metadata(self, share_name, path):
+        """
+        Drops the cached metadata of a file, and the listing of its parent directory
+        """
+        full_path = self.full_path_from_sharename(share_name, path)
+        self.metadata_cache.invalidate(('file_metadata', full_path))
+
+        parent_path = ntpath.dirname(ntpath.normpath(path))
+        if parent_path != path:
+            parent_full_path = self.full_path_from_sharename(share_name, parent_path)
+            self.metadata_cache.invalidate(('list_dir', parent_full_path))
 
     @defer.inlineCallbacks
-    def get_metadata_async_old(self, share_name, path, log, force_update=False):
+    def update_cached_metadata(self, share_name, path, metadata, log):
         """
-        Retrieves metadata for a given path
-        :param share_name: The requested share
-        :param path: The requested path
-        :param log: A log context
-        :param force_update: Whether to force refreshing the metadata from the remote fileserver
-        :return: The API reponse object from the fileserver
+        Replaces the cached metadata of a file we just changed (or deleted) on the fileserver, instead of fetching it
+        again: in metadata_cache, in the redis DB, and in the cached listings of its parent directory.
+        :param metadata: the new metadata of the file, in the format of file_metadata.json
+        :return: a Deferred that fires once the redis DB is updated
         """
-        http_connector = self.get_http_connector(log)
-        if force_update or not self.metadata_valid(share_name, path):
-            full_path = self.full_path_from_sharename(share_name, path)
-            rep = yield http_connector.http_get_metadata_async(full_path)
-            self.set_metadata(share_name, path, rep)
+        full_path = self.full_path_from_sharename(share_name, path)
+        max_age = self.get_metadata_max_age_for_path(share_name, path)
 
-        defer.returnValue(self.metadata_cache[(share_name, path,)])
+        metadata['path'] = full_path
+        metadata['_update_time'] = time.time()
+        self.metadata_cache.set(('file_metadata', full_path), metadata, self.metadata_expiry_time(metadata, max_age))
+
+        npath = ntpath.normpath(path)
+        parent_path = ntpath.dirname(npath)
+        parent_full_path = self.full_path_from_sharename(share_name, parent_path)
+
+        def replace_listed_file(dir_listing):
+            if dir_listing is None or 'files' not in dir_listing:
+                return dir_listing
+            dir_listing, _ = metadata_loader.replace_listed_file(dir_listing, ntpath.basename(npath), metadata)
+            return dir_listing
+        self.metadata_cache.update(('list_dir', parent_full_path), replace_listed_file)
+
+        try:
+            yield metadata_loader.update_cached_file_async(parent_full_path, metadata)
+        except Exception:
+            # The redis DB still has the old metadata: it's only valid until it expires
+            log.msg('Warning: could not update the cached metadata of %s: %s' % (
+                full_path, get_traceback()), level=logger.WARN)
+
+    @defer.inlineCallbacks
+    def update_written_file_metadata(self, share_name, path, metadata, file_size, mtime, log):
+        """
+        Updates the cached metadata of a file we just wrote with its new size and mtime on the fileserver.
+        :param metadata: the cached metadata of the file before it was written, in the format of file_metadata.json
+        """
+        if mtime is None or metadata is None or not metadata.get('exists') or \
+                not metadata['metadata'].get('isfile'):
+            # An older gateway, or a new file: we don't have all of its metadata. Fetch it next time.
+            self.invalidate_metadata(share_name, path)
+            return
+
+        metadata = copy.deepcopy(metadata)
+        metadata['metadata']['st_size'] = file_size
+        metadata['metadata']['st_mtime'] = mtime
+        yield self.update_cached_metadata(share_name, path, metadata, log)
 
     @defer.inlineCallbacks
     def get_metadata_async(self, share_name, path, log, force_update=False):
@@ -785,61 +1012,70 @@ class FSCache(object):
         """
 
         full_path = self.full_path_from_sharename(share_name, path)
+        cache_key = ('file_metadata', full_path)
+
+        if not force_update:
+            v = self.metadata_cache.get(cache_key)
+            if v is not None:
+                defer.returnValue(v)
+
         max_age = self.get_metadata_max_age_for_path(share_name, path)
 
         if not force_update:
             # Check if we have the metadata in the local redis DB and if it is still valid
-            v = metadata_loader.get_cached_file_metadata(full_path, max_age=max_age)
+            v = yield metadata_loader.get_cached_file_metadata_async(full_path, max_age=max_age)
             if v is not None:
+                self.lookup_stats['file_metadata.cache_hit'] += 1
+                self.metadata_cache.set(cache_key, v, self.metadata_expiry_time(v, max_age))
                 defer.returnValue(v)
 
         # If invalid, escalate to the central entrypoint, which will proxy the request towards the gateway
+        self.lookup_stats['file_metadata.cache_miss'] += 1
         http_connector = self.get_http_connector(log)
-        rep = yield http_connector.http_get_metadata_async(full_path, force_refresh=force_update)
+        rep = yield self.metadata_requests.run(
+            ('file_metadata.json', full_path, force_update),
+            http_connector.http_get_metadata_async, full_path, force_refresh=force_update
+        )
+        self.metadata_cache.set(cache_key, rep, self.metadata_expiry_time(rep, max_age))
         defer.returnValue(rep)
 
-    @defer.inlineCallbacks
-    def get_dir_listing_async_old(self, share_name, path, log, force_update=False):
-        http_connector = self.get_http_connector(log)
-        metadata = yield self.get_metadata_async(share_name, path, log)
-
-        if force_update or ('files' not in metadata):
-            full_path = self.full_path_from_sharename(share_name, path)
-
-            dir_listing = yield http_connector.http_get_dirlist_async(full_path)
-
-            if dir_listing is not None and 'files' in dir_listing:
-                metadata['files'] = dir_listing['files']
-            else:
-                log.msg('Warning: No list of children files returned for get_dir_listing_async(%s, %s)' % (
-                    share_name, path.encode('UTF-8')), level=logger.INFO)
-                defer.returnValue([])
-
-            # dir_listing also has the metadata for children files. Cache those too.
-            if 'files_metadata' in dir_listing:
-                for p in dir_listing['files_metadata']:
-                    child_path = ntpath.join(path, p)
-                    self.set_metadata(share_name, child_path, dir_listing['files_metadata'][p])
-
-        defer.returnValue(metadata['files'])
-
     @defer.inlineCallbacks
     def get_dir_listing_async(self, share_name, path, log, force_update=False):
-        http_connector = self.get_http_connector(log)
-        max_age = self.get_metadata_max_age_for_path(share_name, path)
         full_path = self.full_path_from_sharename(share_name, path)
+        cache_key = ('list_dir', full_path)
 
         dir_listing = None
 
         if not force_update:
-            # Check if we have some valid data in the local redis DB
-            v = metadata_loader.get_cached_list_dir(full_path, max_age=max_age)
-            if v is not None:
-                dir_listing = v
+            dir_listing = self.metadata_cache.get(cache_key)
 
         if dir_listing is None:
-            # Make a query on the metadata proxy
-            dir_listing = yield http_connector.http_get_dirlist_async(full_path, force_refresh=force_update)
+            max_age = self.get_metadata_max_age_for_path(share_name, path)
+
+            if not force_update:
+                # Check if we have some valid data in the local redis DB
+                dir_listing = yield metadata_loader.get_cached_list_dir_async(full_path, max_age=max_age)
+                if dir_listing is not None:
+                    self.lookup_stats['list_dir.cache_hit'] += 1
+
+            if dir_listing is None:
+                # Make a query on the metadata proxy
+                self.lookup_stats['list_dir.cache_miss'] += 1
+                http_connector = self.get_http_connector(log)
+                dir_listing = yield self.metadata_requests.run(
+                    ('list_dir.json', full_path, force_update),
+                    http_connector.http_get_dirlist_async, full_path, force_refresh=force_update
+                )
+
+            if dir_listing is not None and 'files' in dir_listing:
+                expiry_time = self.metadata_expiry_time(dir_listing, max_age)
+                self.metadata_cache.set(cache_key, dir_listing, expiry_time)
+
+                # The listing also has the metadata of the children files. Cache those too.
+                for child, child_metadata in dir_listing['files_metadata'].iteritems():
+                    if child_metadata is not None:
+                        child_full_path = self.full_path_from_sharename(share_name, ntpath.join(path, child))
+                        self.metadata_cache.set(('file_metadata', child_full_path), child_metadata, expiry_time)
 
         if dir_listing is not None and 'files' in dir_listing:
             defer.returnValue((dir_listing['files'], dir_listing['files_metadata']))
@@ -873,42 +1109,136 @@ class FSCache(object):
         defer.returnValue(r)
 
     @defer.inlineCallbacks
-    def set_file(self, file_metadata, local_path, log):
+    def get_file_chunks(self, file_metadata, chunk_size, log):
+        """
+        Splits a file in chunks that can be fetched separately (see get_file_range): the parts of the file in
+        CacheClient3 if it's there, chunks of chunk_size bytes otherwise.
+        :return: a Deferred that fires with the list of (start, end, shasum of the part or None)
+        """
+        size = file_metadata.size()
+
+        manifest = None
+        if self.cache_client is not None:
+            full_path = self.full_path_from_sharename(file_metadata.share_name, file_metadata.path)
+            key = self.cache_client.key_from_metadata(full_path, size, file_metadata.mtime())
+            try:
+                manifest = yield self.cache_client.get_file_manifest_async(key)
+            except Exception:
+                log.msg('Warning: could not get the manifest of %s: %s' % (full_path, get_traceback()),
+                        level=logger.WARN)
+
+        if manifest:
+            chunks = [
+                (part['offset'], part['offset'] + part['length'], part['shasum'])
+                for part in sorted(manifest, key=lambda part: part['uid'])
+            ]
+            # The parts must cover the file exactly
+            if all(chunks[i][1] == chunks[i + 1][0] for i in xrange(len(chunks) - 1)) and \
+                    chunks[0][0] == 0 and chunks[-1][1] == size:
+                defer.returnValue(chunks)
+
+        defer.returnValue([(start, min(start + chunk_size, size), None) for start in xrange(0, size, chunk_size)])
+
+    @defer.inlineCallbacks
+    def get_file_range(self, share_name, path, size, mtime, start, end, shasum, log):
+        """
+        Retrieves a chunk of a file (see get_file_chunks): from CacheClient3 if it's there, or from the fileserver.
+        :param size: the size of the version of the file
+        :param mtime: the mtime of the version of the file
+        :return: a Deferred that fires with the content of [start, end)
+        """
+        if shasum is not None and self.cache_client is not None:
+            try:
+                data = yield self.cache_client.get_part(shasum, length=end - start)
+                # It goes straight into the user's file
+                data_shasum = yield threads.deferToThread(lambda: hashlib.sha256(data).hexdigest())
+                if data_shasum != shasum:
+                    raise RuntimeError('Part %s has a checksum of %s' % (shasum, data_shasum))
+                defer.returnValue(data)
+            except Exception:
+                log.msg('Warning: could not get part %s from CacheClient3, reading it from the fileserver: %s' % (
+                    shasum, get_traceback()), level=logger.WARN)
+                self.stats_client.incr('lazy_hydration.cache_client_part_failed')
+
+        http_connector = self.get_http_connector(log)
+        full_path = self.full_path_from_sharename(share_name, path)
+        data = yield http_connector.http_get_file_range_async(full_path, start, end - start, size, mtime)
+        defer.returnValue(data)
+
+    def partial_write_back_ranges(self, file_metadata, size, dirty_ranges, base_version):
+        """
+        :return: the ranges to write back instead of the whole file (an IntervalSet), or None if the whole file must
+        be written back
+        """
+        # Without the version the ranges were written over, they can't be checked to apply to the one of the fileserver
+        if dirty_ranges is None or base_version is None or not file_metadata.exists() or not file_metadata.is_file():
+            return None
+
+        ranges = dirty_ranges.clip(size)
+        dirty_bytes = ranges.total_length()
+        if dirty_bytes > size * self.settings.PARTIAL_WRITE_BACK_MAX_DIRTY_FRACTION or \
+                dirty_bytes > self.settings.PARTIAL_WRITE_BACK_MAX_BYTES:
+            return None
+
+        return ranges
+
+    @defer.inlineCallbacks
+    def set_file(self, file_metadata, local_path, log, dirty_ranges=None, base_version=None):
         """
         Copies local_path to the path represented in file_metadata
         :param file_metadata:
         :param local_path: The local path of the file
         :param log: A log context
+        :param dirty_ranges: an IntervalSet of the only ranges that were modified since the file was imported, or None
+        :param base_version: the (size, mtime) of the version of the file that was imported, and modified. The
+        ranges are only written back if it's still the one of the fileserver.
         :return:
         """
         http_connector = self.get_http_connector(log)
         full_path = self.full_path_from_sharename(file_metadata.share_name, file_metadata.path)
+        local_stat = os.stat(local_path)
+        size = local_stat.st_size
 
-        if os.path.getsize(local_path) > self.settings.CACHECLIENT3_SIZE_THRESHOLD and self.cache_client is not None:
-            r = yield http_connector.http_write_file_queue(full_path, local_path)
-        else:
-            r = yield http_connector.http_write_file_async(full_path, local_path)
+        r = None
+        ranges = self.partial_write_back_ranges(file_metadata, size, dirty_ranges, base_version)
+        if ranges is not None:
+            base_size, base_mtime = base_version
+            try:
+                r = yield http_connector.http_write_file_ranges_async(
+                    full_path, local_path, ranges, size, base_size, base_mtime
+                )
+                self.stats_client.incr('write_back.partial')
+                self.stats_client.incr('write_back.partial_bytes_saved', size - ranges.total_length())
+            except Exception:
+                # Eg. the file changed on the fileserver: our ranges don't apply to it any more
+                log.msg('Partial write-back of %s failed, writing back the whole file: %s' % (
+                    full_path, get_traceback()), level=logger.WARN)
+                self.stats_client.incr('write_back.partial_failed')
+                r = None
+
+        if r is None:
+            self.stats_client.incr('write_back.full')
+            if size > self.settings.CACHECLIENT3_SIZE_THRESHOLD and self.cache_client is not None:
+                r = yield http_connector.http_write_file_queue(full_path, local_path)
+            else:
+                r = yield http_connector.http_write_file_async(full_path, local_path)
 
-        defer.returnValue(r)
+        written_size, written_mtime = r.get('file_size'), r.get('mtime')
+        yield self.update_written_file_metadata(
+            file_metadata.share_name, file_metadata.path, file_metadata.metadata, written_size, written_mtime, log
+        )
 
-        # FIXME: A sync immediately after the write will cause the file to be reimported. Adapt the old workaround:
-        # #
-        # # Manually update our local metadata cache
-        # #
-        #
-        # # We get the written metadata. We assume that the distant file doesn't change between the moment we write
-        # # the file and the moment we read it back.
-        # metadata = self.get_metadata(share_name, path, force_update=True)
-        # try:
-        #     size = metadata['metadata']['st_size']
-        #     mtime = metadata['metadata']['st_mtime']
-        # except KeyError:
-        #     info_print("\tget_metadata() returned nothing for file \"%s:%s\" which we just created. "
-        #                "Either the write failed, or the file was deleted in the meantime." % (share_name, path))
-        # else:
-        #     r = redis.StrictRedis(host=self.REDIS_HOST, port=6379, db=0)
-        #     key = self.key_from_file(full_path, size, mtime)
-        #     r.set(key, checksum)
+        # Otherwise, the next sync sees that the version of the fileserver is more recent, and imports the file we just
+        # wrote back. Unless it was written again in the meantime.
+        if written_mtime is not None and written_size == size:
+            try:
+                st = os.stat(local_path)
+                if (st.st_size, st.st_mtime) == (local_stat.st_size, local_stat.st_mtime):
+                    os.utime(local_path, (written_mtime, written_mtime))
+            except OSError:
+                log.msg("Warning: couldn't set the mtime of %s: %s" % (local_path, get_traceback()), level=logger.WARN)
+
+        defer.returnValue(r)
 
     @defer.inlineCallbacks
     def delete_file(self, share_name, path, log):
@@ -926,12 +1256,9 @@ class FSCache(object):
         success = yield http_connector.http_delete_file_async(full_path)
 
         if success:
-            #
-            # Manually update our local metadata cache
-            #
-            npath = ntpath.normpath(path)
-            parent_path = ntpath.dirname(npath)
-            _, _ = yield self.get_dir_listing_async(share_name, parent_path, log, force_update=True)
+            yield self.update_cached_metadata(share_name, path, {'exists': False, 'metadata': {}}, log)
+        else:
+            self.invalidate_metadata(share_name, path)
 
         defer.returnValue(success)
 
@@ -948,9 +1275,16 @@ class FSCache(object):
         http_connector = self.get_http_connector(log)
         full_path = self.full_path_from_sharename(share_name, path)
 
-        success = yield http_connector.http_touch_file_async(full_path)
+        r = yield http_connector.http_touch_file_async(full_path)
 
-        defer.returnValue(success)
+        if r.get('created', True):
+            # We don't have the metadata of the new file
+            self.invalidate_metadata(share_name, path)
+        else:
+            metadata = yield self.get_metadata_async(share_name, path, log)
+            yield self.update_written_file_metadata(share_name, path, metadata, r.get('file_size'), r.get('mtime'), log)
+
+        defer.returnValue(True)
 
     @defer.inlineCallbacks
     def metadata_object(self, share_name, path, log, include_children=True):
@@ -993,7 +1327,7 @@ class FSCache(object):
         defer.returnValue(processed_metadata)
 
     def flush_metadata_cache(self):
-        self.metadata_cache = {}
+        self.metadata_cache.clear()
 
     # Deprecated, but kept for the idea. This is optimization hasn't been reimplemented, I'm not sure if it is still
     # relevant
@@ -8,15 +8,25 @@ import ntpath
 import os
 import pwd
 import shutil
+import tempfile
 import traceback
 import uuid
 
 import redis
 from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import task
+from twisted.internet import threads
+from twisted.python import failure
+
+from seekscale_commons.twisted_redis import AsyncRedis
 
 import logger
 import audit_logger
+from lazy_hydration import LazyFile, LazyHydration
+from singleflight import SingleFlight
 from statsd_logging import StatsdClient
+from write_behind import WriteBehindJournal, WriteBehindQueue
 
 
 class RedisAccessTimeCache(object):
@@ -25,13 +35,79 @@ class RedisAccessTimeCache(object):
     """
     def __init__(self, redis_host='127.0.0.1'):
         self.redis_host = redis_host
-        self.redis = redis.StrictRedis(host=self.redis_host, port=6379, db=0)
+        self.redis = AsyncRedis(redis.StrictRedis(host=self.redis_host, port=6379, db=0))
 
     def write_last_access_time(self, share_name, path):
+        """
+        :return: a Deferred that fires once the access time is written
+        """
         access_time = datetime.utcnow()
         access_time_string = access_time.isoformat()
         key = 'smbproxy:last_access_time:%s:%s' % (share_name.encode('UTF-8'), path.encode('UTF-8'))
-        self.redis.set(key, access_time_string)
+        return self.redis.set(key, access_time_string)
+
+
+class RedisSyncLocks(object):
+    """
+    Locks on the files being imported, shared by all the smbproxy processes of the host (see WORKERS), so that a
+    file is only downloaded by one of them.
+
+    A lock expires after LOCK_TTL seconds if it isn't refreshed, so that the crash of a worker doesn't block the file.
+    """
+    LOCK_TTL = 60
+    POLL_INTERVAL = 0.2
+
+    # Only delete/refresh the lock if we still hold it
+    RELEASE_SCRIPT = """
+        if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end
+        return 0
+    """
+    REFRESH_SCRIPT = """
+        if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('expire', KEYS[1], ARGV[2]) end
+        return 0
+    """
+
+    def __init__(self, redis_host='127.0.0.1'):
+        self.redis_host = redis_host
+        self.redis = AsyncRedis(redis.StrictRedis(host=self.redis_host, port=6379, db=0))
+        self.release_script = self.redis.register_script(self.RELEASE_SCRIPT)
+        self.refresh_script = self.redis.register_script(self.REFRESH_SCRIPT)
+
+    @staticmethod
+    def key(share_name, path):
+        # Paths are case insensitive
+        return 'smbproxy:sync_lock:%s:%s' % (share_name.lower().encode('UTF-8'), path.lower().encode('UTF-8'))
+
+    @defer.inlineCallbacks
+    def acquire(self, share_name, path):
+        """
+        Waits until we hold the lock on a file.
+        :return: a Deferred that fires with (the token of the lock, whether we had to wait for it)
+        """
+        key = self.key(share_name, path)
+        token = uuid.uuid4().hex
+        waited = False
+
+        while True:
+            acquired = yield self.redis.set(key, token, nx=True, ex=self.LOCK_TTL)
+            if acquired:
+                break
+            waited = True
+            yield task.deferLater(reactor, self.POLL_INTERVAL, lambda: None)
+
+        defer.returnValue((token, waited))
+
+    def refresh(self, share_name, path, token):
+        d = self.refresh_script(keys=[self.key(share_name, path)], args=[token, self.LOCK_TTL])
+        # A failed refresh is retried by the next one: don't stop the LoopingCall
+        d.addErrback(lambda _: None)
+        return d
+
+    def release(self, share_name, path, token):
+        """
+        :return: a Deferred that fires once the lock is released
+        """
+        return self.release_script(keys=[self.key(share_name, path)], args=[token])
 
 
 class ActionLogger(object):
@@ -89,7 +165,7 @@ class ActionLogger(object):
         self.stats_client.incr('action.%s.succeeded' % action['action_type'])
         self.stats_client.timing('action.%s.duration' % action['action_type'], int(ms))
 
-        if (action['action_type'] != 'SYNC' and action['action_type'] != 'LISTDIR')\
+        if action['action_type'] not in ('SYNC', 'SYNC_METADATA', 'LISTDIR')\
                 or (action['action_type'] == 'SYNC' and ctxt is not None and ctxt['is_file']):
             try:
                 yield self.audit_logger.log(log, start_timestamp, ms, "SUCCESS")
@@ -309,6 +385,26 @@ class FS(object):
                 ), level=logger.WARN)
                 self.stats_client.incr('action.SYNC.errors.could_not_fake_file')
 
+    def make_available(self, file_metadata, log):
+        """
+        Make a file usable by samba without importing its content: fake it if needed, and give it to the samba user
+        (as an imported file would be). The fake file keeps an old mtime, so it gets imported on the next data open.
+        :param file_metadata:
+        :param log:
+        :return:
+        """
+        self.fake_file(file_metadata, log)
+
+        try:
+            local_path = self.network_path_to_local_path(file_metadata)
+            os.chown(local_path, self.required_uid, -1)
+            os.chmod(local_path, 0777)
+        except Exception:
+            log.msg('Error: Could not make file \"%s\" on %s available: %s' % (
+                '\\' + file_metadata.path, file_metadata.share_name, traceback.format_exc()
+            ), level=logger.WARN)
+            self.stats_client.incr('action.SYNC.errors.could_not_make_file_available')
+
 class FSLocalCacheClient(object):
     """The FSLocalCacheClient caches data on a local samba server. Is it shared between all the clients."""
 
@@ -322,6 +418,38 @@ class FSLocalCacheClient(object):
         self.fs = FS(settings)
         self.redis_at_cache = RedisAccessTimeCache(redis_host=redis_host)
 
+        # With several workers, they must not import the same file at the same time
+        if self.settings.WORKERS > 1:
+            self.sync_locks = RedisSyncLocks(redis_host=redis_host)
+        else:
+            self.sync_locks = None
+
+        # The imports in progress: a file requested again while it's being imported isn't downloaded twice
+        self.imports = SingleFlight('imports')
+
+        # The written files are written back in the background, after their CLOSE has been answered
+        if self.settings.ENABLE_WRITE_BEHIND:
+            self.write_behind = WriteBehindQueue(
+                WriteBehindJournal(self.settings.WRITE_BEHIND_JOURNAL_DIR),
+                self.write_back,
+                max_concurrent=self.settings.WRITE_BEHIND_MAX_CONCURRENT,
+                retry_delay=self.settings.WRITE_BEHIND_RETRY_DELAY,
+            )
+        else:
+            self.write_behind = None
+
+        # The big files opened read-only are imported lazily: their content is fetched as it's read
+        if self.settings.ENABLE_LAZY_HYDRATION:
+            self.lazy_hydration = LazyHydration(
+                self.fetch_chunk,
+                self.store_chunk,
+                self.finish_hydration,
+                read_ahead=self.settings.LAZY_HYDRATION_READ_AHEAD,
+                max_concurrent=self.settings.LAZY_HYDRATION_MAX_CONCURRENT,
+            )
+        else:
+            self.lazy_hydration = None
+
         self.stats_client = StatsdClient.get()
         self.action_logger = ActionLogger(settings)
 
@@ -329,25 +457,40 @@ class FSLocalCacheClient(object):
     def active_actions(self):
         return self.action_logger.active_actions
 
+    def start(self):
+        """Resumes the write-backs interrupted by the last shutdown"""
+        if self.write_behind is not None:
+            self.write_behind.start()
+
     @defer.inlineCallbacks
-    def action(self, share_name, path, conn_logger, action_type, perform):
+    def action(self, share_name, path, conn_logger, action_type, perform, raise_errors=False):
+        """
+        :param raise_errors: whether the returned Deferred fails if the action fails. By default, the error is only logged.
+        """
         log, start_timestamp = self.action_logger.init_action(conn_logger, action_type, share_name, path)
 
         try:
             yield perform(share_name, path, conn_logger, log)
         except Exception:
+            err = failure.Failure()
             log.msg('Action %s failed: %s' % (action_type, traceback.format_exc()), level=logger.ERROR)
             self.action_logger.action_failed(log, start_timestamp)
+            if raise_errors:
+                err.raiseException()
         else:
             self.action_logger.finish_action(log, start_timestamp)
 
     @defer.inlineCallbacks
-    def perform_sync(self, share_name, path, conn_logger, log):
-        self.redis_at_cache.write_last_access_time(share_name, path)
+    def perform_sync(self, share_name, path, conn_logger, log, fetch_content=True, lazy=False):
+        # The sync doesn't need to wait for it
+        d = self.redis_at_cache.write_last_access_time(share_name, path)
+        d.addErrback(lambda failure: log.msg(
+            'Could not write the last access time: %s' % failure.getErrorMessage(), level=logger.WARN))
 
         ctxt = {
             'is_file': False,
             'needs_import': False,
+            'lazy': lazy,
         }
 
         file_metadata = yield self.fscache.metadata_object(share_name, path, log, include_children=False)
@@ -364,7 +507,21 @@ class FSLocalCacheClient(object):
                 ctxt['is_file'] = True
                 # Create the containing directory
                 self.create_dir_hierarchy(file_metadata.parent_metadata(), log)
-                yield self.send_file(file_metadata, log, ctxt)
+                if self.write_behind is not None and self.write_behind.is_pending(share_name, path):
+                    # The local version is more recent than the one of the control server
+                    self.stats_client.incr('action.SYNC.info.write_behind_pending')
+                elif fetch_content:
+                    yield self.send_file(file_metadata, log, ctxt)
+                    if not lazy and self.lazy_hydration is not None:
+                        # All of the content must be there before the file can be written
+                        yield self.lazy_hydration.wait_complete(share_name, path)
+                else:
+                    # The file must exist (eg. for a FILE_CREATE to fail), but its content won't be read
+                    self.stats_client.incr('action.SYNC.info.content_fetch_skipped')
+                    if self.lazy_hydration is not None:
+                        # Its content is about to be replaced
+                        yield self.lazy_hydration.discard(share_name, path)
+                    self.fs.make_available(file_metadata, log)
 
             # Is it a directory, then just create it
             elif file_metadata.is_dir():
@@ -372,15 +529,28 @@ class FSLocalCacheClient(object):
                 self.create_dir_hierarchy(file_metadata.parent_metadata(), log)
                 self.fs.create_directory(file_metadata, log)
 
-    def sync(self, share_name, path, conn_logger):
+    def perform_sync_metadata(self, share_name, path, conn_logger, log):
+        return self.perform_sync(share_name, path, conn_logger, log, fetch_content=False)
+
+    def sync(self, share_name, path, conn_logger, fetch_content=True, lazy=False):
         """
         Sync a file
         :param share_name:
         :param path:
         :param conn_logger:
+        :param fetch_content: whether to download the content of the file. If False, only the containing directories
+        and a placeholder of the file (with the right size) are created.
+        :param lazy: whether the content of the file can be fetched as it's read (see LazyHydration). Only for
+        files opened read-only: the READ requests on the missing ranges must wait for them.
         :return: A deferred that fires once the action has completed
         """
-        return self.action(share_name, path, conn_logger, 'SYNC', self.perform_sync)
+        if fetch_content:
+            def perform(share_name, path, conn_logger, log):
+                return self.perform_sync(share_name, path, conn_logger, log, lazy=lazy)
+
+            return self.action(share_name, path, conn_logger, 'SYNC', perform)
+        else:
+            return self.action(share_name, path, conn_logger, 'SYNC_METADATA', self.perform_sync_metadata)
 
     @defer.inlineCallbacks
     def perform_listdir(self, share_name, path, conn_logger, log):
@@ -432,29 +602,69 @@ class FSLocalCacheClient(object):
         return self.action(share_name, path, conn_logger, 'LISTDIR', self.perform_listdir)
 
     @defer.inlineCallbacks
-    def perform_syncback(self, share_name, path, conn_logger, log):
+    def perform_syncback(self, share_name, path, conn_logger, log, dirty_ranges=None, base_version=None):
         file_metadata = yield self.fscache.metadata_object(share_name, path, log)
         local_path = self.fs.network_path_to_local_path(file_metadata)
         if self.fs.isfile(local_path):
-            yield self.fscache.set_file(file_metadata, local_path, log)
+            yield self.fscache.set_file(
+                file_metadata, local_path, log, dirty_ranges=dirty_ranges, base_version=base_version)
         else:
             log.msg('Error: Requested to sync_back non-existing file %s' % local_path, level=logger.ERROR)
             self.stats_client.incr('action.SYNCBACK.errors.non_existing_file')
             err = RuntimeError('Requested to sync_back non-existing file %s' % local_path)
             raise err
 
-    def sync_back(self, share_name, path, conn_logger):
+    def sync_back(self, share_name, path, conn_logger, dirty_ranges=None, base_version=None):
         """
         Syncs a file back from the local SMB share to the source server
         :param share_name:
         :param path:
         :param conn_logger:
-        :return: A deferred that fires once the action has completed
+        :param dirty_ranges: an IntervalSet of the only modified ranges of the file, or None if it's all new
+        :param base_version: the (size, mtime) of the version of the file on the source server that dirty_ranges
+        apply to
+        :return: A deferred that fires once the action has completed. With write-behind, once the file is journaled.
         """
-        return self.action(share_name, path, conn_logger, 'SYNCBACK', self.perform_syncback)
+        if self.write_behind is not None:
+            return defer.maybeDeferred(self.write_behind.enqueue, share_name, path, dirty_ranges, base_version)
+
+        return self.write_back(
+            share_name, path, dirty_ranges, base_version, conn_logger=conn_logger, raise_errors=False)
+
+    @defer.inlineCallbacks
+    def local_file_stat(self, share_name, path, log):
+        """
+        :return: A deferred that fires with (size, mtime) of the local version of a file, or None if there isn't one
+        """
+        try:
+            file_metadata = yield self.fscache.metadata_object(share_name, path, log)
+            st = os.stat(self.fs.network_path_to_local_path(file_metadata))
+        except (OSError, IOError):
+            defer.returnValue(None)
+
+        defer.returnValue((st.st_size, st.st_mtime))
+
+    def write_back(self, share_name, path, dirty_ranges, base_version, conn_logger=None, raise_errors=True):
+        """
+        Performs a write-back. By default, one of the write-behind queue.
+        :return: A deferred that fails if the file couldn't be written back
+        """
+        if conn_logger is None:
+            conn_logger = logger.logger.new(connection_id='write-behind', peer='write-behind')
+
+        def perform(share_name, path, conn_logger, log):
+            return self.perform_syncback(
+                share_name, path, conn_logger, log, dirty_ranges=dirty_ranges, base_version=base_version)
+
+        return self.action(share_name, path, conn_logger, 'SYNCBACK', perform, raise_errors=raise_errors)
 
     @defer.inlineCallbacks
     def perform_delete(self, share_name, path, conn_logger, log):
+        if self.write_behind is not None:
+            # Don't write the file back after it's deleted
+            yield self.write_behind.discard(share_name, path)
+        if self.lazy_hydration is not None:
+            yield self.lazy_hydration.discard(share_name, path)
         yield defer.maybeDeferred(self.fscache.delete_file, share_name, path, log)
 
     def delete(self, share_name, path, conn_logger):
@@ -511,19 +721,73 @@ class FSLocalCacheClient(object):
         self.fs.create_directory(file_metadata, log)
 
 
-    @defer.inlineCallbacks
     def send_file(self, file_metadata, log, ctxt):
         """
-        Pull a file from the cache and write in on the local filesystem
+        Pull a file from the cache and write in on the local filesystem.
+        If the same version of the file is already being imported, wait for that import instead.
         :param file_metadata:
         :param log:
         :param ctxt:
         :return:
         """
+        # Paths are case insensitive
+        key = (
+            file_metadata.share_name.lower(),
+            file_metadata.normalized_path().lower(),
+            file_metadata.size(),
+            file_metadata.mtime(),
+        )
+        if key in self.imports.in_flight:
+            self.stats_client.incr('action.SYNC.info.import_coalesced')
+
+        return self.imports.run(key, self.locked_import_file, file_metadata, log, ctxt)
+
+    @defer.inlineCallbacks
+    def locked_import_file(self, file_metadata, log, ctxt):
+        """
+        Import a file, holding the sync lock on it when there are several workers
+        """
+        if self.sync_locks is None:
+            yield self.import_file(file_metadata, log, ctxt)
+            return
+
+        share_name = file_metadata.share_name
+        path = file_metadata.path
+
+        token, waited = yield self.sync_locks.acquire(share_name, path)
+        if waited:
+            # Another worker was importing it. It's most likely up to date now.
+            self.stats_client.incr('action.SYNC.info.sync_lock_wait')
+
+        lock_refresh = task.LoopingCall(self.sync_locks.refresh, share_name, path, token)
+        lock_refresh.start(self.sync_locks.LOCK_TTL / 3, now=False)
+        try:
+            yield self.import_file(file_metadata, log, ctxt)
+        finally:
+            if lock_refresh.running:
+                lock_refresh.stop()
+            yield self.sync_locks.release(share_name, path, token)
+
+    @defer.inlineCallbacks
+    def import_file(self, file_metadata, log, ctxt):
+        """
+        Download a file if the local version isn't up to date
+        """
         # If the file already exists, we need to check whether it has to be updated or if we keep the local one.
         local_path = self.fs.network_path_to_local_path(file_metadata)
         distant_mtime = file_metadata.mtime()
 
+        if self.lazy_hydration is not None:
+            lazy_file = self.lazy_hydration.get(file_metadata.share_name, file_metadata.path)
+            if lazy_file is not None:
+                if (lazy_file.size, lazy_file.mtime) == (file_metadata.size(), distant_mtime):
+                    # Being hydrated: the placeholder is up to date
+                    self.stats_client.incr('action.SYNC.info.sync_cache_hit')
+                    defer.returnValue(None)
+
+                # There's a new version of the file. The placeholder has an old mtime: it's imported again below.
+                yield self.lazy_hydration.discard(file_metadata.share_name, file_metadata.path)
+
         if os.path.exists(local_path):
             local_size = os.path.getsize(local_path)
             local_mtime = os.path.getmtime(local_path)
@@ -539,6 +803,12 @@ class FSLocalCacheClient(object):
 
         ctxt['needs_import'] = True
 
+        if ctxt.get('lazy') and self.lazy_hydration is not None and \
+                file_metadata.size() >= self.settings.LAZY_HYDRATION_MIN_SIZE:
+            started = yield self.start_lazy_hydration(file_metadata, local_path, log)
+            if started:
+                defer.returnValue(None)
+
         # Get a fd to the file
         # FIXME: get_file now throws an exception instead of returning None
         try:
@@ -575,6 +845,63 @@ class FSLocalCacheClient(object):
                 self.stats_client.incr('action.SYNC.errors.could_not_store_file')
 
 
+    @defer.inlineCallbacks
+    def start_lazy_hydration(self, file_metadata, local_path, log):
+        """
+        Replaces the local file by a placeholder of the right size, whose content is fetched as it's read.
+        Until all of it is there, the placeholder keeps an old mtime (as a fake file does).
+        :return: a Deferred that fires with whether the hydration started. If not, the file must be imported whole.
+        """
+        size = file_metadata.size()
+        distant_mtime = file_metadata.mtime()
+
+        try:
+            chunks = yield self.fscache.get_file_chunks(file_metadata, self.settings.LAZY_HYDRATION_CHUNK_SIZE, log)
+
+            tmp = tempfile.NamedTemporaryFile(dir=self.fscache.TMPDIR, delete=False)
+            with tmp:
+                tmp.truncate(size)
+            os.chown(tmp.name, self.required_uid, -1)
+            os.chmod(tmp.name, 0777)
+            fake_mtime = distant_mtime - 500 * self.settings.MTIME_REFRESH_THRESHOLD
+            os.utime(tmp.name, (fake_mtime, fake_mtime))
+            os.rename(tmp.name, local_path)
+        except Exception:
+            log.msg('Warning: could not create the placeholder of \"%s\" on %s, importing it whole: %s' % (
+                '\\' + file_metadata.path, file_metadata.share_name, traceback.format_exc()), level=logger.WARN)
+            self.stats_client.incr('action.SYNC.errors.could_not_create_placeholder')
+            defer.returnValue(False)
+
+        self.stats_client.incr('action.SYNC.info.lazy_hydration')
+        yield self.lazy_hydration.start(LazyFile(
+            file_metadata.share_name, file_metadata.path, local_path, size, distant_mtime, chunks))
+        defer.returnValue(True)
+
+    def fetch_chunk(self, lazy_file, start, end, source):
+        log = logger.logger.new(connection_id='lazy-hydration', peer='lazy-hydration')
+        return self.fscache.get_file_range(
+            lazy_file.share_name, lazy_file.path, lazy_file.size, lazy_file.mtime, start, end, source, log)
+
+    @staticmethod
+    def write_chunk(local_path, start, data, fake_mtime):
+        with open(local_path, 'r+b') as fh:
+            fh.seek(start)
+            fh.write(data)
+        # Writing sets the mtime to now: the placeholder would look up to date, and be served as is after a restart
+        os.utime(local_path, (fake_mtime, fake_mtime))
+
+    def store_chunk(self, lazy_file, start, data):
+        fake_mtime = lazy_file.mtime - 500 * self.settings.MTIME_REFRESH_THRESHOLD
+        return threads.deferToThread(self.write_chunk, lazy_file.local_path, start, data, fake_mtime)
+
+    def finish_hydration(self, lazy_file):
+        # From now on, the local file is up to date
+        try:
+            os.utime(lazy_file.local_path, (lazy_file.mtime, lazy_file.mtime))
+        except OSError:
+            logger.logger.new().msg("Error: couldn't set the mtime of hydrated file %s: %s" % (
+                lazy_file.local_path, traceback.format_exc()), level=logger.WARN)
+
     @staticmethod
     def clean_supplementary_files(share_name, dirname, children_to_keep):
         return
@@ -0,0 +1,77 @@
+# coding: utf-8
+
+# Copyright Luna Technology 2016
+# Matthieu Riviere <mriviere@luna-technology.com>
+
+import bisect
+
+
+# The end of a range that goes to the end of the file, whatever its size
+END_OF_FILE = 2 ** 63
+
+
+class IntervalSet(object):
+    """
+    A set of byte ranges [start, end). Overlapping and adjacent ranges are merged.
+    """
+
+    def __init__(self, ranges=()):
+        # Sorted, disjoint and non-adjacent
+        self.starts = []
+        self.ends = []
+
+        for start, end in ranges:
+            self.add(start, end)
+
+    def __iter__(self):
+        return iter(zip(self.starts, self.ends))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __eq__(self, other):
+        return isinstance(other, IntervalSet) and self.starts == other.starts and self.ends == other.ends
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'IntervalSet(%r)' % list(self)
+
+    def add(self, start, end):
+        if end <= start:
+            return
+
+        # The ranges that overlap or touch [start, end)
+        first = bisect.bisect_left(self.ends, start)
+        last = bisect.bisect_right(self.starts, end)
+
+        if first < last:
+            start = min(start, self.starts[first])
+            end = max(end, self.ends[last - 1])
+
+        self.starts[first:last] = [start]
+        self.ends[first:last] = [end]
+
+    def covers(self, start, end):
+        """Whether [start, end) is entirely in the set"""
+        if end <= start:
+            return True
+        i = bisect.bisect_right(self.starts, start) - 1
+        return i >= 0 and self.ends[i] >= end
+
+    def update(self, other):
+        for start, end in other:
+            self.add(start, end)
+
+    def copy(self):
+        return IntervalSet(self)
+
+    def clip(self, size):
+        """
+        :return: a new IntervalSet, without what's after size
+        """
+        return IntervalSet((start, min(end, size)) for start, end in self if start < size)
+
+    def total_length(self):
+        return sum(end - start for start, end in self)
@@ -0,0 +1,289 @@
+# coding: utf-8
+
+# Copyright Luna Technology 2016
+# Matthieu Riviere <mriviere@luna-technology.com>
+
+"""Lazy hydration of the imported files
+
+Instead of downloading a whole file before its CREATE gets to samba, a read-only open gets a placeholder (a sparse
+file of the right size), and the content is fetched chunk by chunk: first the chunks READ requests wait for (and a few
+after them), then the others in the background. The proxy holds back the READ requests on ranges that aren't there
+yet.
+
+Until all of it is there, the local file keeps the old mtime of a placeholder: after a restart of the proxy, it's
+imported again as usual.
+"""
+
+import bisect
+
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.python import failure
+
+import logger
+from interval_set import IntervalSet
+from singleflight import SingleFlight
+from statsd_logging import StatsdClient
+
+
+def lazy_file_key(share_name, path):
+    # Paths are case insensitive
+    return share_name.lower(), path.lower()
+
+
+class LazyFile(object):
+    """A file whose content is being fetched chunk by chunk"""
+
+    def __init__(self, share_name, path, local_path, size, mtime, chunks):
+        """
+        :param size: the size of the file
+        :param mtime: the mtime of the version of the file that is fetched
+        :param chunks: the list of (start, end, source) of the chunks of the file, in order. source tells where to
+        fetch the chunk from.
+        """
+        self.share_name = share_name
+        self.path = path
+        self.local_path = local_path
+        self.size = size
+        self.mtime = mtime
+        self.chunks = chunks
+        self.chunk_starts = [start for start, _, _ in chunks]
+
+        # The ranges of the local file that hold the content
+        self.present = IntervalSet()
+
+        # The Deferreds of the chunks being written to the local file
+        self.stores = []
+
+        self.discarded = False
+        self.retry_call = None
+
+    def covers(self, offset, length):
+        """Whether [offset, offset + length) is there. What's after the end of the file always is."""
+        end = min(offset + length, self.size)
+        return offset >= end or self.present.covers(offset, end)
+
+    def missing_chunks(self, offset, length):
+        """The indexes of the chunks holding [offset, offset + length) that aren't there yet"""
+        end = min(offset + length, self.size)
+        if offset >= end:
+            return []
+
+        first = max(bisect.bisect_right(self.chunk_starts, offset) - 1, 0)
+        last = bisect.bisect_left(self.chunk_starts, end)
+        return [
+            index for index in xrange(first, last)
+            if not self.present.covers(self.chunks[index][0], self.chunks[index][1])
+        ]
+
+    def is_complete(self):
+        return self.covers(0, self.size)
+
+
+class LazyHydration(object):
+    """
+    The files being hydrated lazily, and the fetches of their chunks.
+
+    A chunk is fetched only once at a time, whether a READ or the background fetch needs it. The background fetches
+    are limited to max_concurrent at a time, for all the files; after a failure, the background fetch of a file
+    starts again retry_delay seconds later.
+    """
+
+    def __init__(self, fetch_chunk, store_chunk, finish, read_ahead=2, max_concurrent=4, retry_delay=30,
+                 clock=reactor):
+        """
+        :param fetch_chunk: called with (lazy_file, start, end, source), returns a Deferred that fires with the content
+        of the chunk
+        :param store_chunk: called with (lazy_file, start, data), writes a chunk in the local file. Can return a
+        Deferred.
+        :param finish: called with the lazy_file once all of it is there, before it's forgotten. Can return a Deferred.
+        :param read_ahead: the number of chunks fetched after those a READ waits for
+        """
+        self.fetch_chunk = fetch_chunk
+        self.store_chunk = store_chunk
+        self.finish = finish
+        self.read_ahead = read_ahead
+        self.retry_delay = retry_delay
+        self.clock = clock
+
+        self.semaphore = defer.DeferredSemaphore(max_concurrent)
+        self.fetches = SingleFlight('lazy_hydration')
+
+        # key -> LazyFile
+        self.lazy_files = {}
+
+        self.total_started = 0
+        self.total_completed = 0
+        self.total_discarded = 0
+        self.total_fetched_chunks = 0
+        self.total_fetched_bytes = 0
+        self.total_held_reads = 0
+
+        self.stats_client = StatsdClient.get()
+
+    def get(self, share_name, path):
+        """:return: the LazyFile of a file being hydrated, or None"""
+        return self.lazy_files.get(lazy_file_key(share_name, path))
+
+    def start(self, lazy_file):
+        """Starts the background fetch of a file. Its local file must be a placeholder of the right size."""
+        self.lazy_files[lazy_file_key(lazy_file.share_name, lazy_file.path)] = lazy_file
+        self.total_started += 1
+        self.stats_client.incr('lazy_hydration.started')
+
+        if lazy_file.is_complete():
+            # An empty file
+            return self.complete(lazy_file)
+
+        self.backfill(lazy_file)
+        return defer.succeed(None)
+
+    def is_missing(self, share_name, path, offset, length):
+        """Whether a READ of [offset, offset + length) of a file must wait for its content"""
+        lazy_file = self.get(share_name, path)
+        return lazy_file is not None and not lazy_file.covers(offset, length)
+
+    def wait_range(self, share_name, path, offset, length):
+        """
+        Fetches the missing chunks of [offset, offset + length) of a file, and the read_ahead chunks after them.
+        :return: a Deferred that fires once the range is there
+        """
+        lazy_file = self.get(share_name, path)
+        if lazy_file is None:
+            return defer.succeed(None)
+
+        missing = lazy_file.missing_chunks(offset, length)
+        if not missing:
+            return defer.succeed(None)
+
+        self.total_held_reads += 1
+        self.stats_client.incr('lazy_hydration.held_reads')
+
+        waited = [self.fetch(lazy_file, index) for index in missing]
+
+        next_index = missing[-1] + 1
+        for index in xrange(next_index, min(next_index + self.read_ahead, len(lazy_file.chunks))):
+            start, end, _ = lazy_file.chunks[index]
+            if not lazy_file.present.covers(start, end):
+                self.fetch(lazy_file, index).addErrback(self.log_fetch_error, lazy_file, 'Read-ahead')
+
+        d = defer.gatherResults(waited, consumeErrors=True)
+        d.addCallback(lambda _: None)
+        return d
+
+    def wait_complete(self, share_name, path):
+        """
+        Fetches all the missing chunks of a file right away.
+        :return: a Deferred that fires once all of the file is there
+        """
+        lazy_file = self.get(share_name, path)
+        if lazy_file is None:
+            return defer.succeed(None)
+
+        d = defer.gatherResults([
+            self.fetch(lazy_file, index) for index in lazy_file.missing_chunks(0, lazy_file.size)
+        ], consumeErrors=True)
+        d.addCallback(lambda _: None)
+        return d
+
+    def discard(self, share_name, path):
+        """
+        Stops the hydration of a file (eg. because it's deleted, or there's a new version of it). The chunks fetched
+        from now on aren't written to the local file.
+        :return: a Deferred that fires once the chunks being written, if any, are
+        """
+        lazy_file = self.lazy_files.pop(lazy_file_key(share_name, path), None)
+        if lazy_file is None:
+            return defer.succeed(None)
+
+        lazy_file.discarded = True
+        self.total_discarded += 1
+        self.stats_client.incr('lazy_hydration.discarded')
+
+        if lazy_file.retry_call is not None and lazy_file.retry_call.active():
+            lazy_file.retry_call.cancel()
+
+        d = defer.DeferredList(list(lazy_file.stores))
+        d.addCallback(lambda _: None)
+        return d
+
+    def fetch(self, lazy_file, index):
+        """
+        :return: a Deferred that fires once a chunk is there
+        """
+        key = (lazy_file_key(lazy_file.share_name, lazy_file.path), lazy_file.mtime, index)
+        return self.fetches.run(key, self.fetch_and_store, lazy_file, index)
+
+    @defer.inlineCallbacks
+    def fetch_and_store(self, lazy_file, index):
+        start, end, source = lazy_file.chunks[index]
+        data = yield self.fetch_chunk(lazy_file, start, end, source)
+        if len(data) != end - start:
+            raise RuntimeError('Got %d bytes instead of %d for the chunk at %d of %s' % (
+                len(data), end - start, start, lazy_file.local_path))
+
+        if lazy_file.discarded:
+            return
+
+        d = defer.maybeDeferred(self.store_chunk, lazy_file, start, data)
+        lazy_file.stores.append(d)
+        try:
+            yield d
+        finally:
+            lazy_file.stores.remove(d)
+
+        lazy_file.present.add(start, end)
+        self.total_fetched_chunks += 1
+        self.total_fetched_bytes += len(data)
+        self.stats_client.incr('lazy_hydration.fetched_bytes', len(data))
+
+        if lazy_file.is_complete() and not lazy_file.discarded:
+            yield self.complete(lazy_file)
+
+    @defer.inlineCallbacks
+    def complete(self, lazy_file):
+        # Still known as being hydrated until it's finished: it mustn't be imported in the meantime
+        yield defer.maybeDeferred(self.finish, lazy_file)
+
+        key = lazy_file_key(lazy_file.share_name, lazy_file.path)
+        if self.lazy_files.get(key) is lazy_file:
+            del self.lazy_files[key]
+            self.total_completed += 1
+            self.stats_client.incr('lazy_hydration.completed')
+
+    @defer.inlineCallbacks
+    def backfill(self, lazy_file):
+        """Fetches the missing chunks of a file, in order"""
+        lazy_file.retry_call = None
+
+        for index, (start, end, _) in enumerate(lazy_file.chunks):
+            if lazy_file.discarded:
+                return
+            if lazy_file.present.covers(start, end):
+                continue
+
+            try:
+                yield self.semaphore.run(self.fetch, lazy_file, index)
+            except Exception:
+                self.log_fetch_error(failure.Failure(), lazy_file, 'Background fetch')
+                self.stats_client.incr('lazy_hydration.backfill_failed')
+                if not lazy_file.discarded:
+                    lazy_file.retry_call = self.clock.callLater(self.retry_delay, self.backfill, lazy_file)
+                return
+
+    @staticmethod
+    def log_fetch_error(error, lazy_file, what):
+        logger.logger.new().msg('%s of %s failed: %s' % (
+            what, lazy_file.local_path, error.getErrorMessage()), level=logger.WARN)
+
+    def get_stats(self):
+        return {
+            'hydrating': len(self.lazy_files),
+            'fetches_in_flight': len(self.fetches.in_flight),
+            'total_started': self.total_started,
+            'total_completed': self.total_completed,
+            'total_discarded': self.total_discarded,
+            'total_fetched_chunks': self.total_fetched_chunks,
+            'total_fetched_bytes': self.total_fetched_bytes,
+            'total_held_reads': self.total_held_reads,
+        }
@@ -0,0 +1,98 @@
+# coding: utf-8
+
+# Copyright Luna Technology 2016
+# Matthieu Riviere <mriviere@luna-technology.com>
+
+import collections
+import time
+
+
+class ExpiringLRUCache(object):
+    """
+    A cache holding at most max_entries values. Each value has its own expiry time.
+    When the cache is full, the least recently used value is evicted.
+    """
+
+    def __init__(self, max_entries, clock=time.time):
+        """
+        :param max_entries: the maximum number of values in the cache
+        :param clock: returns the current time (in seconds)
+        """
+        self.max_entries = max_entries
+        self.clock = clock
+
+        # key -> (expiry time, value), the least recently used first
+        self.entries = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """
+        :return: the value cached for key, or None if there isn't one or if it has expired
+        """
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expiry_time, value = entry
+        if expiry_time <= self.clock():
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        # Move it to the most recently used end
+        self.entries[key] = entry
+        self.hits += 1
+        return value
+
+    def set(self, key, value, expiry_time):
+        """
+        :param expiry_time: the time after which the value isn't returned any more
+        """
+        self.entries.pop(key, None)
+        self.entries[key] = (expiry_time, value)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def update(self, key, f):
+        """
+        Replaces the value cached for key by f(value), keeping its expiry time. Does nothing if there isn't one.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return
+
+        expiry_time, value = entry
+        self.entries[key] = (expiry_time, f(value))
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return float(self.hits) / lookups
+
+    def get_stats(self):
+        return {
+            'size': len(self.entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_ratio': self.hit_ratio(),
+        }
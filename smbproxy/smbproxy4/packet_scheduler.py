@@ -0,0 +1,136 @@
+# coding: utf-8
+
+# Copyright Luna Technology 2016
+# Matthieu Riviere <mriviere@luna-technology.com>
+
+import collections
+import heapq
+
+from twisted.internet import defer
+
+
+class ScheduledPacket(object):
+    def __init__(self, seq, item, keys, barrier):
+        self.seq = seq
+        self.item = item
+        self.keys = keys
+        self.barrier = barrier
+        # The number of the packets before it that share one of its keys, and aren't processed yet
+        self.blockers = 0
+
+
+class PacketScheduler(object):
+    """
+    Schedules the processing of the packets of a connection.
+
+    Each packet comes with the keys of the resources it works on (a file id, a path, a message id...). A packet is
+    processed as soon as no packet that came before it and shares one of its keys is still pending, so a slow packet
+    only holds back the packets that depend on it.
+    A barrier packet is processed alone: after all the packets that came before it, and before all the ones after it.
+
+    The pending packets are queued by key: once a packet is processed, only the next packet of each of its keys is
+    looked at again.
+    """
+
+    def __init__(self, process, max_running=None):
+        """
+        :param process: the function that processes a packet. Can return a Deferred.
+        :param max_running: the maximal number of packets processed at the same time
+        """
+        self.process = process
+        self.max_running = max_running
+
+        # The packets held back by a barrier (the first one can be the barrier itself), in order of arrival
+        self.waiting = collections.deque()
+        # The number of packets let in, not processed yet
+        self.admitted = 0
+        # Whether a barrier was let in, and isn't processed yet
+        self.barrier_pending = False
+        # key -> the deque of the packets let in with that key, not processed yet, in order of arrival. The first one
+        # is processed, or ready to be.
+        self.key_queues = {}
+        # The heap of (arrival number, packet) of the packets that can be processed, but wait for max_running
+        self.ready = []
+        self.running = 0
+
+        self._next_seq = 0
+        self._dispatching = False
+
+    def __len__(self):
+        return self.admitted + len(self.waiting)
+
+    def submit(self, item, keys, barrier=False):
+        self.waiting.append(ScheduledPacket(self._next_seq, item, frozenset(keys), barrier))
+        self._next_seq += 1
+        self._admit_waiting()
+        self._dispatch()
+
+    def _admit_waiting(self):
+        """Lets in the packets that a barrier doesn't hold back any more"""
+        while self.waiting and not self.barrier_pending:
+            entry = self.waiting[0]
+            if entry.barrier:
+                if self.admitted:
+                    # After all the packets before it
+                    return
+                self.barrier_pending = True
+            self.waiting.popleft()
+            self._admit(entry)
+
+    def _admit(self, entry):
+        self.admitted += 1
+        if not entry.barrier:
+            for key in entry.keys:
+                queue = self.key_queues.get(key)
+                if queue is None:
+                    self.key_queues[key] = collections.deque([entry])
+                else:
+                    entry.blockers += 1
+                    queue.append(entry)
+
+        if entry.blockers == 0:
+            heapq.heappush(self.ready, (entry.seq, entry))
+
+    def _dispatch(self):
+        if self._dispatching:
+            # We're called back from a packet that was processed synchronously. The running loop goes on.
+            return
+
+        self._dispatching = True
+        try:
+            # In order of arrival
+            while self.ready and (self.max_running is None or self.running < self.max_running):
+                _, entry = heapq.heappop(self.ready)
+                self._start(entry)
+        finally:
+            self._dispatching = False
+
+    def _start(self, entry):
+        self.running += 1
+
+        d = defer.maybeDeferred(self.process, entry.item)
+        d.addBoth(self._finished, entry)
+
+    def _finished(self, result, entry):
+        self.running -= 1
+        self.admitted -= 1
+
+        if entry.barrier:
+            self.barrier_pending = False
+        else:
+            for key in entry.keys:
+                queue = self.key_queues[key]
+                queue.popleft()
+                if not queue:
+                    del self.key_queues[key]
+                    continue
+
+                # Waiting packets also hold back the later packets with the same keys, to keep them in order
+                following = queue[0]
+                following.blockers -= 1
+                if following.blockers == 0:
+                    heapq.heappush(self.ready, (following.seq, following))
+
+        self._admit_waiting()
+        self._dispatch()
+        return result
@@ -0,0 +1,53 @@
+# coding: utf-8
+
+# Copyright Luna Technology 2016
+# Matthieu Riviere <mriviere@luna-technology.com>
+
+from twisted.internet import reactor
+
+from statsd_logging import StatsdClient
+
+
+class ReactorLagMonitor(object):
+    """
+    Measures how late the reactor runs a call scheduled every interval seconds. Anything that blocks the reactor
+    thread (eg. a synchronous redis call) delays it, and with it every connection of the process.
+    """
+
+    def __init__(self, interval=0.5, clock=reactor):
+        self.interval = interval
+        self.clock = clock
+
+        self.scheduled_call = None
+        self.expected_time = None
+
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+        self.stats_client = StatsdClient.get()
+
+    def start(self):
+        self.schedule()
+
+    def stop(self):
+        if self.scheduled_call is not None and self.scheduled_call.active():
+            self.scheduled_call.cancel()
+        self.scheduled_call = None
+
+    def schedule(self):
+        self.expected_time = self.clock.seconds() + self.interval
+        self.scheduled_call = self.clock.callLater(self.interval, self.measure)
+
+    def measure(self):
+        lag = max(0.0, self.clock.seconds() - self.expected_time)
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        self.stats_client.timing('reactor.lag', int(lag * 1000))
+
+        self.schedule()
+
+    def get_stats(self):
+        return {
+            'last_lag': self.last_lag,
+            'max_lag': self.max_lag,
+        }
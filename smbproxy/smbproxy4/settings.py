@@ -16,6 +16,13 @@ except Exception:
 
 # The size above which we download a file through CacheClient3
 CACHECLIENT3_SIZE_THRESHOLD = settings.get('cacheclient3_size_threshold', 1*1024*1024)
+# The maximum number of chunk transfers CacheClient3 keeps in flight for each file. As a whole, it doesn't have more
+# than CACHECLIENT3_CONCURRENCY requests in flight.
+CACHECLIENT3_WINDOW_SIZE = int(settings.get('cacheclient3_window_size', 15))
+CACHECLIENT3_CONCURRENCY = int(settings.get('cacheclient3_concurrency', 15))
+# Whether the number of requests CacheClient3 has in flight (up to CACHECLIENT3_CONCURRENCY) adapts to the measured
+# goodput of the link. Otherwise, it always has CACHECLIENT3_CONCURRENCY requests in flight.
+CACHECLIENT3_ADAPTIVE = settings.get('cacheclient3_adaptive', True)
 
 # The minimal time delay, in seconds, between file changes that we acknowledge.
 # Note that this is *if* the metadata cache has been flushed. By default, no file changes are acknowledged.
@@ -34,9 +41,37 @@ MTIME_REFRESH_THRESHOLD = settings.get('mtime_refresh_threshold', 5)
 MTIME_METADATA_REFRESH_THRESHOLD = settings.get('mtime_metadata_refresh_threshold', 15)
 NO_RECHECK_METADATA_PATTERNS = settings.get('no_recheck_metadata_patterns', [])
 
+# Maximum number of entries (file metadata or directory listings) kept in the in-process metadata cache
+METADATA_CACHE_MAX_ENTRIES = int(settings.get('metadata_cache_max_entries', 100000))
+
 # Whether files get written back to the control server
 ENABLE_WRITE_THROUGH = settings.get('enable_write_through', True)
 
+# When only some ranges of a file were modified, only these ranges are written back, unless they make up more than
+# PARTIAL_WRITE_BACK_MAX_DIRTY_FRACTION of the file or more than PARTIAL_WRITE_BACK_MAX_BYTES bytes.
+PARTIAL_WRITE_BACK_MAX_DIRTY_FRACTION = float(settings.get('partial_write_back_max_dirty_fraction', 0.25))
+PARTIAL_WRITE_BACK_MAX_BYTES = int(settings.get('partial_write_back_max_bytes', 64*1024*1024))
+
+# Whether files get written back in the background (write-behind), after their CLOSE has been answered.
+# The files still to be written back are journaled in WRITE_BEHIND_JOURNAL_DIR, so they survive a restart.
+# A failed write-back is retried after WRITE_BEHIND_RETRY_DELAY seconds, then twice that, etc.
+# Off by default: a closed file isn't on the fileserver yet, to be enabled for each deployment.
+ENABLE_WRITE_BEHIND = settings.get('enable_write_behind', False)
+WRITE_BEHIND_JOURNAL_DIR = settings.get('write_behind_journal_dir', '/home/data/smbproxy_write_behind')
+WRITE_BEHIND_MAX_CONCURRENT = int(settings.get('write_behind_max_concurrent', 4))
+WRITE_BEHIND_RETRY_DELAY = float(settings.get('write_behind_retry_delay', 5))
+
+# Whether the files of at least LAZY_HYDRATION_MIN_SIZE bytes opened read-only are hydrated lazily: the CREATE is
+# answered once a sparse placeholder is there, and the content is fetched by chunks (the parts of the file in
+# CacheClient3, or chunks of LAZY_HYDRATION_CHUNK_SIZE bytes) as the READ requests need it, and in the background.
+# A READ waiting for a chunk also fetches the LAZY_HYDRATION_READ_AHEAD chunks after it.
+# Off by default: a file is only partly there until all of it is fetched, to be enabled for each deployment.
+ENABLE_LAZY_HYDRATION = settings.get('enable_lazy_hydration', False)
+LAZY_HYDRATION_MIN_SIZE = int(settings.get('lazy_hydration_min_size', 16*1024*1024))
+LAZY_HYDRATION_CHUNK_SIZE = int(settings.get('lazy_hydration_chunk_size', 4*1024*1024))
+LAZY_HYDRATION_READ_AHEAD = int(settings.get('lazy_hydration_read_ahead', 2))
+LAZY_HYDRATION_MAX_CONCURRENT = int(settings.get('lazy_hydration_max_concurrent', 4))
+
 
 # Whether the proxy issues a touch() command when a file is opened in write mode.
 # This gives the illusion, on the studio side, that the file is currently being written.
@@ -59,6 +94,25 @@ LOG_SMB2_PACKETS = settings.get('log_smb2_packets', False)
 # Number of packets pending in queue above which a warning gets printed
 PENDING_PACKETS_LEVEL_WARN = 100
 
+# Maximal number of packets of a single connection processed at the same time.
+# Packets that don't depend on each other (eg. CREATEs of different files) are processed concurrently, so one
+# file import doesn't hold back the whole connection.
+MAX_CONCURRENT_PACKETS_PER_CONNECTION = int(settings.get('max_concurrent_packets_per_connection', 64))
+
+# Time (in seconds) after which a CREATE still waiting for its file to be imported gets an interim response
+# (STATUS_PENDING). It keeps the client waiting instead of timing out and retrying. 0 disables interim responses.
+INTERIM_RESPONSE_DELAY = float(settings.get('interim_response_delay', 5))
+
+# Flow control, in bytes. When more than FLOW_CONTROL_HIGH_WATER_MARK bytes of complete packets from one side of a
+# connection are waiting in the proxy (eg. writes held back by a file import), we stop reading from that side until
+# the backlog goes back under FLOW_CONTROL_LOW_WATER_MARK bytes.
+FLOW_CONTROL_HIGH_WATER_MARK = int(settings.get('flow_control_high_water_mark', 32*1024*1024))
+FLOW_CONTROL_LOW_WATER_MARK = int(settings.get('flow_control_low_water_mark', 8*1024*1024))
+
+# Number of smbproxy processes sharing the listening socket. Above 1, a supervisor process starts the workers, and
+# file imports are coordinated between them through the local redis.
+WORKERS = int(settings.get('workers', 1))
+
 
 # Maximum time (in seconds) allowed to be spent in a list_dir request
 LIST_DIR_TIMEOUT = settings.get('list_dir_timeout', 50)
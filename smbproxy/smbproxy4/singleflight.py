@@ -0,0 +1,89 @@
+# coding: utf-8
+
+# Copyright Luna Technology 2016
+# Matthieu Riviere <mriviere@luna-technology.com>
+
+from twisted.internet import defer
+from twisted.python import failure
+
+from statsd_logging import StatsdClient
+
+
+class _Flight(object):
+    def __init__(self):
+        self.deferred = None
+        self.waiters = []
+
+
+class SingleFlight(object):
+    """
+    Runs an operation only once at a time for a given key: a call made while the operation is in flight doesn't
+    start it again, it waits for the running one and gets its result (or its failure).
+
+    Each caller gets its own Deferred. Cancelling it only detaches that caller; the operation itself is cancelled
+    when all its callers are gone.
+    """
+
+    def __init__(self, name):
+        """
+        :param name: the name under which the metrics are reported
+        """
+        self.name = name
+        self.in_flight = {}
+
+        self.total_started = 0
+        self.total_coalesced = 0
+
+        self.stats_client = StatsdClient.get()
+
+    def run(self, key, f, *args, **kwargs):
+        """
+        Calls f(*args, **kwargs), unless a call for the same key is in flight.
+        :return: a Deferred that fires with the result of the call
+        """
+        flight = self.in_flight.get(key)
+
+        if flight is None:
+            flight = _Flight()
+            self.in_flight[key] = flight
+            self.total_started += 1
+            self.stats_client.incr('singleflight.%s.started' % self.name)
+
+            waiter = self._add_waiter(key, flight)
+            flight.deferred = defer.maybeDeferred(f, *args, **kwargs)
+            flight.deferred.addBoth(self._landed, key, flight)
+        else:
+            self.total_coalesced += 1
+            self.stats_client.incr('singleflight.%s.coalesced' % self.name)
+            waiter = self._add_waiter(key, flight)
+
+        return waiter
+
+    def _add_waiter(self, key, flight):
+        waiter = defer.Deferred(canceller=lambda d: self._cancel_waiter(key, flight, d))
+        flight.waiters.append(waiter)
+        return waiter
+
+    def _cancel_waiter(self, key, flight, waiter):
+        flight.waiters.remove(waiter)
+
+        if not flight.waiters and self.in_flight.get(key) is flight:
+            # Nobody wants the result any more
+            del self.in_flight[key]
+            self.stats_client.incr('singleflight.%s.cancelled' % self.name)
+            flight.deferred.cancel()
+
+    def _landed(self, result, key, flight):
+        # New calls must start a new operation, even if they're made by the callbacks of the waiters
+        if self.in_flight.get(key) is flight:
+            del self.in_flight[key]
+
+        waiters, flight.waiters = flight.waiters, []
+        for waiter in waiters:
+            if isinstance(result, failure.Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(result)
+
+        # The failure was handed to the waiters (if there are any left)
+        return None
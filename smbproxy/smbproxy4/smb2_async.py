@@ -0,0 +1,93 @@
+# coding: utf-8
+
+# Copyright Luna Technology 2016
+# Matthieu Riviere <mriviere@luna-technology.com>
+
+"""
+Building of the SMB2 interim responses the proxy sends on its own, and rewriting of the final responses that go
+with them.
+
+When a request takes long (eg. a CREATE that imports a file), the proxy tells the client to keep waiting with an
+interim response (MS-SMB2 3.3.4.2). The request then becomes asynchronous: the final response must carry the
+SMB2_FLAGS_ASYNC_COMMAND flag and the AsyncId of the interim response.
+"""
+
+import struct
+
+from smb.smb2_constants import SMB2_FLAGS_ASYNC_COMMAND, SMB2_FLAGS_SERVER_TO_REDIR, SMB2_FLAGS_SIGNED
+
+
+STATUS_PENDING = 0x00000103
+
+# The whole SMB2 header, async variant
+SMB2_ASYNC_HEADER_STRUCT = struct.Struct('<4sHHIHHIIQQQ16s')
+SMB2_HEADER_SIZE = SMB2_ASYNC_HEADER_STRUCT.size
+
+# Offsets of the fields we rewrite in the header of a response
+SMB2_CREDIT_RESPONSE_OFFSET = 14
+SMB2_FLAGS_OFFSET = 16
+SMB2_ASYNC_ID_OFFSET = 32
+
+# SMB2 ERROR Response, with no error data (MS-SMB2 2.2.2)
+SMB2_ERROR_RESPONSE_STRUCT = struct.Struct('<HBBIB')
+
+NMB_HEADER_STRUCT = struct.Struct('>I')
+
+
+def build_interim_response(request, async_id):
+    """
+    Builds the NMB packet of an interim response to a request.
+
+    The interim response grants no credit: the client gets its credits back with the final response, as Samba
+    accounts for them.
+    :param request: the SMB2Message of the request
+    :param async_id: the AsyncId identifying the request from now on
+    :return: the NMB packet, as a string
+    """
+    header = SMB2_ASYNC_HEADER_STRUCT.pack(
+        '\xFESMB',
+        SMB2_HEADER_SIZE,
+        request.credit_charge,
+        STATUS_PENDING,
+        request.command,
+        0,
+        SMB2_FLAGS_SERVER_TO_REDIR | SMB2_FLAGS_ASYNC_COMMAND,
+        0,
+        request.mid,
+        async_id,
+        request.session_id,
+        '\0' * 16,
+    )
+    body = SMB2_ERROR_RESPONSE_STRUCT.pack(9, 0, 0, 0, 0)
+
+    return NMB_HEADER_STRUCT.pack(len(header) + len(body)) + header + body
+
+
+def is_interim_response(response):
+    """
+    :param response: the SMB2Message of a response
+    """
+    return response.status == STATUS_PENDING and bool(response.flags & SMB2_FLAGS_ASYNC_COMMAND)
+
+
+def make_async_response(data, async_id, extra_credits=0):
+    """
+    Rewrites a final response to the async form, with our AsyncId.
+
+    A signed response can't be rewritten without breaking its signature. It is returned unmodified, but it shouldn't
+    happen: signed requests don't get interim responses.
+    :param data: the SMB2 message of the response (without the NMB header)
+    :param async_id: the AsyncId given in the interim response
+    :param extra_credits: credits to grant on top of those of the response
+    :return: the NMB packet, as a string
+    """
+    response = bytearray(data)
+
+    flags, = struct.unpack_from('<I', response, SMB2_FLAGS_OFFSET)
+    if not flags & SMB2_FLAGS_SIGNED:
+        credits, = struct.unpack_from('<H', response, SMB2_CREDIT_RESPONSE_OFFSET)
+        struct.pack_into('<H', response, SMB2_CREDIT_RESPONSE_OFFSET, min(credits + extra_credits, 0xFFFF))
+        struct.pack_into('<I', response, SMB2_FLAGS_OFFSET, flags | SMB2_FLAGS_ASYNC_COMMAND)
+        struct.pack_into('<Q', response, SMB2_ASYNC_ID_OFFSET, async_id)
+
+    return NMB_HEADER_STRUCT.pack(len(response)) + str(response)
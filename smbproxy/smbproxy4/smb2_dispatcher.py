@@ -0,0 +1,268 @@
+# coding: utf-8
+
+# Copyright Luna Technology 2016
+# Matthieu Riviere <mriviere@luna-technology.com>
+
+"""
+Decoding of SMB2 messages, and dispatch of the messages to per-command handlers.
+
+All the structures are compiled once. A message only has its header decoded; the body structure of a command is only
+decoded when a handler is registered for it. The same code serves requests and responses: the proxy has one
+dispatcher for each direction.
+"""
+
+import collections
+import struct
+
+from smb.smb_structs import ProtocolError
+from smb.smb2_constants import SMB2_FLAGS_ASYNC_COMMAND
+from smb.smb2_structs import SMB2Message
+
+
+class SMB2Structure(object):
+    """A fixed size SMB2 structure, with named fields"""
+
+    def __init__(self, name, fields):
+        """
+        :param name: the name of the structure
+        :param fields: list of (field name, struct format)
+        """
+        self.name = name
+        self.struct = struct.Struct('<' + ''.join(field_format for _, field_format in fields))
+        self.size = self.struct.size
+        self.tuple_class = collections.namedtuple(name, [field_name for field_name, _ in fields])
+
+    def unpack(self, buf, offset=0):
+        if len(buf) < offset + self.size:
+            raise ProtocolError('Not enough data to decode %s' % self.name, buf)
+        # Same as tuple_class._make(), without the length check: the struct has the right number of fields
+        return tuple.__new__(self.tuple_class, self.struct.unpack_from(buf, offset))
+
+
+SMB2_HEADER_SIZE = 64
+
+# The sync variant of the header. In an async header, the pid and tid fields hold the async id.
+SMB2_HEADER = SMB2Structure('SMB2Header', [
+    ('protocol', '4s'),
+    ('structure_size', 'H'),
+    ('credit_charge', 'H'),
+    ('status', 'I'),
+    ('command', 'H'),
+    ('credit_re', 'H'),
+    ('flags', 'I'),
+    ('next_command_offset', 'I'),
+    ('mid', 'Q'),
+    ('pid', 'I'),
+    ('tid', 'I'),
+    ('session_id', 'Q'),
+    ('signature', '16s'),
+])
+
+SMB2_CREATE_REQUEST = SMB2Structure('SMB2CreateRequest', [
+    ('structure_size', 'H'),
+    ('security_flags', 'B'),
+    ('requested_oplock_level', 'B'),
+    ('impersonation_level', 'I'),
+    ('smb_create_flags', 'Q'),
+    ('reserved', 'Q'),
+    ('desired_access', 'I'),
+    ('file_attributes', 'I'),
+    ('share_access', 'I'),
+    ('create_disposition', 'I'),
+    ('create_options', 'I'),
+    ('name_offset', 'H'),
+    ('name_length', 'H'),
+    ('create_contexts_offset', 'I'),
+    ('create_contexts_length', 'I'),
+])
+
+SMB2_CREATE_CONTEXT = SMB2Structure('SMB2CreateContext', [
+    ('next', 'I'),
+    ('name_offset', 'H'),
+    ('name_length', 'H'),
+    ('reserved', 'H'),
+    ('data_offset', 'H'),
+    ('data_length', 'I'),
+])
+
+SMB2_CREATE_RESPONSE = SMB2Structure('SMB2CreateResponse', [
+    ('structure_size', 'H'),
+    ('oplock_level', 'B'),
+    ('flags', 'B'),
+    ('create_action', 'I'),
+    ('creation_time', 'Q'),
+    ('last_access_time', 'Q'),
+    ('last_write_time', 'Q'),
+    ('change_time', 'Q'),
+    ('allocation_size', 'Q'),
+    ('end_of_file', 'Q'),
+    ('file_attributes', 'I'),
+    ('reserved', 'I'),
+    ('file_id', '16s'),
+    ('create_contexts_offset', 'I'),
+    ('create_contexts_length', 'I'),
+])
+
+SMB2_QUERY_DIRECTORY_REQUEST = SMB2Structure('SMB2QueryDirectoryRequest', [
+    ('structure_size', 'H'),
+    ('file_information_class', 'B'),
+    ('flags', 'B'),
+    ('file_index', 'I'),
+    ('file_id', '16s'),
+    ('file_name_offset', 'H'),
+    ('file_name_length', 'H'),
+    ('output_buffer_length', 'I'),
+])
+
+SMB2_TREE_CONNECT_REQUEST = SMB2Structure('SMB2TreeConnectRequest', [
+    ('structure_size', 'H'),
+    ('reserved', 'H'),
+    ('path_offset', 'H'),
+    ('path_length', 'H'),
+])
+
+SMB2_SET_INFO_REQUEST = SMB2Structure('SMB2SetInfoRequest', [
+    ('structure_size', 'H'),
+    ('info_type', 'B'),
+    ('file_info_class', 'B'),
+    ('buffer_length', 'I'),
+    ('buffer_offset', 'H'),
+    ('reserved', 'H'),
+    ('additional_information', 'I'),
+    ('file_id', '16s'),
+])
+
+SMB2_WRITE_REQUEST = SMB2Structure('SMB2WriteRequest', [
+    ('structure_size', 'H'),
+    ('data_offset', 'H'),
+    ('length', 'I'),
+    ('offset', 'Q'),
+    ('file_id', '16s'),
+    ('channel', 'I'),
+    ('remaining_bytes', 'I'),
+    ('write_channel_info_offset', 'H'),
+    ('write_channel_info_length', 'H'),
+    ('flags', 'I'),
+])
+
+SMB2_READ_REQUEST = SMB2Structure('SMB2ReadRequest', [
+    ('structure_size', 'H'),
+    ('padding', 'B'),
+    ('flags', 'B'),
+    ('length', 'I'),
+    ('offset', 'Q'),
+    ('file_id', '16s'),
+    ('minimum_count', 'I'),
+    ('channel', 'I'),
+    ('remaining_bytes', 'I'),
+    ('read_channel_info_offset', 'H'),
+    ('read_channel_info_length', 'H'),
+])
+
+SMB2_CLOSE_REQUEST = SMB2Structure('SMB2CloseRequest', [
+    ('structure_size', 'H'),
+    ('flags', 'H'),
+    ('reserved', 'I'),
+    ('file_id', '16s'),
+])
+
+
+class ParsedSMB2Message(SMB2Message):
+    """
+    A SMB2Message decoded by parse_smb2_message.
+    The parser sets all the header fields, the others keep these defaults: no need to go through reset().
+    """
+    async_id = 0
+    pid = 0
+    tid = 0
+    payload = None
+    flags2 = 0
+    uid = 0
+    security = 0L
+    parameters_data = ''
+
+    def __init__(self):
+        pass
+
+
+def parse_smb2_message(buf):
+    """
+    Decodes the header of a SMB2 message.
+    :param buf: the data, starting at the SMB2 header. Can hold the next messages of a compound chain.
+    :return: (length of the message, SMB2Message). The body is left undecoded in message.data.
+    """
+    if len(buf) < SMB2_HEADER_SIZE:
+        raise ProtocolError('Not enough data to decode SMB2 header', buf)
+
+    header = SMB2_HEADER.struct.unpack_from(buf)
+    if header[0] != '\xFESMB':
+        raise ProtocolError('Invalid 4-byte SMB2 protocol field', buf)
+    if header[1] != SMB2_HEADER_SIZE:
+        raise ProtocolError('Invalid SMB2 header structure size')
+
+    smb_message = ParsedSMB2Message()
+    _, _, smb_message.credit_charge, smb_message.status, smb_message.command, smb_message.credit_re, \
+        smb_message.flags, smb_message.next_command_offset, smb_message.mid, pid, tid, smb_message.session_id, \
+        smb_message.signature = header
+
+    if smb_message.flags & SMB2_FLAGS_ASYNC_COMMAND:
+        smb_message.async_id = (tid << 32) | pid
+    else:
+        smb_message.pid = pid
+        smb_message.tid = tid
+
+    if smb_message.next_command_offset > 0:
+        smb_message.raw_data = buf[:smb_message.next_command_offset]
+        smb_message.data = buf[SMB2_HEADER_SIZE:smb_message.next_command_offset]
+    else:
+        smb_message.raw_data = buf
+        smb_message.data = buf[SMB2_HEADER_SIZE:]
+
+    return len(smb_message.raw_data), smb_message
+
+
+class SMB2Dispatcher(object):
+    """
+    Calls the handler registered for the command of a SMB2 message.
+
+    Handlers are registered with the handler() decorator, on methods:
+
+        REQUEST_HANDLERS = SMB2Dispatcher()
+
+        class Protocol(object):
+            @REQUEST_HANDLERS.handler(SMB2_COM_CLOSE, SMB2_CLOSE_REQUEST)
+            def on_close(self, message, body):
+                ...
+
+    and called with the body structure decoded, by REQUEST_HANDLERS.dispatch(protocol, message).
+    """
+
+    def __init__(self):
+        self.handlers = {}
+
+    def handler(self, command, body_structure=None):
+        def register(func):
+            self.handlers[command] = (func, body_structure)
+            return func
+        return register
+
+    def decode_body(self, message):
+        """Decodes the body structure of a message, if a handler is interested in it. Returns None otherwise."""
+        handler = self.handlers.get(message.command)
+        if handler is None or handler[1] is None:
+            return None
+        return handler[1].unpack(message.data)
+
+    def dispatch(self, target, message, default=True):
+        """
+        :param target: the object the handler is called on
+        :return: what the handler returns, or default if there's no handler for the command
+        """
+        handler = self.handlers.get(message.command)
+        if handler is None:
+            return default
+
+        func, body_structure = handler
+        if body_structure is None:
+            return func(target, message, None)
+        return func(target, message, body_structure.unpack(message.data))
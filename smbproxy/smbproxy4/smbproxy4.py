@@ -8,6 +8,7 @@ import base64
 from datetime import datetime
 import json
 import os
+import socket
 import struct
 import traceback
 import uuid
@@ -22,19 +23,176 @@ from twisted.python import log
 from seekscale_commons.stream_stats import StreamStatsClient
 
 from nmb.nmb_constants import *
-from nmb.nmb_structs import DirectTCPSessionMessage, NMBError, NotConnectedError
+from nmb.nmb_structs import DirectTCPSessionMessage, NMBError, NMBReceiveBuffer, NotConnectedError
 from smb.smb_structs import SMBMessage, SMB2ProtocolHeaderError, ProtocolError
 from smb.smb_constants import *
 from smb.smb2_structs import SMB2Message
 from smb.smb2_constants import *
 
 from debug_interface import dump_debug_stats, get_debug_stats_struct
+from flow_control import FlowController
 from fs_cache import FSCache
 from fs_local_cache_client import FSLocalCacheClient
+from interval_set import END_OF_FILE, IntervalSet
 import logger
+from packet_scheduler import PacketScheduler
+from reactor_lag import ReactorLagMonitor
+from smb2_async import build_interim_response, is_interim_response, make_async_response
+from smb2_dispatcher import SMB2Dispatcher, parse_smb2_message, SMB2_CLOSE_REQUEST, SMB2_CREATE_CONTEXT, \
+    SMB2_CREATE_REQUEST, SMB2_CREATE_RESPONSE, SMB2_HEADER_SIZE, SMB2_QUERY_DIRECTORY_REQUEST, SMB2_READ_REQUEST, \
+    SMB2_SET_INFO_REQUEST, SMB2_TREE_CONNECT_REQUEST, SMB2_WRITE_REQUEST
 from statsd_logging import StatsdClient
 
 
+# The beginning of the SMB2 header (protocol, structure size, credit charge, status, command, credits, flags and
+# next command offset), located right after the 4 bytes of the Direct TCP header.
+# Precompiled, so that each packet can be classified without decoding it.
+SMB2_HEADER_PEEK_STRUCT = struct.Struct('<4sHHIHHII')
+SMB2_HEADER_PEEK_OFFSET = DirectTCPSessionMessage.HEADER_STRUCT_SIZE
+# The MessageId, right after it
+SMB2_MESSAGE_ID_STRUCT = struct.Struct('<Q')
+SMB2_MESSAGE_ID_PEEK_OFFSET = SMB2_HEADER_PEEK_OFFSET + SMB2_HEADER_PEEK_STRUCT.size
+
+
+# Where the FileId field is, in the body of the SMB2 requests that work on an open file
+SMB2_FILE_ID_OFFSETS = {
+    SMB2_COM_CLOSE: 8,
+    SMB2_COM_FLUSH: 8,
+    SMB2_COM_READ: 16,
+    SMB2_COM_WRITE: 16,
+    SMB2_COM_LOCK: 8,
+    SMB2_COM_IOCTL: 8,
+    SMB2_COM_QUERY_DIRECTORY: 8,
+    SMB2_COM_CHANGE_NOTIFY: 8,
+    SMB2_COM_QUERY_INFO: 24,
+    SMB2_COM_SET_INFO: 16,
+    SMB2_COM_OPLOCK_BREAK: 8,
+}
+SMB2_FILE_ID_SIZE = 16
+# The FileId used by the requests that refer to the file opened by a previous request of the same compound chain
+SMB2_RELATED_FILE_ID = '\xff' * SMB2_FILE_ID_SIZE
+# No open has this FileId: samba fails the requests that use it with STATUS_FILE_CLOSED
+SMB2_INVALID_FILE_ID = '\0' * SMB2_FILE_ID_SIZE
+
+# The number of bytes that are enough to decode the body of a WRITE request (without its data)
+SMB2_WRITE_PEEK_SIZE = SMB2_HEADER_PEEK_OFFSET + SMB2_HEADER_SIZE + SMB2_WRITE_REQUEST.size
+# The number of bytes that are enough to decode the body of a READ request
+SMB2_READ_PEEK_SIZE = SMB2_HEADER_PEEK_OFFSET + SMB2_HEADER_SIZE + SMB2_READ_REQUEST.size
+
+# The SET_INFO classes that change the size of a file
+SIZE_CHANGING_FILE_INFO_CLASSES = frozenset([
+    19,  # FileAllocationInformation
+    20,  # FileEndOfFileInformation
+])
+
+# The number of bytes that are enough to find the FileId of a request
+SMB2_DEPENDENCIES_PEEK_SIZE = SMB2_HEADER_PEEK_OFFSET + 64 + max(SMB2_FILE_ID_OFFSETS.values()) + SMB2_FILE_ID_SIZE
+
+# The requests that change the state of the whole session. They are processed alone.
+SMB2_BARRIER_COMMANDS = frozenset([
+    SMB2_COM_NEGOTIATE,
+    SMB2_COM_SESSION_SETUP,
+    SMB2_COM_LOGOFF,
+    SMB2_COM_TREE_DISCONNECT,
+])
+
+
+def peek_packet(packet, size):
+    """
+    Returns (as a string) the first size bytes of a NMB packet decoded from a NMBReceiveBuffer, or less if the
+    packet is shorter. Only the chunks that are needed are concatenated.
+    """
+    data = packet.raw_chunks[0]
+    if len(data) < size and len(packet.raw_chunks) > 1:
+        pieces = []
+        length = 0
+        for chunk in packet.raw_chunks:
+            pieces.append(chunk)
+            length += len(chunk)
+            if length >= size:
+                break
+        data = ''.join(pieces)
+
+    return data
+
+
+def peek_smb2_command(packet):
+    """
+    Returns the SMB2 command of a NMB packet decoded from a NMBReceiveBuffer, by only looking at its first bytes.
+    Returns None if the packet is not a single SMB2 message (SMB1 message, compound request...)
+    """
+    needed = SMB2_HEADER_PEEK_OFFSET + SMB2_HEADER_PEEK_STRUCT.size
+
+    header = peek_packet(packet, needed)
+    if len(header) < needed:
+        return None
+
+    protocol, _, _, _, command, _, _, next_command_offset = \
+        SMB2_HEADER_PEEK_STRUCT.unpack_from(header, SMB2_HEADER_PEEK_OFFSET)
+
+    if protocol != '\xFESMB' or next_command_offset != 0:
+        return None
+
+    return command
+
+
+def peek_smb2_message_id(packet):
+    """
+    Returns the MessageId of a NMB packet holding a single SMB2 message (see peek_smb2_command), by only looking at its
+    first bytes.
+    """
+    needed = SMB2_MESSAGE_ID_PEEK_OFFSET + SMB2_MESSAGE_ID_STRUCT.size
+    header = peek_packet(packet, needed)
+    if len(header) < needed:
+        return None
+
+    mid, = SMB2_MESSAGE_ID_STRUCT.unpack_from(header, SMB2_MESSAGE_ID_PEEK_OFFSET)
+    return mid
+
+
+def replace_file_id(packet, command, file_id):
+    """
+    Returns the data of a NMB packet holding a single SMB2 request that works on an open file, with another FileId.
+    Only meant for small requests: the whole packet is copied.
+    """
+    data = ''.join(packet.raw_chunks)
+    offset = SMB2_HEADER_PEEK_OFFSET + SMB2_HEADER_SIZE + SMB2_FILE_ID_OFFSETS[command]
+    return [data[:offset] + file_id + data[offset+SMB2_FILE_ID_SIZE:]]
+
+
+# The create dispositions that replace the content of an existing file (or fail if the file exists). The current
+# content of the file is never read: no need to download it.
+CONTENT_DISCARDING_CREATE_DISPOSITIONS = frozenset([
+    FILE_SUPERSEDE,
+    FILE_CREATE,
+    FILE_OVERWRITE,
+    FILE_OVERWRITE_IF,
+])
+
+
+# The access rights that only give access to the metadata of a file (attributes, extended attributes, security
+# descriptor). Explorer, backup agents and render managers open files with them to stat them or read their ACLs.
+# Anything else (read, write, execute, delete, generic or maximum access) needs the content.
+METADATA_ONLY_ACCESS = FILE_READ_ATTRIBUTES | FILE_READ_EA | READ_CONTROL | SYNCHRONIZE
+
+
+def create_needs_content(create_disposition, desired_access):
+    """Whether the content of a file must be available locally before a CREATE request on it gets to samba"""
+    if create_disposition in CONTENT_DISCARDING_CREATE_DISPOSITIONS:
+        return False
+
+    # The content is downloaded by the first open that can read or write data
+    if desired_access & ~METADATA_ONLY_ACCESS == 0:
+        return False
+
+    return True
+
+
+# The handlers of the SMB2 messages, by command
+SMB2_REQUEST_HANDLERS = SMB2Dispatcher()
+SMB2_RESPONSE_HANDLERS = SMB2Dispatcher()
+
+
 class ProxyClientProtocol(protocol.Protocol):
 
     def connectionMade(self):
@@ -43,10 +201,15 @@ class ProxyClientProtocol(protocol.Protocol):
         self.cli_queue = self.factory.cli_queue
         self.cli_queue.get().addCallback(self.serverDataReceived)
 
+        # Stop reading from the client when samba doesn't keep up, and from samba when the proxy has too much of its
+        # data waiting
+        self.transport.registerProducer(self.factory.client_flow, True)
+        self.factory.server_flow.set_producer(self.transport)
+
     def serverDataReceived(self, chunk):
         """
         This is where we react to data received from the client
-        :param chunk:
+        :param chunk: the list of strings that make up a NMB packet
         """
         if chunk is False:
             self.cli_queue = None
@@ -55,7 +218,8 @@ class ProxyClientProtocol(protocol.Protocol):
             self.transport.loseConnection()
         elif self.cli_queue:
             # log.msg("Client: writing %d bytes to peer" % len(chunk))
-            self.transport.write(chunk)
+            self.transport.writeSequence(chunk)
+            self.factory.client_flow.dequeued(sum(len(c) for c in chunk))
             # Put back the callback for the next chunk of data
             self.cli_queue.get().addCallback(self.serverDataReceived)
         else:
@@ -80,21 +244,39 @@ class ProxyClientFactory(protocol.ClientFactory):
     continueTrying = True
     protocol = ProxyClientProtocol
 
-    def __init__(self, srv_queue, cli_queue):
+    def __init__(self, srv_queue, cli_queue, client_flow, server_flow):
         self.srv_queue = srv_queue
         self.cli_queue = cli_queue
+        self.client_flow = client_flow
+        self.server_flow = server_flow
 
 
 class ProxyServerProtocol(protocol.Protocol):
     remote_host = None
     remote_port = None
     fscacheclient = None
+    lazy_hydration = None
+
+    # The only client commands that go through the interception pipeline. Everything else is forwarded as-is.
+    INTERCEPTED_SMB2_COMMANDS = frozenset([
+        SMB2_COM_CREATE,
+        SMB2_COM_QUERY_DIRECTORY,
+        SMB2_COM_TREE_CONNECT,
+        SMB2_COM_SET_INFO,
+        SMB2_COM_CLOSE,
+    ])
+
+    # The only server responses that update the connection state
+    INTERCEPTED_SMB2_RESPONSES = frozenset([
+        SMB2_COM_CREATE,
+        SMB2_COM_TREE_CONNECT,
+    ])
 
     def __init__(self):
         self.log = None
 
-        self.data_buf = ''
-        self.response_data_buf = ''
+        self.data_buf = NMBReceiveBuffer()
+        self.response_data_buf = NMBReceiveBuffer()
 
         self.stats_client = StatsdClient.get()
 
@@ -112,16 +294,24 @@ class ProxyServerProtocol(protocol.Protocol):
         # Manually bind a reaction to the data that comes from the server
         self.srv_queue.get().addCallback(self.clientDataReceived)
 
-        # The list of NMB packets from the client waiting to be processed
-        self.client_pending_packets_queue = defer.DeferredQueue()
-        self.client_pending_packets_queue_len = 0
-        self.client_pending_packets_queue.get().addCallback(self.process_client_pending_packet)
+        # Flow control of the data from the client (waiting in the packet scheduler and cli_queue), and of the data
+        # from the server (waiting in server_pending_packets_queue)
+        self.client_flow = FlowController('client')
+        self.server_flow = FlowController('server')
+
+        # The NMB packets from the client waiting to be processed. Packets are processed concurrently, unless they
+        # depend on each other.
+        self.client_packet_scheduler = PacketScheduler(self.process_client_packet)
 
         # The list of NMB packets from the server waiting to be processed
         self.server_pending_packets_queue = defer.DeferredQueue()
         self.server_pending_packets_queue_len = 0
         self.server_pending_packets_queue.get().addCallback(self.process_server_pending_packet)
 
+        # The requests that got an interim response from us, by message id
+        self.async_requests = {}
+        self.next_async_id = 1
+
         # Whether a shutdown has been requested
         self.shutdown_requested = False
         self.shutdown_deferred = None
@@ -129,6 +319,10 @@ class ProxyServerProtocol(protocol.Protocol):
         # Misc counters
         self.total_processed_client_packets = 0
         self.total_processed_server_packets = 0
+        self.total_fast_path_client_packets = 0
+        self.total_fast_path_server_packets = 0
+        self.total_interim_responses = 0
+        self.total_skipped_sync_backs = 0
 
     #
     # Connectivity functions
@@ -137,13 +331,21 @@ class ProxyServerProtocol(protocol.Protocol):
         self.factory.clients.append(self)
 
         # Setup the forward connection
-        factory = ProxyClientFactory(self.srv_queue, self.cli_queue)
+        factory = ProxyClientFactory(self.srv_queue, self.cli_queue, self.client_flow, self.server_flow)
 #        self.remote_host = self.transport.getPeer().host
 
         self.settings = self.factory.settings
         self.remote_host = self.settings.REMOTE_SAMBA_HOST
         self.remote_port = self.settings.REMOTE_SAMBA_PORT
 
+        self.client_packet_scheduler.max_running = self.settings.MAX_CONCURRENT_PACKETS_PER_CONNECTION
+
+        for flow in (self.client_flow, self.server_flow):
+            flow.high_water_mark = self.settings.FLOW_CONTROL_HIGH_WATER_MARK
+            flow.low_water_mark = self.settings.FLOW_CONTROL_LOW_WATER_MARK
+        self.client_flow.set_producer(self.transport)
+        self.transport.registerProducer(self.server_flow, True)
+
         self.log = logger.logger.new(
             connection_id=str(uuid.uuid4()),
             peer=self.transport.getPeer().host
@@ -153,6 +355,7 @@ class ProxyServerProtocol(protocol.Protocol):
 
         # Initialize a FSCache for this client
         self.fscacheclient = self.factory.fscacheclient
+        self.lazy_hydration = self.fscacheclient.lazy_hydration
 
     def clientDataReceived(self, chunk):
         # log.msg("Server: writing %d bytes to original client" % len(chunk))
@@ -162,11 +365,10 @@ class ProxyServerProtocol(protocol.Protocol):
             self.transport.loseConnection()
             return
 
-        # Process the data
+        # Process the data. Complete packets get written to the client.
         self.feedDataResponse(chunk)
 
-        # Write data to the client, and listen for the next chunk
-        self.transport.write(chunk)
+        # Listen for the next chunk
         self.srv_queue.get().addCallback(self.clientDataReceived)
 
     def shutdown(self):
@@ -205,26 +407,46 @@ class ProxyServerProtocol(protocol.Protocol):
         else:
             return True
 
+    @property
+    def client_pending_packets_queue_len(self):
+        return len(self.client_packet_scheduler)
+
     #
     # NMB handling functions
     #
+    @staticmethod
+    def is_passthrough_packet(packet, intercepted_commands):
+        """Whether a packet can be forwarded without being decoded"""
+        command = peek_smb2_command(packet)
+        return command is not None and command not in intercepted_commands
+
     def feedData(self, data):
         """Decodes and processes forward-going data (from the client to the server)"""
-        self.data_buf = self.data_buf + data
+        self.data_buf.append(data)
 
         while True:
             data_nmb = DirectTCPSessionMessage()
-            length = data_nmb.decode(self.data_buf, 0)
+            # The raw chunks stay attached to the data_nmb packet, so we can forward them in a callback afterwards
+            length = data_nmb.decode_from_buffer(self.data_buf)
             if length == 0:
                 break
             elif length > 0:
-                # Save the raw_chunk in the data_nmb packet, so we can pass it in a callback afterwards
-                chunk = self.data_buf[:length]
-                self.data_buf = self.data_buf[length:]
-                data_nmb.raw_chunk = chunk
-
-                self.client_pending_packets_queue.put((data_nmb, datetime.utcnow()))
-                self.client_pending_packets_queue_len += 1
+                # Accounted for until it's written to samba
+                self.client_flow.queued(length)
+
+                if self.client_pending_packets_queue_len == 0 and \
+                        self.is_passthrough_packet(data_nmb, self.INTERCEPTED_SMB2_COMMANDS) and \
+                        self.get_held_read(data_nmb) is None:
+                    # Fast path: nothing is pending, and we don't need to look at this packet.
+                    # Forward it right away, ordering is preserved.
+                    self.track_passthrough_packet(data_nmb)
+                    self.cli_queue.put(data_nmb.raw_chunks)
+                    self.total_fast_path_client_packets += 1
+                    continue
+
+                data_nmb.reception_time = datetime.utcnow()
+                keys, barrier = self.get_packet_dependencies(data_nmb)
+                self.client_packet_scheduler.submit(data_nmb, keys, barrier)
                 # self._processNMBSessionPacket(self.data_nmb, self.onNMBSessionMessage)
             else:
                 raise NMBError
@@ -241,17 +463,25 @@ class ProxyServerProtocol(protocol.Protocol):
         :param data:
         :return:
         """
-        self.response_data_buf = self.response_data_buf + data
+        self.response_data_buf.append(data)
 
-        offset = 0
         while True:
             response_data_nmb = DirectTCPSessionMessage()
-            length = response_data_nmb.decode(self.response_data_buf, offset)
+            length = response_data_nmb.decode_from_buffer(self.response_data_buf)
             if length == 0:
                 break
             elif length > 0:
                 # log.msg("Found response NMB packet of length %d" % length)
-                offset += length
+                if self.server_pending_packets_queue_len == 0 and \
+                        self.is_passthrough_packet(response_data_nmb, self.INTERCEPTED_SMB2_RESPONSES) and \
+                        not self.is_async_response(response_data_nmb):
+                    # Fast path: this response doesn't change our state, no need to decode it.
+                    self.transport.writeSequence(response_data_nmb.raw_chunks)
+                    self.total_fast_path_server_packets += 1
+                    continue
+
+                # Accounted for until it's written to the client
+                self.server_flow.queued(length)
                 self.server_pending_packets_queue.put((response_data_nmb, datetime.utcnow()))
                 self.server_pending_packets_queue_len += 1
                 # self._processNMBSessionPacket(self.response_data_nmb, self.onNMBSessionMessageResponse)
@@ -264,14 +494,172 @@ class ProxyServerProtocol(protocol.Protocol):
                 logger.WARN
             )
 
-        if offset > 0:
-            self.response_data_buf = self.response_data_buf[offset:]
+    def is_async_response(self, packet):
+        """Whether a response is to a request we sent an interim response for: it must be rewritten"""
+        return bool(self.async_requests) and peek_smb2_message_id(packet) in self.async_requests
+
+    def track_passthrough_packet(self, packet):
+        """Records what a packet forwarded without being decoded does to the open files"""
+        if peek_smb2_command(packet) != SMB2_COM_WRITE:
+            return
+
+        try:
+            body = SMB2_WRITE_REQUEST.unpack(
+                peek_packet(packet, SMB2_WRITE_PEEK_SIZE), SMB2_HEADER_PEEK_OFFSET + SMB2_HEADER_SIZE
+            )
+        except Exception:
+            self.log.msg("Couldn't decode a WRITE request: %s" % traceback.format_exc(), level=logger.WARN)
+            return
+
+        self.record_write(body)
+
+    def get_held_read(self, packet):
+        """
+        Finds out whether a packet is a READ request that must wait for the content of a lazily hydrated file.
+        :return: (share, filename, SMB2_READ_REQUEST body) if it must, None otherwise
+        """
+        if self.lazy_hydration is None or not self.lazy_hydration.lazy_files:
+            return None
+
+        if peek_smb2_command(packet) != SMB2_COM_READ:
+            return None
+
+        try:
+            body = SMB2_READ_REQUEST.unpack(
+                peek_packet(packet, SMB2_READ_PEEK_SIZE), SMB2_HEADER_PEEK_OFFSET + SMB2_HEADER_SIZE
+            )
+        except Exception:
+            self.log.msg("Couldn't decode a READ request: %s" % traceback.format_exc(), level=logger.WARN)
+            return None
+
+        open_file = self.open_files.get(body.file_id)
+        if open_file is None or not open_file.get('share'):
+            return None
+
+        if not self.lazy_hydration.is_missing(open_file['share'], open_file['filename'], body.offset, body.length):
+            return None
+
+        return open_file['share'], open_file['filename'], body
+
+    def record_write(self, body):
+        """
+        :param body: the SMB2_WRITE_REQUEST body of a WRITE request
+        """
+        if body.file_id == SMB2_RELATED_FILE_ID:
+            # In a compound request, after the CREATE of the file
+            open_file = self.get_latest_open_request()
+        else:
+            open_file = self.open_files.get(body.file_id)
+
+        if open_file is not None:
+            open_file['writes'] += 1
+            open_file['dirty_ranges'].add(body.offset, body.offset + body.length)
+
+    def get_latest_open_request(self):
+        """Returns the open file (or file open request) of the latest CREATE, or None"""
+        filename = self.session_latest_create_request_filename
+        for open_requests in (self.file_open_requests, self.open_files):
+            for open_file in open_requests.values():
+                if open_file['filename'] == filename:
+                    return open_file
+        return None
+
+    def get_packet_dependencies(self, packet):
+        """
+        Lists the resources that a client packet works on: it will only be processed once the packets that came before
+        it and work on the same resources are done.
+        :param packet: a NMB packet
+        :return: (keys of the resources, whether the packet is a barrier that must be processed alone)
+        """
+        try:
+            command = peek_smb2_command(packet)
+
+            if command is None:
+                # SMB1 or compound request. Decode the whole packet.
+                data = packet.data
+                if data[:4] != '\xFESMB':
+                    return [], True
+            elif command == SMB2_COM_CREATE:
+                # We need the filename
+                data = packet.data
+            else:
+                data = memoryview(peek_packet(packet, SMB2_DEPENDENCIES_PEEK_SIZE))[SMB2_HEADER_PEEK_OFFSET:]
+
+            keys = []
+            barrier = False
+            while True:
+                _, smb_message = self.peekSMB2MessageType(data)
+                message_keys, message_barrier = self.get_message_dependencies(smb_message)
+                keys.extend(message_keys)
+                barrier = barrier or message_barrier
+
+                if smb_message.next_command_offset > 0:
+                    data = data[smb_message.next_command_offset:]
+                else:
+                    break
+
+            return keys, barrier
+        except Exception:
+            self.log.msg("Couldn't compute the dependencies of a client packet: %s" % traceback.format_exc(),
+                         level=logger.WARN)
+            return [], True
+
+    def get_message_dependencies(self, message):
+        """
+        Lists the resources that a SMB2 message works on.
+        :param message: a SMB2Message
+        :return: (keys of the resources, whether the message is a barrier)
+        """
+        if message.command in SMB2_BARRIER_COMMANDS:
+            return [], True
+
+        # A CANCEL has the message id of the request it cancels
+        keys = [('mid', message.mid)]
+
+        if message.command == SMB2_COM_CREATE:
+            body = SMB2_CREATE_REQUEST.unpack(message.data)
+            filename = message.raw_data[body.name_offset:body.name_offset+body.name_length].tobytes()\
+                .decode('UTF-16LE')
+            keys.append(('path', message.tid, filename.lower()))
+
+        elif message.command in SMB2_FILE_ID_OFFSETS:
+            offset = SMB2_FILE_ID_OFFSETS[message.command]
+            file_id = message.data[offset:offset+SMB2_FILE_ID_SIZE].tobytes()
+
+            if file_id != SMB2_RELATED_FILE_ID:
+                keys.append(('fid', file_id))
+
+                # A CLOSE can sync back the file. New opens of that file need to wait for it.
+                if message.command == SMB2_COM_CLOSE and file_id in self.open_files:
+                    keys.append(('path', message.tid, self.open_files[file_id]['filename'].lower()))
+
+        return keys, False
+
+    def process_client_packet(self, packet):
+        """Process a SMB packet coming from the client. Returns a Deferred that fires once it has been forwarded"""
+        if self.is_passthrough_packet(packet, self.INTERCEPTED_SMB2_COMMANDS):
+            held_read = self.get_held_read(packet)
+            if held_read is not None:
+                return self.process_held_read(packet, *held_read)
+
+            self.track_passthrough_packet(packet)
+            self.cli_queue.put(packet.raw_chunks)
+            self.total_fast_path_client_packets += 1
+            return None
+
+        return self.process_client_pending_packet(packet, packet.reception_time)
 
     @defer.inlineCallbacks
-    def process_client_pending_packet(self, arg):
+    def process_client_pending_packet(self, packet, packet_reception_time):
         """Process a SMB packet coming from the client"""
-        packet, packet_reception_time = arg
-        chunk = packet.raw_chunk
+        chunk = packet.raw_chunks
+
+        # If importing the file takes long, tell the client to keep waiting
+        interim_response_call = None
+        if self.settings.INTERIM_RESPONSE_DELAY > 0 and peek_smb2_command(packet) == SMB2_COM_CREATE:
+            interim_response_call = reactor.callLater(
+                self.settings.INTERIM_RESPONSE_DELAY, self.send_interim_response, packet
+            )
 
         try:
             if packet.type == SESSION_MESSAGE:
@@ -281,6 +669,9 @@ class ProxyServerProtocol(protocol.Protocol):
         except Exception:
             self.log.msg("Couldn't process client packet: %s" % traceback.format_exc(), level=logger.WARN)
 
+        if interim_response_call is not None and interim_response_call.active():
+            interim_response_call.cancel()
+
         packet_processing_time = (datetime.utcnow() - packet_reception_time).total_seconds()*1000
         self.stats_client.incr('packet.inbound.count')
         self.stats_client.timing('packet.inbound.processing_time', int(packet_processing_time))
@@ -288,10 +679,34 @@ class ProxyServerProtocol(protocol.Protocol):
         # Pass the data to the real server
         self.cli_queue.put(chunk)
 
-        # Mark the packet as processed, and schedule a callback for the next packet
+        # Mark the packet as processed
+        self.total_processed_client_packets += 1
+
+    @defer.inlineCallbacks
+    def process_held_read(self, packet, share, filename, body):
+        """Forwards a READ request once the range it reads has been fetched"""
+        chunks = packet.raw_chunks
+
+        interim_response_call = None
+        if self.settings.INTERIM_RESPONSE_DELAY > 0:
+            interim_response_call = reactor.callLater(
+                self.settings.INTERIM_RESPONSE_DELAY, self.send_interim_response, packet
+            )
+
+        try:
+            yield self.lazy_hydration.wait_range(share, filename, body.offset, body.length)
+        except Exception:
+            self.log.msg('Error: could not fetch %d bytes at %d of %s: %s' % (
+                body.length, body.offset, filename, traceback.format_exc()), level=logger.ERROR)
+            self.stats_client.incr('lazy_hydration.failed_reads')
+            # Samba mustn't read the placeholder: make the READ fail instead
+            chunks = replace_file_id(packet, SMB2_COM_READ, SMB2_INVALID_FILE_ID)
+
+        if interim_response_call is not None and interim_response_call.active():
+            interim_response_call.cancel()
+
+        self.cli_queue.put(chunks)
         self.total_processed_client_packets += 1
-        self.client_pending_packets_queue_len -= 1
-        self.client_pending_packets_queue.get().addCallback(self.process_client_pending_packet)
 
     def process_server_pending_packet(self, arg):
         """Process a SMB packet coming from the server"""
@@ -301,6 +716,10 @@ class ProxyServerProtocol(protocol.Protocol):
         except Exception:
             self.log.msg("Couldn't process server packet: %s" % traceback.format_exc(), level=logger.WARN)
 
+        # Pass the data to the client
+        self.forward_server_packet(packet)
+        self.server_flow.dequeued(sum(len(c) for c in packet.raw_chunks))
+
         packet_processing_time = (datetime.utcnow() - packet_reception_time).total_seconds()*1000
         self.stats_client.incr('packet.outbound.count')
         self.stats_client.timing('packet.outbound.processing_time', int(packet_processing_time))
@@ -309,6 +728,70 @@ class ProxyServerProtocol(protocol.Protocol):
         self.server_pending_packets_queue_len -= 1
         self.server_pending_packets_queue.get().addCallback(self.process_server_pending_packet)
 
+    def send_interim_response(self, packet):
+        """Sends an interim response to a client request that's still being processed"""
+        try:
+            _, request = self.peekSMB2MessageType(packet.data)
+        except Exception:
+            self.log.msg("Couldn't decode request for interim response: %s" % traceback.format_exc(),
+                         level=logger.WARN)
+            return
+
+        if request.flags & SMB2_FLAGS_SIGNED:
+            # The final response couldn't be rewritten to the async form without breaking its signature: the client
+            # would get an async interim response, then a sync final one. It has to wait without an interim response.
+            return
+
+        async_id = self.next_async_id
+        self.next_async_id += 1
+        self.async_requests[request.mid] = {
+            'async_id': async_id,
+            'extra_credits': 0,
+        }
+
+        if self.settings.LOG_SMB2_PACKETS:
+            self.log.msg('Sending interim response for packet %d' % request.mid, level=logger.DEBUG)
+
+        self.transport.write(build_interim_response(request, async_id))
+        self.total_interim_responses += 1
+        self.stats_client.incr('packet.interim_responses')
+
+    def forward_server_packet(self, packet):
+        """Writes a SMB packet coming from the server to the client"""
+        if self.async_requests:
+            try:
+                data = self.get_async_response(packet)
+            except Exception:
+                self.log.msg("Couldn't rewrite async response: %s" % traceback.format_exc(), level=logger.WARN)
+                data = packet.raw_chunks
+
+            if data is not None:
+                self.transport.writeSequence(data)
+        else:
+            self.transport.writeSequence(packet.raw_chunks)
+
+    def get_async_response(self, packet):
+        """
+        Adapts a response to a request we sent an interim response for.
+        :return: the chunks to send to the client, or None if the response must not be sent
+        """
+        if packet.type != SESSION_MESSAGE or peek_smb2_command(packet) is None:
+            return packet.raw_chunks
+
+        _, response = self.peekSMB2MessageType(packet.data)
+        async_request = self.async_requests.get(response.mid)
+        if async_request is None:
+            return packet.raw_chunks
+
+        if is_interim_response(response):
+            # The client already has our interim response, and the AsyncId it knows is ours. Keep the credits
+            # granted by Samba for the final response.
+            async_request['extra_credits'] += response.credit_re
+            return None
+
+        del self.async_requests[response.mid]
+        return [make_async_response(packet.data, async_request['async_id'], async_request['extra_credits'])]
+
     def _processNMBSessionPacket(self, packet, callback):
         # log.msg('Got NMB packet. Passing to %s' % callback)
         if packet.type == SESSION_MESSAGE:
@@ -434,375 +917,334 @@ class ProxyServerProtocol(protocol.Protocol):
     def peekSMB2MessageType(self, buf):
         """Decodes a SMB2 message.
         Returns (length_of_message_processed, smb_message)"""
+        return parse_smb2_message(buf)
 
-        smb_message = SMB2Message()
+    def _updateState_SMB2(self, message):
+        """React to a SMB2 packet coming from the client.
+        Returns either True, or a deferred that fires when the action has been processed."""
+        if self.settings.LOG_SMB2_PACKETS and message.command != SMB2_COM_READ and message.command != SMB2_COM_WRITE:
+            self.log.msg(
+                'Processing SMB2 packet %d. Command: %s' % (message.mid, SMB2_COMMAND_NAMES[message.command]),
+                level=logger.DEBUG
+            )
 
-        HEADER_STRUCT_FORMAT = '<4sHHIHHI'
-        HEADER_STRUCT_SIZE = struct.calcsize(HEADER_STRUCT_FORMAT)
-        HEADER_SIZE = 64
-        ASYNC_HEADER_STRUCT_FORMAT = '<IQQQ16s'
-        ASYNC_HEADER_STRUCT_SIZE = struct.calcsize(ASYNC_HEADER_STRUCT_FORMAT)
-        SYNC_HEADER_STRUCT_FORMAT = '<IQIIQ16s'
-        SYNC_HEADER_STRUCT_SIZE = struct.calcsize(SYNC_HEADER_STRUCT_FORMAT)
+        return SMB2_REQUEST_HANDLERS.dispatch(self, message)
 
-        buf_len = len(buf)
-        if buf_len < 64:
-            raise ProtocolError('Not enough data to decode SMB2 header', buf)
+    @SMB2_REQUEST_HANDLERS.handler(SMB2_COM_CREATE, SMB2_CREATE_REQUEST)
+    def on_create_request(self, message, body):
+        # print 'This is a create operation. Extracting filename...'
 
-        protocol, struct_size, smb_message.credit_charge, smb_message.status, smb_message.command,\
-            smb_message.credit_re, smb_message.flags = struct.unpack(HEADER_STRUCT_FORMAT, buf[:HEADER_STRUCT_SIZE])
+        request_share = self.check_message_tid(message)
+        if request_share is None:
+            return True
 
-        if protocol != '\xFESMB':
-            raise ProtocolError('Invalid 4-byte SMB2 protocol field', buf)
+        access_mask = body.desired_access
+        create_options = body.create_options
+
+        # Whether there will be writes on this file.
+        do_write = False
+
+        # Whether the file will be deleted on close.
+        do_delete = False
+
+        if self.settings.LOG_SMB2_PACKETS:
+            self.log.msg("Requested access level is: %s" % repr(access_mask), level=logger.DEBUG)
+        if self.settings.DEBUG_OUTPUT:
+            enabled_access_level = []
+            for opt in SMB_ACCESS_MASK_NAMES:
+                if access_mask & opt:
+                    enabled_access_level.append(SMB_ACCESS_MASK_NAMES[opt])
+
+            self.log.msg("Requested access level: %s" % ("|".join(enabled_access_level)), level=logger.DEBUG)
+
+        if access_mask & FILE_WRITE_DATA or \
+                access_mask & FILE_APPEND_DATA or \
+                access_mask & FILE_WRITE_ATTRIBUTES or \
+                access_mask & MAXIMUM_ALLOWED or \
+                access_mask & GENERIC_ALL or \
+                access_mask & GENERIC_WRITE:
+            do_write = True
+
+        if self.settings.LOG_SMB2_PACKETS:
+            self.log.msg("Create options are: %s" % repr(create_options), level=logger.DEBUG)
+        if self.settings.DEBUG_OUTPUT:
+            enabled_create_options = []
+            for opt in SMB_CREATE_OPTION_NAMES:
+                if create_options & opt:
+                    enabled_create_options.append(SMB_CREATE_OPTION_NAMES[opt])
+
+            self.log.msg("Requested create_options: %s" % ("|".join(enabled_create_options)), level=logger.DEBUG)
+
+        if create_options & FILE_DELETE_ON_CLOSE:
+            do_delete = True
+
+        filename = message.raw_data[body.name_offset:body.name_offset+body.name_length].tobytes().decode('UTF-16LE')
+        # print 'Filename requested is "%s"' % (filename)
+        # print 'mid=%d, tid=%d' % (message.mid, message.tid)
+
+        # Parse the create context
+        if self.settings.DEBUG_OUTPUT:
+            if body.create_contexts_offset != 0:
+                self.log.msg('Found CreateContext')
+                create_context_data = message.raw_data[
+                    body.create_contexts_offset:body.create_contexts_offset+body.create_contexts_length
+                ]
 
-        if struct_size != HEADER_SIZE:
-            raise ProtocolError('Invalid SMB2 header structure size')
+                create_context_messages = []
 
-        isAsync = bool(smb_message.flags & SMB2_FLAGS_ASYNC_COMMAND)
+                while True:
+                    context = SMB2_CREATE_CONTEXT.unpack(create_context_data)
 
-        if isAsync:
-            if buf_len < HEADER_STRUCT_SIZE+ASYNC_HEADER_STRUCT_SIZE:
-                raise ProtocolError('Not enough data to decode SMB2 header', buf)
+                    name = create_context_data[context.name_offset:context.name_offset+context.name_length].tobytes()
 
-            smb_message.next_command_offset, smb_message.mid, smb_message.async_id, smb_message.session_id, \
-                smb_message.signature = \
-                struct.unpack(
-                    ASYNC_HEADER_STRUCT_FORMAT,
-                    buf[HEADER_STRUCT_SIZE:HEADER_STRUCT_SIZE+ASYNC_HEADER_STRUCT_SIZE]
-                )
-        else:
-            if buf_len < HEADER_STRUCT_SIZE+SYNC_HEADER_STRUCT_SIZE:
-                raise ProtocolError('Not enough data to decode SMB2 header', buf)
-            smb_message.next_command_offset, smb_message.mid, smb_message.pid, smb_message.tid, smb_message.session_id,\
-                smb_message.signature = \
-                struct.unpack(
-                    SYNC_HEADER_STRUCT_FORMAT,
-                    buf[HEADER_STRUCT_SIZE:HEADER_STRUCT_SIZE+SYNC_HEADER_STRUCT_SIZE]
-                )
+                    if context.data_offset != 0 and context.data_length > 0:
+                        data = create_context_data[context.data_offset:context.data_offset+context.data_length]\
+                            .tobytes()
+                    else:
+                        data = None
 
-        if smb_message.next_command_offset > 0:
-            smb_message.raw_data = buf[:smb_message.next_command_offset]
-            smb_message.data = buf[HEADER_SIZE:smb_message.next_command_offset]
-        else:
-            smb_message.raw_data = buf
-            smb_message.data = buf[HEADER_SIZE:]
+                    create_context_messages.append((name, data))
+                    if context.next == 0:
+                        break
+                    else:
+                        create_context_data = create_context_data[context.next:]
 
-        return len(smb_message.raw_data), smb_message
+                self.log.msg(repr(create_context_messages))
 
-    def _updateState_SMB2(self, message):
-        """React to a SMB2 packet coming from the client.
-        Returns either True, or a deferred that fires when the action has been processed."""
-        if self.settings.LOG_SMB2_PACKETS and message.command != SMB2_COM_READ and message.command != SMB2_COM_WRITE:
-            self.log.msg(
-                'Processing SMB2 packet %d. Command: %s' % (message.mid, SMB2_COMMAND_NAMES[message.command]),
-                level=logger.DEBUG
+        open_stat = []
+        if request_share is not False:
+            d = self.syncFile(
+                request_share, filename,
+                fetch_content=create_needs_content(body.create_disposition, access_mask),
+                lazy=not do_write,
             )
 
-        if message.command == SMB2_COM_CREATE:
-            # print 'This is a create operation. Extracting filename...'
+            def log_error(error):
+                self.log.msg(error, level=logger.ERROR)
+            d.addErrback(log_error)
 
-            request_share = self.check_message_tid(message)
-            if request_share is not None:
-                HEADER_SIZE = 64
-                STRUCTURE_FORMAT = '<HBBIQQIIIIIHHII'
-                STRUCTURE_SIZE = struct.calcsize(STRUCTURE_FORMAT)
+            if do_write:
+                d.addCallback(lambda x: self.touch_file(request_share, filename))
+                d.addErrback(log_error)
 
-                structure_size, security_flag, oplock, impersonation, smb_create_flags, reserved, access_mask, \
-                    file_attributes, share_access, create_disp, create_options, name_offset, \
-                    name_length, create_context_offset, create_context_length \
-                    = struct.unpack(STRUCTURE_FORMAT, message.data[:STRUCTURE_SIZE])
+                # On CLOSE, tells whether the file was modified through this handle
+                d.addCallback(lambda x: self.local_file_stat(request_share, filename))
+                d.addCallback(open_stat.append)
+                d.addErrback(log_error)
 
-                # Whether there will be writes on this file.
-                do_write = False
+        else:
+            self.log.msg(
+                'Error: Could not intercept request for file %s (message id: %s), request_share unknown.' % (
+                    filename, repr(message.mid)
+                ),
+                level=logger.ERROR
+            )
+            d = defer.succeed(None)
 
-                # Whether the file will be deleted on close.
-                do_delete = False
+        def register_open_request(_):
+            if message.mid in self.file_open_requests:
+                self.log.msg(
+                    'Message id reuse (%s) in file_open_requests. This should not be happening' % repr(message.mid),
+                    level=logger.ERROR
+                )
 
-                if self.settings.LOG_SMB2_PACKETS:
-                    self.log.msg("Requested access level is: %s" % repr(access_mask), level=logger.DEBUG)
-                if self.settings.DEBUG_OUTPUT:
-                    enabled_access_level = []
-                    for opt in SMB_ACCESS_MASK_NAMES:
-                        if access_mask & opt:
-                            enabled_access_level.append(SMB_ACCESS_MASK_NAMES[opt])
-
-                    self.log.msg("Requested access level: %s" % ("|".join(enabled_access_level)), level=logger.DEBUG)
-
-                if access_mask & FILE_WRITE_DATA or \
-                        access_mask & FILE_APPEND_DATA or \
-                        access_mask & FILE_WRITE_ATTRIBUTES or \
-                        access_mask & MAXIMUM_ALLOWED or \
-                        access_mask & GENERIC_ALL or \
-                        access_mask & GENERIC_WRITE:
-                    do_write = True
-
-                if self.settings.LOG_SMB2_PACKETS:
-                    self.log.msg("Create options are: %s" % repr(create_options), level=logger.DEBUG)
-                if self.settings.DEBUG_OUTPUT:
-                    enabled_create_options = []
-                    for opt in SMB_CREATE_OPTION_NAMES:
-                        if create_options & opt:
-                            enabled_create_options.append(SMB_CREATE_OPTION_NAMES[opt])
+            self.file_open_requests[message.mid] = {
+                'share': request_share,
+                'filename': filename,
+                'do_write': do_write,
+                'do_delete': do_delete,
+                # The size and mtime of the local file when it was opened. Unless it had been modified and not written
+                # back yet, those of the version of the fileserver it was imported from.
+                'open_stat': open_stat[0] if open_stat else None,
+                # The WRITE and size changing SET_INFO requests received on the handle
+                'writes': 0,
+                'size_changes': 0,
+                # The ranges written through the handle. If full_write, the whole content is replaced.
+                'dirty_ranges': IntervalSet(),
+                'full_write': body.create_disposition in CONTENT_DISCARDING_CREATE_DISPOSITIONS,
+            }
+
+            self.session_latest_create_request_filename = filename
+
+        d.addCallback(register_open_request)
 
-                    self.log.msg("Requested create_options: %s" % ("|".join(enabled_create_options)), level=logger.DEBUG)
+        return d
 
-                if create_options & FILE_DELETE_ON_CLOSE:
-                    do_delete = True
+    @SMB2_REQUEST_HANDLERS.handler(SMB2_COM_QUERY_DIRECTORY, SMB2_QUERY_DIRECTORY_REQUEST)
+    def on_query_directory_request(self, message, body):
+        request_share = self.check_message_tid(message)
+        if request_share is None:
+            return True
 
-                filename = message.raw_data[name_offset:name_offset+name_length].decode('UTF-16LE')
-                # print 'Filename requested is "%s"' % (filename)
-                # print 'mid=%d, tid=%d' % (message.mid, message.tid)
+        search_pattern = message.raw_data[body.file_name_offset:body.file_name_offset+body.file_name_length]\
+            .tobytes().decode('UTF-16LE')
 
-                # Parse the create context
+        if request_share is not False:
+            filename, _, _ = self.get_filename(body.file_id)
+            if filename is None:
+                self.log.msg(
+                    'Error: could not find the filename associated to handle %s' % repr(body.file_id),
+                    level=logger.ERROR
+                )
+            else:
                 if self.settings.DEBUG_OUTPUT:
-                    if create_context_offset != 0:
-                        self.log.msg('Found CreateContext')
-                        create_context_data = \
-                            message.raw_data[create_context_offset:create_context_offset+create_context_length]
-
-                        create_context_messages = []
+                    flags_str = '|'.join([
+                        SMB2_SMB2QueryDirectoryRequest_Flags_Values[v]
+                        for v in SMB2_SMB2QueryDirectoryRequest_Flags_Values.keys()
+                        if v & body.flags
+                    ])
 
-                        STRUCTURE_FORMAT = '<IBBBBI'
-                        STRUCTURE_SIZE = struct.calcsize(STRUCTURE_FORMAT)
+                    self.log.msg(
+                        'QueryDirectoryRequest: %s:%s %s %s "%s"' % (
+                            request_share,
+                            filename,
+                            SMB2_SMB2QueryDirectoryRequest_FileInformationClass_Values.get(
+                                body.file_information_class, 'UNKNOWN'
+                            ),
+                            flags_str,
+                            search_pattern,
+                        ),
+                        level=logger.INFO
+                    )
 
-                        while True:
-                            next, name_offset, name_length, reserved, data_offset, data_length = \
-                                struct.unpack(STRUCTURE_FORMAT, create_context_data[:STRUCTURE_SIZE])
+                d = self.listdir(request_share, filename)
+                d.addErrback(lambda x: self.log.msg(traceback.format_exc(x.value), level=logger.ERROR))
+                return d
 
-                            name = create_context_data[name_offset:name_offset+name_length]
+        return True
 
-                            if data_offset != 0 and data_length > 0:
-                                data = create_context_data[data_offset:data_offset+data_length]
-                            else:
-                                data = None
+    @SMB2_REQUEST_HANDLERS.handler(SMB2_COM_TREE_CONNECT, SMB2_TREE_CONNECT_REQUEST)
+    def on_tree_connect_request(self, message, body):
+        # print 'This is a tree_connect operation. Extracting requested host and share'
+        # print 'mid=%d, tid=%d' % (message.mid, message.tid)
+        path = message.raw_data[body.path_offset:body.path_offset+body.path_length].tobytes().decode('UTF-16LE')
+        # print 'Tree path requested is "%s"' % (path)
+        self.tree_connect_requests[message.mid] = {'path': path}
+        self.session_latest_tree_connect_path = path
 
-                            create_context_messages.append((name, data))
-                            if next == 0:
-                                break
-                            else:
-                                create_context_data = create_context_data[next:]
+        return True
 
-                        self.log.msg(repr(create_context_messages))
+    @SMB2_REQUEST_HANDLERS.handler(SMB2_COM_SET_INFO, SMB2_SET_INFO_REQUEST)
+    def on_set_info_request(self, message, body):
+        request_share = self.check_message_tid(message)
+        if request_share is None:
+            return True
 
-                if request_share is not False:
-                    d = self.syncFile(request_share, filename)
+        file_id = body.file_id
+        try:
+            filename = self.open_files[file_id]['filename']
+        except KeyError, e:
+            self.log.msg(traceback.format_exc(), level=logger.ERROR)
+            return True
 
-                    def log_error(error):
-                        self.log.msg(error, level=logger.ERROR)
-                    d.addErrback(log_error)
+        # self.log.msg(filename, level=logger.DEBUG)
+        # self.log.msg("Info_type: %d" % body.info_type, level=logger.DEBUG)
+        # self.log.msg("File_info_class: %d" % body.file_info_class, level=logger.DEBUG)
 
-                    if do_write:
-                        d.addCallback(lambda x: self.touch_file(request_share, filename))
-                        d.addErrback(log_error)
+        data = message.data[SMB2_SET_INFO_REQUEST.size:SMB2_SET_INFO_REQUEST.size + body.buffer_length]
+        # self.log.msg("Data length: %d" % len(data), level=logger.DEBUG)
 
+        if body.info_type == 1:
+            if body.file_info_class == 4:
+                pass
+                # self.log.msg("FileBasicInformation -> Not supported", level=logger.DEBUG)
+            elif body.file_info_class == 13:
+                # self.log.msg("FileDispositionInformation", level=logger.DEBUG)
+                buffer_format = "<B"
+                (do_delete,) = struct.unpack(buffer_format, data)
+                if do_delete == 1:
+                    # self.log.msg("Setting do_delete to 1 as requested by SET_INFO", level=logger.INFO)
+                    self.open_files[file_id]['do_delete'] = True
+                elif do_delete == 0:
+                    # self.log.msg("Setting do_delete to 0 as requested by SET_INFO", level=logger.INFO)
+                    self.open_files[file_id]['do_delete'] = False
                 else:
-                    self.log.msg(
-                        'Error: Could not intercept request for file %s (message id: %s), request_share unknown.' % (
-                            filename, repr(message.id)
-                        ),
-                        level=logger.ERROR
-                    )
-                    d = defer.succeed(None)
+                    self.log.msg("Unrecognized value for do_delete: %d" % do_delete, level=logger.INFO)
+            elif body.file_info_class in SIZE_CHANGING_FILE_INFO_CLASSES:
+                # The file may be truncated to the new size: what's after it must be written back
+                (new_size,) = struct.unpack_from('<Q', data)
+                self.open_files[file_id]['size_changes'] += 1
+                self.open_files[file_id]['dirty_ranges'].add(new_size, END_OF_FILE)
+            else:
+                pass
+                # self.log.msg("Unsupported FileInfoClass", level=logger.DEBUG)
 
-                def register_open_request(_):
-                    if message.mid in self.file_open_requests:
-                        self.log.msg(
-                            'Message id reuse (%s) in file_open_requests. This should not be happening' % repr(message.id),
-                            level=logger.ERROR
-                        )
+        return True
 
-                    self.file_open_requests[message.mid] = {
-                        'filename': filename,
-                        'do_write': do_write,
-                        'do_delete': do_delete,
-                    }
+    @SMB2_REQUEST_HANDLERS.handler(SMB2_COM_WRITE, SMB2_WRITE_REQUEST)
+    def on_write_request(self, message, body):
+        # Only the WRITEs of compound requests get here, the others are forwarded right away
+        self.record_write(body)
+        return True
 
-                    self.session_latest_create_request_filename = filename
+    @SMB2_REQUEST_HANDLERS.handler(SMB2_COM_READ, SMB2_READ_REQUEST)
+    def on_read_request(self, message, body):
+        # Only the READs of compound requests get here, the others are held in process_held_read if needed
+        if self.lazy_hydration is None or not self.lazy_hydration.lazy_files:
+            return True
 
-                d.addCallback(register_open_request)
+        request_share = self.check_message_tid(message)
+        if not request_share:
+            return True
 
-                return d
+        filename, _, _ = self.get_filename(body.file_id)
+        if filename is None:
+            return True
 
-        elif message.command == SMB2_COM_QUERY_DIRECTORY:
-            request_share = self.check_message_tid(message)
+        d = self.lazy_hydration.wait_range(request_share, filename, body.offset, body.length)
 
-            if request_share is not None:
+        def log_error(error):
+            self.log.msg('Error: could not fetch %d bytes at %d of %s: %s' % (
+                body.length, body.offset, filename, error.getErrorMessage()), level=logger.ERROR)
+            self.stats_client.incr('lazy_hydration.failed_reads')
+        d.addErrback(log_error)
 
-                STRUCTURE_FORMAT = '<HBBI16sHHI'
-                STRUCTURE_SIZE = struct.calcsize(STRUCTURE_FORMAT)
+        return d
 
-                structure_size, file_information_class, flags, file_index, file_id, \
-                    file_name_offset, file_name_length, output_buffer_length = \
-                    struct.unpack(STRUCTURE_FORMAT, message.data[:STRUCTURE_SIZE])
+    @SMB2_REQUEST_HANDLERS.handler(SMB2_COM_CLOSE, SMB2_CLOSE_REQUEST)
+    def on_close_request(self, message, body):
+        request_share = self.check_message_tid(message)
+        if request_share is None:
+            return True
 
-                # self.log.msg(repr((
-                #     structure_size, file_information_class, flags, file_index, file_id,
-                #     file_name_offset, file_name_length, output_buffer_length
-                # )))
+        file_id = body.file_id
+        try:
+            filename = self.open_files[file_id]['filename']
+            do_write = self.open_files[file_id]['do_write']
+            do_delete = self.open_files[file_id]['do_delete']
+        except KeyError, e:
+            self.log.msg(traceback.format_exc(), level=logger.ERROR)
+            filename = "_"
+            do_write = False
+            do_delete = False
 
-                search_pattern = message.raw_data[file_name_offset:file_name_offset+file_name_length].decode('UTF-16LE')
+        # self.log.msg("Closing file %s" % (filename,), level=logger.DEBUG)
 
-                # Handle the file_information_class
-                file_information_class_str = 'UNKNOWN'
-                for v in SMB2_SMB2QueryDirectoryRequest_FileInformationClass_Values.keys():
-                    if file_information_class == v:
-                        file_information_class_str = SMB2_SMB2QueryDirectoryRequest_FileInformationClass_Values[v]
-                        break
+        d = defer.succeed(None)
 
-                flags_ary = [
-                    SMB2_SMB2QueryDirectoryRequest_Flags_Values[v]
-                    for v in SMB2_SMB2QueryDirectoryRequest_Flags_Values.keys()
-                    if v & flags
-                ]
-                flags_str = '|'.join(flags_ary)
-
-                if request_share is not False:
-                    filename, _, _ = self.get_filename(file_id)
-                    if filename is None:
-                        self.log.msg(
-                            'Error: could not find the filename associated to handle %s' % repr(file_id),
-                            level=logger.ERROR
-                        )
-                    else:
-                        if self.settings.DEBUG_OUTPUT:
-                            self.log.msg(
-                                'QueryDirectoryRequest: %s:%s %s %s "%s"' % (
-                                    request_share,
-                                    filename,
-                                    file_information_class_str,
-                                    flags_str,
-                                    search_pattern,
-                                ),
-                                level=logger.INFO
-                            )
-
-                        d = self.listdir(request_share, filename)
-                        d.addErrback(lambda x: self.log.msg(traceback.format_exc(x.value), level=logger.ERROR))
-                        return d
-
-        elif message.command == SMB2_COM_TREE_CONNECT:
-            # print 'This is a tree_connect operation. Extracting requested host and share'
-            # print 'mid=%d, tid=%d' % (message.mid, message.tid)
-
-            HEADER_SIZE = 64
-            STRUCTURE_FORMAT = '<HHHH'
-            STRUCTURE_SIZE = struct.calcsize(STRUCTURE_FORMAT)
-
-            structure_size, reserved, path_offset, path_length = struct.unpack(STRUCTURE_FORMAT, message.data[:STRUCTURE_SIZE])
-
-            path = message.raw_data[path_offset:path_offset+path_length].decode('UTF-16LE')
-            # print 'Tree path requested is "%s"' % (path)
-            self.tree_connect_requests[message.mid] = {'path': path}
-            self.session_latest_tree_connect_path = path
-
-        # elif message.command == SMB2_COM_WRITE:
-        #     request_share = self.check_message_tid(message)
-        #     if request_share is not None:
-        #         STRUCTURE_FORMAT = "<HHIQ16sIIHHI"
-        #         STRUCTURE_SIZE = struct.calcsize(STRUCTURE_FORMAT)
-        #
-        #         structure_size, data_offset, data_length, write_offset, file_id, channel, \
-        #             remaining_bytes, write_channel_info_offset, write_channel_info_length, \
-        #             flags = struct.unpack(STRUCTURE_FORMAT, message.data[:STRUCTURE_SIZE])
-        #
-        #         try:
-        #             filename = self.open_files[file_id]['filename']
-        #         except KeyError, e:
-        #             self.log.msg(traceback.format_exc(), level=logger.ERROR)
-        #             filename = "_"
-
-        elif message.command == SMB2_COM_SET_INFO:
-            request_share = self.check_message_tid(message)
-            if request_share is not None:
-                STRUCTURE_FORMAT = "<HBBIHHI16s"
-                STRUCTURE_SIZE = struct.calcsize(STRUCTURE_FORMAT)
-
-                structure_size, info_type, file_info_class, buffer_length, buffer_offset, \
-                    _, additional_info, file_id = struct.unpack(STRUCTURE_FORMAT, message.data[:STRUCTURE_SIZE])
-
-                try:
-                    filename = self.open_files[file_id]['filename']
-                except KeyError, e:
-                    self.log.msg(traceback.format_exc(), level=logger.ERROR)
-                    filename = "_"
-                else:
-                    # self.log.msg(filename, level=logger.DEBUG)
-                    # self.log.msg("Info_type: %d" % info_type, level=logger.DEBUG)
-                    # self.log.msg("File_info_class: %d" % file_info_class, level=logger.DEBUG)
-
-                    data = message.data[STRUCTURE_SIZE:STRUCTURE_SIZE + buffer_length]
-                    # self.log.msg("Data length: %d" % len(data), level=logger.DEBUG)
-
-                    if info_type == 1:
-                        if file_info_class == 4:
-                            pass
-                            # self.log.msg("FileBasicInformation -> Not supported", level=logger.DEBUG)
-                        elif file_info_class == 13:
-                            # self.log.msg("FileDispositionInformation", level=logger.DEBUG)
-                            buffer_format = "<B"
-                            (do_delete,) = struct.unpack(buffer_format, data)
-                            if do_delete == 1:
-                                # self.log.msg("Setting do_delete to 1 as requested by SET_INFO", level=logger.INFO)
-                                self.open_files[file_id]['do_delete'] = True
-                            elif do_delete == 0:
-                                # self.log.msg("Setting do_delete to 0 as requested by SET_INFO", level=logger.INFO)
-                                self.open_files[file_id]['do_delete'] = False
-                            else:
-                                self.log.msg("Unrecognized value for do_delete: %d" % do_delete, level=logger.INFO)
-                        elif file_info_class == 20:
-                            pass
-                            # self.log.msg("FileEndOfFileInformation -> Uninteresting", level=logger.DEBUG)
-                        else:
-                            pass
-                            # self.log.msg("Unsupported FileInfoClass", level=logger.DEBUG)
-
-        elif message.command == SMB2_COM_CLOSE:
-            request_share = self.check_message_tid(message)
-            if request_share is not None:
-                STRUCTURE_FORMAT = "<HHI16s"
-                STRUCTURE_SIZE = struct.calcsize(STRUCTURE_FORMAT)
-
-                structure_size, flags, _, file_id = struct.unpack(STRUCTURE_FORMAT, message.data[:STRUCTURE_SIZE])
-
-                try:
-                    filename = self.open_files[file_id]['filename']
-                    do_write = self.open_files[file_id]['do_write']
-                    do_delete = self.open_files[file_id]['do_delete']
-                except KeyError, e:
-                    self.log.msg(traceback.format_exc(), level=logger.ERROR)
-                    filename = "_"
-                    do_write = False
-                    do_delete = False
-
-                # self.log.msg("Closing file %s" % (filename,), level=logger.DEBUG)
-
-                d = defer.succeed(None)
-
-                if do_write:
-                    # self.log.msg("Got do_write", level=logger.DEBUG)
-                    # Sync back the file
-                    d.addCallback(lambda x: self.sync_back_file(request_share, filename))
-                    d.addErrback(lambda x: self.log.msg(traceback.format_exc(x.value), level=logger.INFO))
-
-                if do_delete:
-                    # self.log.msg("Got do_delete", level=logger.DEBUG)
-                    # Delete the file
-                    d.addCallback(lambda x: self.delete_file(request_share, filename))
-                    d.addErrback(lambda x: self.log.msg(traceback.format_exc(x.value), level=logger.INFO))
-
-                def remove_handle_from_open_files(_):
-                    # Remove the handle from the list of open files.
-                    try:
-                        del self.open_files[file_id]
-                    except KeyError:
-                        pass
-
-                d.addCallback(remove_handle_from_open_files)
-                d.addBoth(self.tryShutdown)
+        if do_write:
+            # self.log.msg("Got do_write", level=logger.DEBUG)
+            # Sync back the file, if it was modified
+            d.addCallback(lambda x: self.sync_back_modified_file(request_share, file_id, filename))
+            d.addErrback(lambda x: self.log.msg(traceback.format_exc(x.value), level=logger.INFO))
 
-                return d
+        if do_delete:
+            # self.log.msg("Got do_delete", level=logger.DEBUG)
+            # Delete the file
+            d.addCallback(lambda x: self.delete_file(request_share, filename))
+            d.addErrback(lambda x: self.log.msg(traceback.format_exc(x.value), level=logger.INFO))
 
-        return True
+        def remove_handle_from_open_files(_):
+            # Remove the handle from the list of open files.
+            try:
+                del self.open_files[file_id]
+            except KeyError:
+                pass
+
+        d.addCallback(remove_handle_from_open_files)
+        d.addBoth(self.tryShutdown)
+
+        return d
 
     def _updateState_SMB2_Response(self, message):
         """React to a SMB2 message coming from the server"""
@@ -812,55 +1254,58 @@ class ProxyServerProtocol(protocol.Protocol):
                 level=logger.DEBUG
             )
 
-        if message.command == SMB2_COM_TREE_CONNECT:
-            # print 'This is the response to a tree_connect attempt'
-            # print 'mid=%d, tid=%d' % (message.mid, message.tid)
-            try:
-                self.connected_trees[message.tid] = self.tree_connect_requests[message.mid]
-                del self.tree_connect_requests[message.mid]
-            except Exception:
-                pass
+        return SMB2_RESPONSE_HANDLERS.dispatch(self, message)
 
-        elif message.command == SMB2_COM_CREATE:
-            request_share = self.check_message_tid(message)
-            if request_share is not None:
-                STRUCTURE_FORMAT = "<HBBIQQQQQQII16sII"
-                STRUCTURE_SIZE = struct.calcsize(STRUCTURE_FORMAT)
-
-                if message.status == 0:
-                    struct_size, oplock, _, create_action, \
-                    create_time, lastaccess_time, lastwrite_time, change_time, \
-                    allocation_size, file_size, file_attributes, \
-                    _, fid, _, _ = struct.unpack(STRUCTURE_FORMAT, message.data[:STRUCTURE_SIZE])
-
-                    try:
-                        self.open_files[fid] = self.file_open_requests[message.mid]
-                        self.open_files[fid]['open_datetime'] = datetime.utcnow().isoformat()
-                        # self.log.msg("Associating %s to file %s" %
-                        #             (repr(fid), self.open_files[fid]['filename'].encode('UTF-8')), level=logger.DEBUG)
-                        del self.file_open_requests[message.mid]
-                    except Exception, e:
-                        self.log.msg(traceback.format_exc(), level=logger.INFO)
-                        self.log.msg(
-                            "Warning: got SMB2_COM_CREATE response but could not map back to a requested filename.",
-                            level=logger.WARN)
+    @SMB2_RESPONSE_HANDLERS.handler(SMB2_COM_TREE_CONNECT)
+    def on_tree_connect_response(self, message, body):
+        # print 'This is the response to a tree_connect attempt'
+        # print 'mid=%d, tid=%d' % (message.mid, message.tid)
+        try:
+            self.connected_trees[message.tid] = self.tree_connect_requests[message.mid]
+            del self.tree_connect_requests[message.mid]
+        except Exception:
+            pass
 
-                else:
-                    if message.status in SMB2_NTSTATUS_ERRORS.keys():
-                        error_message = SMB2_NTSTATUS_ERRORS[message.status]
-                    else:
-                        error_message = "0x%08x" % message.status
+        return True
 
-                    # If the request failed, we still need to remove it from the list of pending requests
-                    if message.mid in self.file_open_requests:
-                        requested_filename = self.file_open_requests[message.mid]['filename']
-                        del self.file_open_requests[message.mid]
-                    else:
-                        requested_filename = None
-                    self.log.msg(
-                        "SMB2_COM_CREATE response with status %s. Ignoring." % error_message,
-                        requested_filename=requested_filename,
-                        level=logger.INFO)
+    @SMB2_RESPONSE_HANDLERS.handler(SMB2_COM_CREATE)
+    def on_create_response(self, message, body):
+        request_share = self.check_message_tid(message)
+        if request_share is None:
+            return True
+
+        if message.status == 0:
+            # Error responses have a different body: only decode it now
+            fid = SMB2_CREATE_RESPONSE.unpack(message.data).file_id
+
+            try:
+                self.open_files[fid] = self.file_open_requests[message.mid]
+                self.open_files[fid]['open_datetime'] = datetime.utcnow().isoformat()
+                # self.log.msg("Associating %s to file %s" %
+                #             (repr(fid), self.open_files[fid]['filename'].encode('UTF-8')), level=logger.DEBUG)
+                del self.file_open_requests[message.mid]
+            except Exception, e:
+                self.log.msg(traceback.format_exc(), level=logger.INFO)
+                self.log.msg(
+                    "Warning: got SMB2_COM_CREATE response but could not map back to a requested filename.",
+                    level=logger.WARN)
+
+        else:
+            if message.status in SMB2_NTSTATUS_ERRORS:
+                error_message = SMB2_NTSTATUS_ERRORS[message.status]
+            else:
+                error_message = "0x%08x" % message.status
+
+            # If the request failed, we still need to remove it from the list of pending requests
+            if message.mid in self.file_open_requests:
+                requested_filename = self.file_open_requests[message.mid]['filename']
+                del self.file_open_requests[message.mid]
+            else:
+                requested_filename = None
+            self.log.msg(
+                "SMB2_COM_CREATE response with status %s. Ignoring." % error_message,
+                requested_filename=requested_filename,
+                level=logger.INFO)
 
         return True
 
@@ -902,15 +1347,17 @@ class ProxyServerProtocol(protocol.Protocol):
 
         return v
 
-    def syncFile(self, full_share, path):
-        """Tells the backend to sync a file. Returns a deferred that fires when the action is done."""
+    def syncFile(self, full_share, path, fetch_content=True, lazy=False):
+        """Tells the backend to sync a file. Returns a deferred that fires when the action is done.
+        If fetch_content is False, the content of the file isn't downloaded (the file only needs to exist).
+        If lazy is True, the content can be fetched as it's read (the file is opened read-only)."""
         d = defer.succeed((full_share, path, self.log))
         if path == 'srvsvc':
             # Special case, we don't touch that
             return d
 
         def process(args):
-            return self.fscacheclient.sync(*args)
+            return self.fscacheclient.sync(*args, fetch_content=fetch_content, lazy=lazy)
 
         d.addCallback(process)
 
@@ -930,8 +1377,10 @@ class ProxyServerProtocol(protocol.Protocol):
 
         return d
 
-    def sync_back_file(self, full_share, path):
-        """Tells the backend to write back a file. Returns a deferred that fires when the action is done."""
+    def sync_back_file(self, full_share, path, dirty_ranges=None, base_version=None):
+        """Tells the backend to write back a file. Returns a deferred that fires when the action is done.
+        If dirty_ranges (an IntervalSet) is given, only these ranges of the file were modified, since the version of the
+        fileserver whose (size, mtime) is base_version."""
         d = defer.succeed((full_share, path, self.log))
         if not self.settings.ENABLE_WRITE_THROUGH:
             return d
@@ -940,11 +1389,44 @@ class ProxyServerProtocol(protocol.Protocol):
             return d
 
         def process(args):
-            return self.fscacheclient.sync_back(*args)
+            return self.fscacheclient.sync_back(*args, dirty_ranges=dirty_ranges, base_version=base_version)
         d.addCallback(process)
 
         return d
 
+    @defer.inlineCallbacks
+    def sync_back_modified_file(self, full_share, file_id, path):
+        """
+        Writes back a file closed by a handle that can write, unless the file wasn't modified through it.
+        Applications open files with MAXIMUM_ALLOWED just to read them.
+        """
+        open_file = self.open_files.get(file_id)
+        modified = True
+        # The only ranges to write back. None for the whole file.
+        dirty_ranges = None
+        # The version of the file on the fileserver these ranges apply to
+        base_version = None
+        if open_file is not None and open_file['writes'] == 0 and open_file['size_changes'] == 0:
+            # Catches the changes that don't go through WRITE requests (eg. server-side copies, overwriting CREATEs)
+            close_stat = yield self.local_file_stat(full_share, path)
+            modified = close_stat != open_file['open_stat']
+        elif open_file is not None and not open_file['full_write']:
+            dirty_ranges = open_file['dirty_ranges']
+            base_version = open_file['open_stat']
+
+        if modified:
+            yield self.sync_back_file(full_share, path, dirty_ranges, base_version)
+        else:
+            self.total_skipped_sync_backs += 1
+            self.stats_client.incr('action.SYNCBACK.skipped_unmodified')
+
+    def local_file_stat(self, full_share, path):
+        """Returns a deferred that fires with the (size, mtime) of the local version of a file, or None"""
+        if path == 'srvsvc':
+            return defer.succeed(None)
+
+        return self.fscacheclient.local_file_stat(full_share, path, self.log)
+
     def delete_file(self, full_share, path):
         """Tells the backend to delete a file. Returns a deferred that fires when the action is done."""
         d = defer.succeed((full_share, path, self.log))
@@ -1028,6 +1510,8 @@ class ProxyServerFactory(protocol.Factory):
 
         self.shutdown_requested = False
 
+        self.reactor_lag = ReactorLagMonitor()
+
     @defer.inlineCallbacks
     def shutdown(self):
         self.shutdown_requested = True
@@ -1085,7 +1569,13 @@ def init(
         fileserver_port,
         metadata_proxy_address,
         metadata_proxy_port,
-        settings):
+        settings,
+        inherited_fd=None):
+    """
+    Runs the proxy.
+    :param inherited_fd: the fd of an already listening socket to accept connections from (in supervisor mode, the
+    socket is shared by all the workers). If None, listens on listen_address:listen_port.
+    """
     # Initialize the caches
     fscache = FSCache(
         settings,
@@ -1099,7 +1589,10 @@ def init(
 
     # Initialize the proxy
     factory = ProxyServerFactory(fscache, fscacheclient, settings)
-    port = reactor.listenTCP(listen_port, factory, interface=listen_address)
+    if inherited_fd is not None:
+        port = reactor.adoptStreamPort(inherited_fd, socket.AF_INET, factory)
+    else:
+        port = reactor.listenTCP(listen_port, factory, interface=listen_address)
 
     # management_factory = ManagementInterfaceFactory(fscache, fscacheclient)
     # reactor.listenTCP(40445, management_factory, interface='0.0.0.0')
@@ -1122,6 +1615,9 @@ def init(
     )
     periodic_stats_dump.start(1)
 
+    factory.reactor_lag.start()
+    fscacheclient.start()
+
     reactor.run()
 
 
@@ -3,30 +3,118 @@
 # Copyright Luna Technology 2016
 # Matthieu Riviere <mriviere@luna-technology.com>
 
+import weakref
 
+from OpenSSL import SSL
+from OpenSSL._util import lib as _openssl_lib
 from twisted.internet import reactor
-from twisted.internet.ssl import Certificate, PrivateCertificate, optionsForClientTLS
+from twisted.internet._sslverify import ClientTLSOptions
+from twisted.internet.ssl import Certificate, CertificateOptions, PrivateCertificate
 from twisted.python.filepath import FilePath
 from twisted.web.client import Agent
 from twisted.web.client import BrowserLikePolicyForHTTPS, _requireSSL
 from twisted.web.client import HTTPConnectionPool
 
+from statsd_logging import StatsdClient
+
+
+# Telemetry counters, shared by all the pools and TLS connections of the process
+connection_stats = {
+    'requested': 0,
+    'created': 0,
+    'tls_handshakes': 0,
+    'tls_resumed_handshakes': 0,
+}
+
+
+def connection_reuse_rate():
+    """The proportion of HTTP requests that were sent on an already open connection"""
+    if connection_stats['requested'] == 0:
+        return 0.0
+    return 1.0 - float(connection_stats['created']) / connection_stats['requested']
+
+
+class SessionResumingClientTLSOptions(ClientTLSOptions):
+    """
+    ClientTLSOptions that offer the session of the last handshake to the new connections, so that the server can
+    resume it instead of doing a full handshake.
+    """
+
+    def __init__(self, hostname, ctx):
+        ClientTLSOptions.__init__(self, hostname, ctx)
+        self._last_connection = None
+        self._handshaking = weakref.WeakKeyDictionary()
+        self.stats_client = StatsdClient.get()
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        connection = ClientTLSOptions.clientConnectionForTLS(self, tlsProtocol)
+        if self._last_connection is not None:
+            # With TLS 1.3, the session tickets are sent after the handshake: only get the session now
+            connection.set_session(self._last_connection.get_session())
+        self._handshaking[connection] = True
+        return connection
+
+    def _identityVerifyingInfoCallback(self, connection, where, ret):
+        ClientTLSOptions._identityVerifyingInfoCallback(self, connection, where, ret)
+
+        if where & SSL.SSL_CB_HANDSHAKE_DONE:
+            self._last_connection = connection
+
+            if self._handshaking.pop(connection, None) is not None:
+                connection_stats['tls_handshakes'] += 1
+                if _openssl_lib.SSL_session_reused(connection._ssl):
+                    connection_stats['tls_resumed_handshakes'] += 1
+                    self.stats_client.incr('tls.handshakes.resumed')
+                else:
+                    self.stats_client.incr('tls.handshakes.full')
+
 
 class BrowserLikePolicyForHTTPSWithClientCertificate(BrowserLikePolicyForHTTPS):
     """Extend the default HTTPS certificate policy to send a given SSL certificate"""
     def __init__(self, trustRoot=None, clientCertificate=None):
         self._trustRoot = trustRoot
         self._clientCertificate = clientCertificate
+        self._creators = {}
 
     @_requireSSL
     def creatorForNetloc(self, hostname, port):
-        return optionsForClientTLS(
-            hostname.decode("ascii"),
-            trustRoot=self._trustRoot,
-            clientCertificate=self._clientCertificate)
+        # The creator (and its SSL context) is kept for each server, so that its TLS sessions can be resumed
+        creator = self._creators.get((hostname, port))
+        if creator is None:
+            certificate_options = CertificateOptions(
+                trustRoot=self._trustRoot,
+                privateKey=self._clientCertificate.privateKey.original,
+                certificate=self._clientCertificate.original)
+            creator = SessionResumingClientTLSOptions(hostname.decode("ascii"), certificate_options.getContext())
+            self._creators[(hostname, port)] = creator
+        return creator
+
+
+class MonitoredHTTPConnectionPool(HTTPConnectionPool):
+    """A HTTPConnectionPool that counts how many connections it has to open"""
+
+    def __init__(self, reactor, persistent=True):
+        HTTPConnectionPool.__init__(self, reactor, persistent)
+        self.stats_client = StatsdClient.get()
+
+    def getConnection(self, key, endpoint):
+        connection_stats['requested'] += 1
+        self.stats_client.incr('http.connections.requested')
+        return HTTPConnectionPool.getConnection(self, key, endpoint)
+
+    def _newConnection(self, key, endpoint):
+        connection_stats['created'] += 1
+        self.stats_client.incr('http.connections.created')
+        return HTTPConnectionPool._newConnection(self, key, endpoint)
+
+
+def create_pool(max_persistent_per_host=2):
+    pool = MonitoredHTTPConnectionPool(reactor, persistent=True)
+    pool.maxPersistentPerHost = max_persistent_per_host
+    return pool
 
 
-def create_agent(ca_cert, client_cert, client_key):
+def create_agent(ca_cert, client_cert, client_key, max_persistent_per_host=2):
     ca_certificate = Certificate.loadPEM(FilePath(ca_cert).getContent())
     client_certificate = PrivateCertificate.loadPEM(
         FilePath(client_cert).getContent() + b"\n" +
@@ -36,7 +124,7 @@ def create_agent(ca_cert, client_cert, client_key):
         trustRoot=ca_certificate,
         clientCertificate=client_certificate)
 
-    pool = HTTPConnectionPool(reactor, persistent=True)
+    pool = create_pool(max_persistent_per_host)
     agent = Agent(reactor, customPolicy, pool=pool)
 
     return agent
@@ -0,0 +1,226 @@
+# coding: utf-8
+
+# Copyright Luna Technology 2016
+# Matthieu Riviere <mriviere@luna-technology.com>
+
+"""
+Supervisor mode: runs several smbproxy worker processes that share the same listening socket.
+
+Each worker is a complete smbproxy (one reactor, one process), started with the listening socket as fd 3.
+A SMB connection stays in the worker that accepted it. File imports are coordinated between the workers through
+the local redis (see RedisSyncLocks).
+
+The supervisor has its own management socket (/tmp/smbproxy-<pid>.sock), like a single process smbproxy. STATS
+aggregates the stats of all the workers, SHUTDOWN shuts all of them down.
+"""
+
+import json
+import os
+import signal
+import socket
+import sys
+import traceback
+
+from twisted.internet import defer
+from twisted.internet import protocol
+from twisted.internet import reactor
+from twisted.internet.endpoints import UNIXClientEndpoint, connectProtocol
+from twisted.protocols.basic import LineReceiver
+
+import logger
+
+
+# The fd under which the workers get the listening socket
+WORKER_LISTEN_FD = 3
+
+# Delay (in seconds) before a worker that died gets restarted
+WORKER_RESTART_DELAY = 1
+
+
+def management_socket_path(pid):
+    return '/tmp/smbproxy-%d.sock' % pid
+
+
+class ManagementQueryProtocol(protocol.Protocol):
+    """Sends a command to the management socket of a worker, and collects the answer"""
+
+    def __init__(self, command):
+        self.command = command
+        self.data = []
+        self.finished = defer.Deferred()
+
+    def connectionMade(self):
+        self.transport.write(self.command + '\n')
+
+    def dataReceived(self, data):
+        self.data.append(data)
+
+    def connectionLost(self, reason):
+        self.finished.callback(''.join(self.data))
+
+
+def query_worker(pid, command):
+    """
+    :return: a Deferred that fires with the answer of the worker
+    """
+    query = ManagementQueryProtocol(command)
+    d = connectProtocol(UNIXClientEndpoint(reactor, management_socket_path(pid)), query)
+    d.addCallback(lambda _: query.finished)
+    return d
+
+
+class WorkerProcessProtocol(protocol.ProcessProtocol):
+    def __init__(self, supervisor):
+        self.supervisor = supervisor
+
+    def processEnded(self, reason):
+        self.supervisor.worker_ended(self, reason)
+
+
+class Supervisor(object):
+    def __init__(self, listen_address, listen_port, workers_count, worker_args):
+        """
+        :param workers_count: the number of workers to run
+        :param worker_args: the command line of a worker, without the listening fd option
+        """
+        self.listen_address = listen_address
+        self.listen_port = listen_port
+        self.workers_count = workers_count
+        self.worker_args = worker_args
+
+        self.log = logger.logger.new(supervisor_pid=os.getpid())
+
+        self.listen_socket = None
+        self.workers = {}
+        self.shutdown_requested = False
+        self.shutdown_deferred = defer.Deferred()
+
+    def start(self):
+        self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listen_socket.bind((self.listen_address, self.listen_port))
+        self.listen_socket.listen(socket.SOMAXCONN)
+        self.listen_socket.setblocking(False)
+
+        for _ in xrange(self.workers_count):
+            self.start_worker()
+
+    def start_worker(self):
+        if self.shutdown_requested:
+            return
+
+        process_protocol = WorkerProcessProtocol(self)
+        process = reactor.spawnProcess(
+            process_protocol,
+            sys.executable,
+            self.worker_args + ['--inherited-fd', str(WORKER_LISTEN_FD)],
+            env=os.environ,
+            childFDs={0: 0, 1: 1, 2: 2, WORKER_LISTEN_FD: self.listen_socket.fileno()},
+        )
+        self.workers[process_protocol] = process.pid
+        self.log.msg('Started worker %d' % process.pid, level=logger.INFO)
+
+    def worker_ended(self, process_protocol, reason):
+        pid = self.workers.pop(process_protocol, None)
+
+        if self.shutdown_requested:
+            if not self.workers and not self.shutdown_deferred.called:
+                self.shutdown_deferred.callback(None)
+            return
+
+        self.log.msg('Worker %s ended unexpectedly: %s' % (pid, reason.value), level=logger.ERROR)
+        reactor.callLater(WORKER_RESTART_DELAY, self.start_worker)
+
+    @property
+    def worker_pids(self):
+        return sorted(self.workers.values())
+
+    @defer.inlineCallbacks
+    def get_stats(self):
+        pids = self.worker_pids
+        results = yield defer.DeferredList([query_worker(pid, 'STATS') for pid in pids], consumeErrors=True)
+
+        output = dict()
+        output['Global'] = {
+            'pid': os.getpid(),
+            'listen_address': self.listen_address,
+            'listen_port': self.listen_port,
+            'shutdown_requested': self.shutdown_requested,
+            'workers': pids,
+        }
+        output['Workers'] = []
+        output['Client'] = []
+
+        for pid, (success, result) in zip(pids, results):
+            try:
+                if not success:
+                    result.raiseException()
+                worker_stats = json.loads(result)
+            except Exception:
+                self.log.msg("Couldn't get the stats of worker %d: %s" % (pid, traceback.format_exc()),
+                             level=logger.WARN)
+                continue
+
+            output['Workers'].append(worker_stats)
+            output['Client'].extend(worker_stats.get('Client', []))
+
+        defer.returnValue(output)
+
+    def shutdown(self):
+        if not self.shutdown_requested:
+            self.shutdown_requested = True
+
+            if not self.workers:
+                self.shutdown_deferred.callback(None)
+
+            for pid in self.worker_pids:
+                d = query_worker(pid, 'SHUTDOWN')
+                d.addErrback(lambda failure, pid=pid: self.log.msg(
+                    "Couldn't shut worker %d down: %s" % (pid, failure.getErrorMessage()), level=logger.WARN))
+
+        return self.shutdown_deferred
+
+    def kill_workers(self):
+        """Called when the reactor stops: don't leave orphan workers behind"""
+        for pid in self.worker_pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+
+class SupervisorManagementProtocol(LineReceiver):
+    """The management API of ManagementInterfaceProtocol, for all the workers"""
+
+    delimiter = '\n'
+
+    def lineReceived(self, line):
+        supervisor = self.factory.supervisor
+
+        if line == 'STATS':
+            supervisor.get_stats().addCallback(self.send_stats)
+        elif line == 'SHUTDOWN':
+            supervisor.shutdown().addCallback(lambda _: reactor.stop())
+            self.transport.write('OK')
+            self.transport.loseConnection()
+
+    def send_stats(self, stats):
+        self.transport.write(json.dumps(stats, indent=4))
+        self.transport.loseConnection()
+
+
+class SupervisorManagementFactory(protocol.Factory):
+    protocol = SupervisorManagementProtocol
+
+    def __init__(self, supervisor):
+        self.supervisor = supervisor
+
+
+def run_supervisor(listen_address, listen_port, workers_count, worker_args):
+    supervisor = Supervisor(listen_address, listen_port, workers_count, worker_args)
+    supervisor.start()
+
+    reactor.listenUNIX(management_socket_path(os.getpid()), SupervisorManagementFactory(supervisor))
+    reactor.addSystemEventTrigger('before', 'shutdown', supervisor.kill_workers)
+
+    reactor.run()
@@ -0,0 +1,89 @@
+# coding: utf-8
+
+# Copyright Luna Technology 2016
+# Matthieu Riviere <mriviere@luna-technology.com>
+
+import struct
+from unittest import TestCase
+
+from twisted.internet import defer
+
+from smb.smb_constants import *
+from smb.smb2_constants import SMB2_COM_CREATE
+from smbproxy4 import logger
+from smbproxy4 import settings
+from smbproxy4.interval_set import IntervalSet
+from smbproxy4.smbproxy4 import ProxyServerProtocol
+from test_fast_path import create_body
+
+
+def create_message(filename, desired_access, create_disposition, tid=1):
+    header = struct.pack(
+        '<4sHHIHHIIQIIQ16s',
+        '\xFESMB', 64, 1, 0, SMB2_COM_CREATE, 1, 0, 0, 1, 0, tid, 0, '\0' * 16
+    )
+    return memoryview(header + create_body(filename, desired_access, create_disposition))
+
+
+class TestCreateInterception(TestCase):
+    def setUp(self):
+        self.protocol = ProxyServerProtocol()
+        self.protocol.settings = settings
+        self.protocol.log = logger.logger.new()
+        self.protocol.connected_trees[1] = {'path': u'\\\\host\\share'}
+
+        self.syncs = []
+
+        def sync_file(full_share, path, fetch_content=True, lazy=False):
+            self.syncs.append((path, fetch_content, lazy))
+            return defer.succeed(None)
+        self.protocol.syncFile = sync_file
+        self.protocol.touch_file = lambda full_share, path: defer.succeed(None)
+        self.protocol.local_file_stat = lambda full_share, path: defer.succeed((1024, 1456000000.0))
+
+    def sync(self, desired_access, create_disposition):
+        del self.syncs[:]
+        _, message = self.protocol.peekSMB2MessageType(create_message(u'out\\frame.exr', desired_access,
+                                                                      create_disposition))
+        self.protocol._updateState_SMB2(message)
+        assert len(self.syncs) == 1
+        return self.syncs[0][1]
+
+    def test_open_fetches_content(self):
+        assert self.sync(FILE_READ_DATA, FILE_OPEN) is True
+        assert self.sync(GENERIC_READ | GENERIC_WRITE, FILE_OPEN_IF) is True
+
+    def test_overwrite_skips_content(self):
+        for disposition in (FILE_SUPERSEDE, FILE_CREATE, FILE_OVERWRITE, FILE_OVERWRITE_IF):
+            assert self.sync(GENERIC_WRITE, disposition) is False
+
+    def test_metadata_only_open_skips_content(self):
+        assert self.sync(FILE_READ_ATTRIBUTES | SYNCHRONIZE, FILE_OPEN) is False
+        assert self.sync(READ_CONTROL | FILE_READ_EA, FILE_OPEN) is False
+
+        # As soon as data can be read or written, the content is needed
+        assert self.sync(FILE_READ_ATTRIBUTES | FILE_READ_DATA, FILE_OPEN) is True
+        assert self.sync(FILE_READ_ATTRIBUTES | FILE_EXECUTE, FILE_OPEN) is True
+        assert self.sync(FILE_READ_ATTRIBUTES | FILE_WRITE_ATTRIBUTES, FILE_OPEN) is True
+        assert self.sync(GENERIC_READ, FILE_OPEN) is True
+        assert self.sync(MAXIMUM_ALLOWED, FILE_OPEN) is True
+
+    def test_read_only_open_is_lazy(self):
+        self.sync(FILE_READ_DATA, FILE_OPEN)
+        assert self.syncs[0][2] is True
+        self.sync(GENERIC_READ | GENERIC_WRITE, FILE_OPEN_IF)
+        assert self.syncs[0][2] is False
+
+    def test_file_open_request_is_registered(self):
+        self.sync(GENERIC_WRITE, FILE_OVERWRITE_IF)
+        assert self.protocol.file_open_requests[1] == {
+            'share': u'\\\\host\\share',
+            'filename': u'out\\frame.exr',
+            'do_write': True,
+            'do_delete': False,
+            'open_stat': (1024, 1456000000.0),
+            'writes': 0,
+            'size_changes': 0,
+            'dirty_ranges': IntervalSet(),
+            'full_write': True,
+        }
@@ -0,0 +1,104 @@
+# coding: utf-8
+
+# Copyright Luna Technology 2016
+# Matthieu Riviere <mriviere@luna-technology.com>
+
+import struct
+from unittest import TestCase
+
+from twisted.internet import defer
+
+from smb.smb2_constants import SMB2_COM_CLOSE, SMB2_COM_SET_INFO, SMB2_COM_WRITE
+from smbproxy4 import logger
+from smbproxy4 import settings
+from smbproxy4.interval_set import END_OF_FILE, IntervalSet
+from smbproxy4.smbproxy4 import ProxyServerProtocol
+from test_fast_path import smb2_packet
+
+
+FILE_ID = 'f' * 16
+
+
+def write_body(offset, data, file_id=FILE_ID):
+    return struct.pack('<HHIQ16sIIHHI', 49, 64 + 48, len(data), offset, file_id, 0, 0, 0, 0, 0) + data
+
+
+def set_info_body(file_info_class, data, file_id=FILE_ID):
+    return struct.pack('<HBBIHHI16s', 33, 1, file_info_class, len(data), 64 + 32, 0, 0, file_id) + data
+
+
+def close_body(file_id=FILE_ID):
+    return struct.pack('<HHI16s', 24, 0, 0, file_id)
+
+
+class TestDirtyTracking(TestCase):
+    def setUp(self):
+        self.protocol = ProxyServerProtocol()
+        self.protocol.settings = settings
+        self.protocol.log = logger.logger.new()
+        self.protocol.connected_trees[0] = {'path': u'\\\\host\\share'}
+        self.protocol.open_files[FILE_ID] = {
+            'filename': u'out\\frame.exr',
+            'do_write': True,
+            'do_delete': False,
+            'open_stat': (1024, 1456000000.0),
+            'writes': 0,
+            'size_changes': 0,
+            'dirty_ranges': IntervalSet(),
+            'full_write': False,
+        }
+
+        self.close_stat = (1024, 1456000000.0)
+        self.protocol.local_file_stat = lambda full_share, path: defer.succeed(self.close_stat)
+        self.sync_backs = []
+
+        self.base_versions = []
+
+        def sync_back_file(full_share, path, dirty_ranges=None, base_version=None):
+            self.sync_backs.append((path, dirty_ranges))
+            self.base_versions.append(base_version)
+            return defer.succeed(None)
+        self.protocol.sync_back_file = sync_back_file
+
+        self.protocol.cli_queue.get().addCallback(self.forward)
+
+    def forward(self, chunks):
+        self.protocol.cli_queue.get().addCallback(self.forward)
+
+    def close(self):
+        self.protocol.feedData(smb2_packet(SMB2_COM_CLOSE, body=close_body()))
+
+    def test_unmodified_file_is_not_written_back(self):
+        self.close()
+        assert self.sync_backs == []
+        assert self.protocol.total_skipped_sync_backs == 1
+        assert FILE_ID not in self.protocol.open_files
+
+    def test_write_marks_the_handle_dirty(self):
+        # Forwarded through the fast path
+        self.protocol.feedData(smb2_packet(SMB2_COM_WRITE, body=write_body(0, 'data')))
+        self.protocol.feedData(smb2_packet(SMB2_COM_WRITE, body=write_body(4096, 'more data')))
+        assert self.protocol.total_fast_path_client_packets == 2
+        assert self.protocol.open_files[FILE_ID]['writes'] == 2
+
+        self.close()
+        assert self.sync_backs == [(u'out\\frame.exr', IntervalSet([(0, 4), (4096, 4105)]))]
+        # Over the version the file had when it was opened
+        assert self.base_versions == [(1024, 1456000000.0)]
+
+    def test_end_of_file_change_marks_the_handle_dirty(self):
+        self.protocol.feedData(smb2_packet(SMB2_COM_SET_INFO, body=set_info_body(20, struct.pack('<Q', 512))))
+        self.close()
+        # Everything after the new end of file
+        assert self.sync_backs == [(u'out\\frame.exr', IntervalSet([(512, END_OF_FILE)]))]
+
+    def test_local_change_marks_the_handle_dirty(self):
+        self.close_stat = (0, 1456000100.0)
+        self.close()
+        assert self.sync_backs == [(u'out\\frame.exr', None)]
+
+    def test_overwritten_file_is_written_back_whole(self):
+        self.protocol.open_files[FILE_ID]['full_write'] = True
+        self.protocol.feedData(smb2_packet(SMB2_COM_WRITE, body=write_body(0, 'data')))
+        self.close()
+        assert self.sync_backs == [(u'out\\frame.exr', None)]
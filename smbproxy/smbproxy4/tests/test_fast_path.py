@@ -0,0 +1,138 @@
+# coding: utf-8
+
+# Copyright Luna Technology 2016
+# Matthieu Riviere <mriviere@luna-technology.com>
+
+import struct
+from unittest import TestCase
+
+from twisted.internet import defer
+
+from smb.smb2_constants import SMB2_COM_CREATE, SMB2_COM_ECHO, SMB2_COM_LOGOFF, SMB2_COM_READ
+from smbproxy4 import logger
+from smbproxy4 import settings
+from smbproxy4.smbproxy4 import ProxyServerProtocol, peek_smb2_command
+from nmb.nmb_structs import DirectTCPSessionMessage, NMBReceiveBuffer
+
+
+def smb2_packet(command, mid=1, next_command_offset=0, body='\0' * 16, flags=0):
+    header = struct.pack(
+        '<4sHHIHHIIQIIQ16s',
+        '\xFESMB', 64, 1, 0, command, 1, flags, next_command_offset, mid, 0, 0, 0, '\0' * 16
+    )
+    message = header + body
+    return struct.pack('>I', len(message)) + message
+
+
+def create_body(filename, desired_access=0, create_disposition=1):
+    name = filename.encode('UTF-16LE')
+    structure = struct.pack(
+        '<HBBIQQIIIIIHHII',
+        57, 0, 0, 0, 0, 0, desired_access, 0, 0, create_disposition, 0, 64 + 56, len(name), 0, 0
+    )
+    return structure + name
+
+
+def decode(data):
+    buf = NMBReceiveBuffer()
+    buf.append(data)
+    packet = DirectTCPSessionMessage()
+    packet.decode_from_buffer(buf)
+    return packet
+
+
+class TestPeekSMB2Command(TestCase):
+    def test_single_message(self):
+        assert peek_smb2_command(decode(smb2_packet(SMB2_COM_READ))) == SMB2_COM_READ
+
+    def test_split_header(self):
+        buf = NMBReceiveBuffer()
+        data = smb2_packet(SMB2_COM_READ)
+        for i in xrange(0, len(data), 7):
+            buf.append(data[i:i+7])
+        packet = DirectTCPSessionMessage()
+        packet.decode_from_buffer(buf)
+
+        assert peek_smb2_command(packet) == SMB2_COM_READ
+
+    def test_compound_message(self):
+        assert peek_smb2_command(decode(smb2_packet(SMB2_COM_READ, next_command_offset=80))) is None
+
+    def test_smb1_message(self):
+        data = '\xFFSMB' + '\0' * 60
+        assert peek_smb2_command(decode(struct.pack('>I', len(data)) + data)) is None
+
+
+class TestFastPath(TestCase):
+    def setUp(self):
+        self.protocol = ProxyServerProtocol()
+        self.protocol.settings = settings
+        self.protocol.log = logger.logger.new()
+
+        self.forwarded = []
+
+        def forward(chunks):
+            self.forwarded.append(''.join(chunks))
+            self.protocol.cli_queue.get().addCallback(forward)
+        self.protocol.cli_queue.get().addCallback(forward)
+
+    def test_read_bypasses_the_queue(self):
+        data = smb2_packet(SMB2_COM_READ)
+        self.protocol.feedData(data)
+
+        assert self.forwarded == [data]
+        assert self.protocol.total_fast_path_client_packets == 1
+        assert self.protocol.client_pending_packets_queue_len == 0
+
+    def test_read_does_not_wait_behind_a_pending_create(self):
+        pending = defer.Deferred()
+        self.protocol.onNMBSessionMessage = lambda message: pending
+
+        create = smb2_packet(SMB2_COM_CREATE, mid=1, body=create_body(u'some\\file'))
+        read = smb2_packet(SMB2_COM_READ, mid=2)
+        self.protocol.feedData(create + read)
+
+        # The CREATE is being processed, the READ of another file goes through
+        assert self.forwarded == [read]
+        assert self.protocol.client_pending_packets_queue_len == 1
+
+        pending.callback(None)
+        assert self.forwarded == [read, create]
+        assert self.protocol.client_pending_packets_queue_len == 0
+
+    def test_create_of_the_same_file_waits(self):
+        pending = []
+
+        def process(message):
+            d = defer.Deferred()
+            pending.append(d)
+            return d
+        self.protocol.onNMBSessionMessage = process
+
+        create1 = smb2_packet(SMB2_COM_CREATE, mid=1, body=create_body(u'some\\file'))
+        create2 = smb2_packet(SMB2_COM_CREATE, mid=2, body=create_body(u'SOME\\FILE'))
+        self.protocol.feedData(create1 + create2)
+
+        # Only the first CREATE is being processed
+        assert len(pending) == 1
+
+        pending[0].callback(None)
+        assert self.forwarded == [create1]
+        assert len(pending) == 2
+
+        pending[1].callback(None)
+        assert self.forwarded == [create1, create2]
+
+    def test_barrier(self):
+        pending = defer.Deferred()
+        self.protocol.onNMBSessionMessage = lambda message: pending
+
+        create = smb2_packet(SMB2_COM_CREATE, mid=1, body=create_body(u'some\\file'))
+        logoff = smb2_packet(SMB2_COM_LOGOFF, mid=2)
+        echo = smb2_packet(SMB2_COM_ECHO, mid=3)
+        self.protocol.feedData(create + logoff + echo)
+
+        assert self.forwarded == []
+
+        pending.callback(None)
+        assert self.forwarded == [create, logoff, echo]
@@ -0,0 +1,112 @@
+# coding: utf-8
+
+# Copyright Luna Technology 2016
+# Matthieu Riviere <mriviere@luna-technology.com>
+
+from unittest import TestCase
+
+from twisted.test.proto_helpers import StringTransport
+
+from smb.smb2_constants import SMB2_COM_CREATE
+from smbproxy4 import logger
+from smbproxy4 import settings
+from smbproxy4.flow_control import FlowController
+from smbproxy4.smbproxy4 import ProxyServerProtocol
+from test_interim_responses import smb2_response
+
+
+class FakeProducer(object):
+    def __init__(self):
+        self.paused = False
+
+    def pauseProducing(self):
+        assert not self.paused
+        self.paused = True
+
+    def resumeProducing(self):
+        assert self.paused
+        self.paused = False
+
+
+class TestFlowController(TestCase):
+    def setUp(self):
+        self.producer = FakeProducer()
+        self.flow = FlowController('test', high_water_mark=100, low_water_mark=20)
+        self.flow.set_producer(self.producer)
+
+    def test_water_marks(self):
+        self.flow.queued(60)
+        self.flow.queued(40)
+        assert not self.producer.paused
+
+        self.flow.queued(1)
+        assert self.producer.paused
+
+        # Still above the low water mark
+        self.flow.dequeued(60)
+        assert self.producer.paused
+
+        self.flow.dequeued(21)
+        assert not self.producer.paused
+        assert self.flow.pause_count == 1
+
+    def test_consumer_pause(self):
+        self.flow.pauseProducing()
+        assert self.producer.paused
+
+        # The producer stays paused as long as one of the reasons holds
+        self.flow.queued(200)
+        self.flow.resumeProducing()
+        assert self.producer.paused
+
+        self.flow.dequeued(200)
+        assert not self.producer.paused
+        assert self.flow.pause_count == 1
+
+    def test_paused_before_the_producer_is_known(self):
+        flow = FlowController('test', high_water_mark=100, low_water_mark=20)
+        flow.queued(200)
+
+        flow.set_producer(self.producer)
+        assert self.producer.paused
+
+
+class TestServerFlow(TestCase):
+    def setUp(self):
+        self.protocol = ProxyServerProtocol()
+        self.protocol.settings = settings
+        self.protocol.log = logger.logger.new()
+        self.protocol.transport = StringTransport()
+        self.protocol.onNMBSessionMessageResponse = lambda flags, data: None
+
+        # The connection to samba
+        self.samba = FakeProducer()
+        self.protocol.server_flow.high_water_mark = 100
+        self.protocol.server_flow.low_water_mark = 20
+        self.protocol.server_flow.set_producer(self.samba)
+
+    def test_slow_client(self):
+        # The client doesn't read its responses fast enough: its transport pauses us
+        self.protocol.server_flow.pauseProducing()
+        assert self.samba.paused
+
+        self.protocol.server_flow.resumeProducing()
+        assert not self.samba.paused
+
+    def test_responses_waiting_to_be_processed(self):
+        queue = self.protocol.server_pending_packets_queue
+        # A response is being processed: the next ones wait behind it
+        queue.waiting.pop()
+
+        response = smb2_response(SMB2_COM_CREATE, mid=5)
+        self.protocol.clientDataReceived(response)
+        assert not self.samba.paused
+        self.protocol.clientDataReceived(response)
+        assert self.samba.paused
+        assert self.protocol.transport.value() == ''
+
+        # Samba is read from again once they're written to the client
+        queue.get().addCallback(self.protocol.process_server_pending_packet)
+        assert self.protocol.transport.value() == response * 2
+        assert self.protocol.server_flow.queued_bytes == 0
+        assert not self.samba.paused
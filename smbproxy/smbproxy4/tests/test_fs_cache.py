@@ -3,9 +3,18 @@
 # Copyright Luna Technology 2016
 # Matthieu Riviere <mriviere@luna-technology.com>
 
+import hashlib
+import json
+import tempfile
 from unittest import TestCase
 
-from smbproxy4.fs_cache import FSCacheFileMetadata
+from twisted.internet import defer, task
+
+from smbproxy4 import fs_cache
+from smbproxy4 import logger
+from smbproxy4 import settings
+from smbproxy4.fs_cache import FSCache, FSCacheFileMetadata, FSCacheHTTPConnector, read_ranges, wait_at_most
+from smbproxy4.interval_set import END_OF_FILE, IntervalSet
 
 
 class TestFSCacheFileMetadata(TestCase):
@@ -42,4 +51,195 @@ class TestFSCacheFileMetadata(TestCase):
     def test_is_dir(self):
         assert self.file_metadata.is_dir() is False
         assert self.dir_metadata.is_dir() is True
-        assert self.none_file_metadata.is_dir() is False
\ No newline at end of file
+        assert self.none_file_metadata.is_dir() is False
+
+BASE_VERSION = (1024, 1456000000.0)
+
+
+class FakeConnector(object):
+    def __init__(self):
+        self.partial_writes = []
+        self.full_writes = []
+
+    def http_write_file_ranges_async(self, full_path, local_path, ranges, size, base_size, base_mtime):
+        self.partial_writes.append((ranges, size, base_size, base_mtime))
+        return defer.succeed({'file_size': size, 'mtime': None})
+
+    def http_write_file_async(self, full_path, local_path):
+        self.full_writes.append(full_path)
+        return defer.succeed({'file_size': None, 'mtime': None})
+
+
+class TestPartialWriteBack(TestCase):
+    def setUp(self):
+        self.fscache = FSCache(settings)
+        self.file_metadata = FSCacheFileMetadata(
+            '\\\\HOST\\SHARE', 'my\\path', {'exists': True, 'metadata': {'isfile': True}}, None
+        )
+
+    def test_small_changes_are_written_back_alone(self):
+        dirty_ranges = IntervalSet([(0, 10), (1000, END_OF_FILE)])
+        ranges = self.fscache.partial_write_back_ranges(self.file_metadata, 1024, dirty_ranges, BASE_VERSION)
+        assert ranges == IntervalSet([(0, 10), (1000, 1024)])
+
+    def test_whole_file_write_back(self):
+        # Unknown changes
+        assert self.fscache.partial_write_back_ranges(self.file_metadata, 1024, None, BASE_VERSION) is None
+        # Most of the file changed
+        assert self.fscache.partial_write_back_ranges(
+            self.file_metadata, 1024, IntervalSet([(0, 512)]), BASE_VERSION) is None
+        # New file
+        missing_metadata = FSCacheFileMetadata('\\\\HOST\\SHARE', 'my\\path', {'exists': False}, None)
+        assert self.fscache.partial_write_back_ranges(
+            missing_metadata, 1024, IntervalSet([(0, 10)]), BASE_VERSION) is None
+        # Unknown version of the file the changes were made to
+        assert self.fscache.partial_write_back_ranges(self.file_metadata, 1024, IntervalSet([(0, 10)]), None) is None
+
+    def test_ranges_apply_to_the_imported_version(self):
+        connector = FakeConnector()
+        self.fscache.get_http_connector = lambda log: connector
+        self.fscache.update_written_file_metadata = lambda *args: defer.succeed(None)
+        # The metadata was refreshed since the import: the fileserver has another version
+        file_metadata = FSCacheFileMetadata('\\\\HOST\\SHARE', 'my\\path', {
+            'exists': True, 'metadata': {'isfile': True, 'st_size': 2048, 'st_mtime': 1456000100.0}}, None)
+
+        with tempfile.NamedTemporaryFile() as fh:
+            fh.truncate(1024)
+            self.fscache.set_file(
+                file_metadata, fh.name, logger.logger.new(), IntervalSet([(0, 10)]), BASE_VERSION)
+            assert connector.partial_writes == [(IntervalSet([(0, 10)]), 1024, 1024, 1456000000.0)]
+
+            self.fscache.set_file(file_metadata, fh.name, logger.logger.new(), IntervalSet([(0, 10)]))
+            assert len(connector.full_writes) == 1
+
+    def test_read_ranges(self):
+        with tempfile.NamedTemporaryFile() as fh:
+            fh.write('0123456789')
+            fh.flush()
+            assert read_ranges(fh.name, IntervalSet([(1, 3), (8, 10)])) == '1289'
+
+
+class TestWaitAtMost(TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.real_reactor, fs_cache.reactor = fs_cache.reactor, self.clock
+
+    def tearDown(self):
+        fs_cache.reactor = self.real_reactor
+
+    def test_result(self):
+        d = defer.Deferred()
+        results = []
+        wait_at_most(d, 10).addCallback(results.append)
+        d.callback('SUCCESS')
+        assert results == ['SUCCESS']
+
+    def test_timeout(self):
+        d = defer.Deferred()
+        results = []
+        wait_at_most(d, 10).addCallback(results.append)
+        self.clock.advance(10)
+        assert results == [None]
+
+        # It can be waited again
+        wait_at_most(d, 10).addCallback(results.append)
+        d.callback('SUCCESS')
+        assert results == [None, 'SUCCESS']
+
+    def test_failure(self):
+        d = defer.Deferred()
+        failures = []
+        wait_at_most(d, 10).addErrback(failures.append)
+        d.errback(RuntimeError('Connection lost'))
+        # Right away, instead of after the timeout
+        assert len(failures) == 1
+        assert failures[0].check(RuntimeError)
+        assert self.clock.getDelayedCalls() == []
+
+
+class FakeThreads(object):
+    @staticmethod
+    def deferToThread(f, *args, **kwargs):
+        return defer.maybeDeferred(f, *args, **kwargs)
+
+
+class FakeCacheClient(object):
+    def __init__(self, parts):
+        self.parts = parts
+
+    def get_part(self, shasum, length=None):
+        return defer.succeed(self.parts[shasum])
+
+
+class TestGetFileRange(TestCase):
+    def setUp(self):
+        self.real_threads, fs_cache.threads = fs_cache.threads, FakeThreads
+        self.fscache = FSCache(settings)
+        self.fscache.get_http_connector = lambda log: self
+        self.range_reads = []
+
+    def tearDown(self):
+        fs_cache.threads = self.real_threads
+
+    def http_get_file_range_async(self, full_path, offset, length, size, mtime):
+        self.range_reads.append((offset, length))
+        return defer.succeed('from the fileserver')
+
+    def get_file_range(self, shasum):
+        results = []
+        self.fscache.get_file_range(
+            '\\\\HOST\\SHARE', 'my\\path', 100, 1456000000.0, 0, 10, shasum, logger.logger.new()
+        ).addCallback(results.append)
+        return results[0]
+
+    def test_part_from_cache_client(self):
+        shasum = hashlib.sha256('0123456789').hexdigest()
+        self.fscache.cache_client = FakeCacheClient({shasum: '0123456789'})
+        assert self.get_file_range(shasum) == '0123456789'
+        assert self.range_reads == []
+
+    def test_corrupted_part(self):
+        shasum = hashlib.sha256('0123456789').hexdigest()
+        self.fscache.cache_client = FakeCacheClient({shasum: '01234\0\0\0\0\0'})
+        assert self.get_file_range(shasum) == 'from the fileserver'
+        assert self.range_reads == [(0, 10)]
+
+
+class TestWriteRanges(TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.real_reactor, self.real_threads = fs_cache.reactor, fs_cache.threads
+        fs_cache.reactor, fs_cache.threads = self.clock, FakeThreads
+
+        # No connection is made: the requests are made by request() below
+        self.connector = FSCacheHTTPConnector.__new__(FSCacheHTTPConnector)
+        self.connector.log = logger.logger.new()
+        self.connector.http_service_host = 'fileserver'
+        self.connector.http_service_port = 443
+        self.connector._http_treq_req_base = self.request
+        self.bodies = []
+
+    def tearDown(self):
+        fs_cache.reactor, fs_cache.threads = self.real_reactor, self.real_threads
+
+    def request(self, endpoint, host, port, log=None, ssl=False, files=None, **kwargs):
+        self.bodies.append(files['data'][1].read())
+        if len(self.bodies) == 1:
+            error = RuntimeError('Internal server error')
+            error.status_code = 500
+            return defer.fail(error)
+        return defer.succeed(json.dumps({'file_size': 10, 'mtime': 1456000000.0}))
+
+    def test_body_is_sent_again_on_retry(self):
+        results = []
+        with tempfile.NamedTemporaryFile() as fh:
+            fh.write('0123456789')
+            fh.flush()
+            self.connector.http_write_file_ranges_async(
+                'path', fh.name, IntervalSet([(1, 3), (8, 10)]), 10, 10, 1456000000.0
+            ).addCallback(results.append)
+            self.clock.advance(0)
+            self.clock.advance(10)
+
+        assert self.bodies == ['1289', '1289']
+        assert results == [{'file_size': 10, 'mtime': 1456000000.0}]
@@ -0,0 +1,120 @@
+# coding: utf-8
+
+# Copyright Luna Technology 2016
+# Matthieu Riviere <mriviere@luna-technology.com>
+
+import struct
+from unittest import TestCase
+
+from twisted.internet import defer
+from twisted.internet import task
+from twisted.test.proto_helpers import StringTransport
+
+from smb.smb2_constants import SMB2_COM_CREATE, SMB2_COM_READ, SMB2_FLAGS_ASYNC_COMMAND, SMB2_FLAGS_SERVER_TO_REDIR, \
+    SMB2_FLAGS_SIGNED
+from smbproxy4 import logger
+from smbproxy4 import settings
+from smbproxy4 import smbproxy4
+from smbproxy4.smb2_async import STATUS_PENDING
+from test_fast_path import create_body, smb2_packet
+
+
+def smb2_response(command, mid, status=0, flags=SMB2_FLAGS_SERVER_TO_REDIR, credits=1, async_id=0):
+    if flags & SMB2_FLAGS_ASYNC_COMMAND:
+        header = struct.pack(
+            '<4sHHIHHIIQQQ16s',
+            '\xFESMB', 64, 1, status, command, credits, flags, 0, mid, async_id, 0, '\0' * 16
+        )
+    else:
+        header = struct.pack(
+            '<4sHHIHHIIQIIQ16s',
+            '\xFESMB', 64, 1, status, command, credits, flags, 0, mid, 0, 0, 0, '\0' * 16
+        )
+    message = header + '\0' * 9
+    return struct.pack('>I', len(message)) + message
+
+
+def parse_header(packet):
+    return struct.unpack('<4sHHIHHIIQQQ16s', packet[4:68])
+
+
+class TestInterimResponses(TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.real_reactor = smbproxy4.reactor
+        smbproxy4.reactor = self.clock
+
+        self.protocol = smbproxy4.ProxyServerProtocol()
+        self.protocol.settings = settings
+        self.protocol.log = logger.logger.new()
+        self.protocol.transport = StringTransport()
+
+        self.pending = defer.Deferred()
+        self.protocol.onNMBSessionMessage = lambda message: self.pending
+
+        self.forwarded = []
+
+        def forward(chunks):
+            self.forwarded.append(''.join(chunks))
+            self.protocol.cli_queue.get().addCallback(forward)
+        self.protocol.cli_queue.get().addCallback(forward)
+
+    def tearDown(self):
+        smbproxy4.reactor = self.real_reactor
+
+    def test_no_interim_response_for_fast_creates(self):
+        create = smb2_packet(SMB2_COM_CREATE, mid=5, body=create_body(u'some\\file'))
+        self.protocol.feedData(create)
+        self.pending.callback(None)
+
+        self.clock.advance(settings.INTERIM_RESPONSE_DELAY * 2)
+        assert self.protocol.transport.value() == ''
+        assert self.forwarded == [create]
+
+    def test_interim_response(self):
+        create = smb2_packet(SMB2_COM_CREATE, mid=5, body=create_body(u'some\\file'))
+        self.protocol.feedData(create)
+        self.clock.advance(settings.INTERIM_RESPONSE_DELAY)
+
+        interim = self.protocol.transport.value()
+        _, _, _, status, command, credits, flags, _, mid, async_id, _, _ = parse_header(interim)
+        assert (status, command, credits, mid) == (STATUS_PENDING, SMB2_COM_CREATE, 0, 5)
+        assert flags == SMB2_FLAGS_SERVER_TO_REDIR | SMB2_FLAGS_ASYNC_COMMAND
+        assert len(interim) == 4 + 64 + 9
+
+        # The CREATE is only forwarded once the import is done
+        assert self.forwarded == []
+        self.pending.callback(None)
+        assert self.forwarded == [create]
+
+        # Samba's own interim response is swallowed, the final one is rewritten with our AsyncId
+        self.protocol.transport.clear()
+        self.protocol.clientDataReceived(smb2_response(SMB2_COM_READ, mid=4))
+        self.protocol.clientDataReceived(smb2_response(
+            SMB2_COM_CREATE, mid=5, status=STATUS_PENDING, flags=SMB2_FLAGS_SERVER_TO_REDIR | SMB2_FLAGS_ASYNC_COMMAND,
+            credits=3, async_id=1234
+        ))
+        self.protocol.clientDataReceived(smb2_response(SMB2_COM_CREATE, mid=5, credits=2))
+
+        output = self.protocol.transport.value()
+        assert output[:len(smb2_response(SMB2_COM_READ, mid=4))] == smb2_response(SMB2_COM_READ, mid=4)
+        final = output[len(smb2_response(SMB2_COM_READ, mid=4)):]
+        _, _, _, status, command, credits, flags, _, mid, final_async_id, _, _ = parse_header(final)
+        assert (status, command, credits, mid, final_async_id) == (0, SMB2_COM_CREATE, 5, 5, async_id)
+        assert flags & SMB2_FLAGS_ASYNC_COMMAND
+        assert len(final) == 4 + 64 + 9
+
+        assert self.protocol.async_requests == {}
+
+    def test_no_interim_response_for_signed_requests(self):
+        create = smb2_packet(SMB2_COM_CREATE, mid=5, body=create_body(u'some\\file'), flags=SMB2_FLAGS_SIGNED)
+        self.protocol.feedData(create)
+        self.clock.advance(settings.INTERIM_RESPONSE_DELAY * 2)
+        assert self.protocol.transport.value() == ''
+        assert self.protocol.async_requests == {}
+
+        # The signed final response goes through as it is
+        self.pending.callback(None)
+        final = smb2_response(SMB2_COM_CREATE, mid=5, flags=SMB2_FLAGS_SERVER_TO_REDIR | SMB2_FLAGS_SIGNED)
+        self.protocol.clientDataReceived(final)
+        assert self.protocol.transport.value() == final
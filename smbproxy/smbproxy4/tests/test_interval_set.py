@@ -0,0 +1,49 @@
+# coding: utf-8
+
+# Copyright Luna Technology 2016
+# Matthieu Riviere <mriviere@luna-technology.com>
+
+from unittest import TestCase
+
+from smbproxy4.interval_set import END_OF_FILE, IntervalSet
+
+
+class TestIntervalSet(TestCase):
+    def test_merge(self):
+        ranges = IntervalSet()
+        ranges.add(10, 20)
+        ranges.add(30, 40)
+        assert list(ranges) == [(10, 20), (30, 40)]
+
+        # Adjacent
+        ranges.add(20, 25)
+        assert list(ranges) == [(10, 25), (30, 40)]
+
+        # Overlapping several ranges
+        ranges.add(0, 35)
+        assert list(ranges) == [(0, 40)]
+
+        # Empty ranges are ignored
+        ranges.add(50, 50)
+        assert list(ranges) == [(0, 40)]
+
+    def test_insert_between(self):
+        ranges = IntervalSet([(0, 10), (40, 50)])
+        ranges.add(20, 30)
+        assert list(ranges) == [(0, 10), (20, 30), (40, 50)]
+        assert ranges.total_length() == 30
+
+    def test_clip(self):
+        ranges = IntervalSet([(0, 10), (20, 30), (100, END_OF_FILE)])
+        assert list(ranges.clip(25)) == [(0, 10), (20, 25)]
+        assert list(ranges.clip(150)) == [(0, 10), (20, 30), (100, 150)]
+
+    def test_covers(self):
+        ranges = IntervalSet([(0, 10), (20, 30)])
+        assert ranges.covers(0, 10)
+        assert ranges.covers(22, 25)
+        assert not ranges.covers(5, 15)
+        assert not ranges.covers(10, 20)
+        assert not ranges.covers(25, 35)
+        # An empty range always is
+        assert ranges.covers(15, 15)
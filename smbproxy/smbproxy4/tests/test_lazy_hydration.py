@@ -0,0 +1,269 @@
+# coding: utf-8
+
+# Copyright Luna Technology 2016
+# Matthieu Riviere <mriviere@luna-technology.com>
+
+import os
+import struct
+import tempfile
+from unittest import TestCase
+
+from twisted.internet import defer, task
+from twisted.test.proto_helpers import StringTransport
+
+from smb.smb2_constants import SMB2_COM_READ, SMB2_FLAGS_ASYNC_COMMAND
+from smbproxy4 import fs_local_cache_client
+from smbproxy4 import logger
+from smbproxy4 import settings
+from smbproxy4 import smbproxy4
+from smbproxy4.fs_local_cache_client import FSLocalCacheClient
+from smbproxy4.lazy_hydration import LazyFile, LazyHydration
+from smbproxy4.smb2_async import STATUS_PENDING
+from smbproxy4.smbproxy4 import ProxyServerProtocol, SMB2_INVALID_FILE_ID
+from test_fast_path import smb2_packet
+from test_fs_cache import FakeThreads
+from test_interim_responses import parse_header, smb2_response
+
+
+FILE_ID = 'f' * 16
+
+
+def lazy_file(size=40, chunk_size=10):
+    chunks = [(start, min(start + chunk_size, size), None) for start in xrange(0, size, chunk_size)]
+    return LazyFile(u'\\\\host\\share', u'big.bin', '/tmp/big.bin', size, 1456000000.0, chunks)
+
+
+def read_body(offset, length, file_id=FILE_ID):
+    return struct.pack('<HBBIQ16sIIIHH', 49, 0, 0, length, offset, file_id, 0, 0, 0, 0, 0) + '\0'
+
+
+class TestLazyFile(TestCase):
+    def test_missing_chunks(self):
+        f = lazy_file()
+        f.present.add(10, 20)
+        assert f.missing_chunks(0, 40) == [0, 2, 3]
+        assert f.missing_chunks(12, 5) == []
+        assert f.missing_chunks(15, 10) == [2]
+        # Past the end of the file
+        assert f.missing_chunks(35, 100) == [3]
+        assert f.missing_chunks(40, 10) == []
+        assert f.covers(40, 10)
+        assert not f.covers(15, 10)
+
+
+class TestLazyHydration(TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.fetches = []
+        self.stored = {}
+        self.finished = []
+        self.hydration = LazyHydration(
+            self.fetch_chunk, self.store_chunk, self.finished.append,
+            read_ahead=1, max_concurrent=1, retry_delay=30, clock=self.clock)
+
+    def fetch_chunk(self, f, start, end, source):
+        d = defer.Deferred()
+        self.fetches.append((start, end, d))
+        return d
+
+    def store_chunk(self, f, start, data):
+        self.stored[start] = data
+
+    def complete_fetch(self, i):
+        start, end, d = self.fetches[i]
+        d.callback('x' * (end - start))
+
+    def test_background_fetch(self):
+        f = lazy_file(size=25)
+        self.hydration.start(f)
+        assert [start for start, _, _ in self.fetches] == [0]
+
+        self.complete_fetch(0)
+        self.complete_fetch(1)
+        assert self.hydration.get(u'\\\\HOST\\share', u'BIG.bin') is f
+        self.complete_fetch(2)
+
+        assert sorted(self.stored) == [0, 10, 20]
+        assert len(self.stored[20]) == 5
+        assert self.finished == [f]
+        assert self.hydration.get(u'\\\\host\\share', u'big.bin') is None
+
+    def test_read_fetches_its_chunks_first(self):
+        f = lazy_file()
+        self.hydration.start(f)
+
+        waited = []
+        self.hydration.wait_range(f.share_name, f.path, 25, 2).addCallback(waited.append)
+        # The chunk of the READ, and the next one
+        assert [start for start, _, _ in self.fetches] == [0, 20, 30]
+        assert self.hydration.is_missing(f.share_name, f.path, 25, 2)
+
+        self.complete_fetch(1)
+        assert waited == [None]
+        assert not self.hydration.is_missing(f.share_name, f.path, 25, 2)
+
+        # The background fetch doesn't fetch them again
+        self.complete_fetch(0)
+        self.complete_fetch(2)
+        self.complete_fetch(3)
+        assert [start for start, _, _ in self.fetches] == [0, 20, 30, 10]
+        assert self.finished == [f]
+
+    def test_coalesced_fetch(self):
+        f = lazy_file()
+        self.hydration.start(f)
+        waited = []
+        self.hydration.wait_range(f.share_name, f.path, 0, 5).addCallback(waited.append)
+        assert [start for start, _, _ in self.fetches] == [0, 10]
+
+        self.complete_fetch(0)
+        assert waited == [None]
+
+    def test_retry(self):
+        f = lazy_file()
+        self.hydration.start(f)
+        self.fetches[0][2].errback(RuntimeError('Gateway unreachable'))
+        assert len(self.fetches) == 1
+
+        self.clock.advance(30)
+        assert [start for start, _, _ in self.fetches] == [0, 0]
+
+    def test_truncated_chunk(self):
+        f = lazy_file()
+        self.hydration.start(f)
+        failures = []
+        self.hydration.wait_range(f.share_name, f.path, 0, 5).addErrback(failures.append)
+        self.fetches[0][2].callback('short')
+        assert len(failures) == 1
+        assert self.stored == {}
+
+    def test_discard(self):
+        f = lazy_file()
+        self.hydration.start(f)
+        discarded = []
+        self.hydration.discard(f.share_name, f.path).addCallback(discarded.append)
+        assert discarded == [None]
+
+        # A chunk fetched after that isn't stored
+        self.complete_fetch(0)
+        assert self.stored == {}
+        assert self.finished == []
+        assert len(self.fetches) == 1
+
+
+class TestHeldRead(TestCase):
+    def setUp(self):
+        self.fetches = []
+        self.hydration = LazyHydration(self.fetch_chunk, lambda f, start, data: None, lambda f: None,
+                                       read_ahead=0, clock=task.Clock())
+        self.file = lazy_file()
+
+        self.protocol = ProxyServerProtocol()
+        self.protocol.settings = settings
+        self.protocol.log = logger.logger.new()
+        self.protocol.lazy_hydration = self.hydration
+        self.protocol.open_files[FILE_ID] = {
+            'share': self.file.share_name,
+            'filename': self.file.path,
+            'do_write': False,
+        }
+
+        self.forwarded = []
+        self.protocol.cli_queue.get().addCallback(self.forward)
+
+    def fetch_chunk(self, f, start, end, source):
+        d = defer.Deferred()
+        self.fetches.append((start, end, d))
+        return d
+
+    def forward(self, chunks):
+        self.forwarded.append(''.join(chunks))
+        self.protocol.cli_queue.get().addCallback(self.forward)
+
+    def read(self, offset, length):
+        self.protocol.feedData(smb2_packet(SMB2_COM_READ, body=read_body(offset, length)))
+
+    def test_read_waits_for_its_range(self):
+        self.hydration.start(self.file)
+        self.read(12, 4)
+        assert self.forwarded == []
+
+        self.fetches[-1][2].callback('x' * 10)
+        assert len(self.forwarded) == 1
+        assert FILE_ID in self.forwarded[0]
+
+        # The range is there now: forwarded right away
+        self.read(10, 10)
+        assert len(self.forwarded) == 2
+        assert self.protocol.total_fast_path_client_packets == 1
+
+    def test_failed_fetch_fails_the_read(self):
+        self.hydration.start(self.file)
+        self.read(0, 4)
+        self.fetches[0][2].errback(RuntimeError('Gateway unreachable'))
+
+        assert len(self.forwarded) == 1
+        assert FILE_ID not in self.forwarded[0]
+        assert SMB2_INVALID_FILE_ID in self.forwarded[0]
+
+    def test_no_lazy_file(self):
+        self.read(0, 4)
+        assert len(self.forwarded) == 1
+        assert self.fetches == []
+
+    def test_interim_response(self):
+        clock = task.Clock()
+        real_reactor, smbproxy4.reactor = smbproxy4.reactor, clock
+        self.addCleanup(setattr, smbproxy4, 'reactor', real_reactor)
+        self.protocol.transport = StringTransport()
+
+        self.hydration.start(self.file)
+        self.read(0, 4)
+        clock.advance(settings.INTERIM_RESPONSE_DELAY)
+        _, _, _, status, _, _, _, _, mid, async_id, _, _ = parse_header(self.protocol.transport.value())
+        assert (status, mid) == (STATUS_PENDING, 1)
+
+        self.fetches[0][2].callback('x' * 10)
+        assert len(self.forwarded) == 1
+
+        # The final response is rewritten with our AsyncId, even though READ responses usually go straight through
+        self.protocol.transport.clear()
+        self.protocol.clientDataReceived(smb2_response(SMB2_COM_READ, mid=1))
+        _, _, _, status, command, _, flags, _, mid, final_async_id, _, _ = parse_header(
+            self.protocol.transport.value())
+        assert (status, command, mid, final_async_id) == (0, SMB2_COM_READ, 1, async_id)
+        assert flags & SMB2_FLAGS_ASYNC_COMMAND
+        assert self.protocol.async_requests == {}
+
+        # The next responses take the fast path again
+        self.protocol.clientDataReceived(smb2_response(SMB2_COM_READ, mid=2))
+        assert self.protocol.total_fast_path_server_packets == 1
+
+
+class TestPlaceholder(TestCase):
+    def setUp(self):
+        real_threads, fs_local_cache_client.threads = fs_local_cache_client.threads, FakeThreads
+        self.addCleanup(setattr, fs_local_cache_client, 'threads', real_threads)
+
+        self.client = FSLocalCacheClient.__new__(FSLocalCacheClient)
+        self.client.settings = settings
+
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+        self.file = LazyFile(
+            u'\\\\host\\share', u'big.bin', self.path, 20, 1456000000.0, [(0, 10, None), (10, 20, None)])
+        self.fake_mtime = self.file.mtime - 500 * settings.MTIME_REFRESH_THRESHOLD
+        with open(self.path, 'wb') as fh:
+            fh.truncate(20)
+        os.utime(self.path, (self.fake_mtime, self.fake_mtime))
+
+    def test_store_chunk_keeps_the_old_mtime(self):
+        self.client.store_chunk(self.file, 10, 'x' * 10)
+        with open(self.path, 'rb') as fh:
+            assert fh.read() == '\0' * 10 + 'x' * 10
+        # Only partly there: it must still look out of date
+        assert os.path.getmtime(self.path) == self.fake_mtime
+
+        self.client.finish_hydration(self.file)
+        assert os.path.getmtime(self.path) == self.file.mtime
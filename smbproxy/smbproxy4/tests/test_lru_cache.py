@@ -0,0 +1,121 @@
+# coding: utf-8
+
+# Copyright Luna Technology 2016
+# Matthieu Riviere <mriviere@luna-technology.com>
+
+from unittest import TestCase
+
+from twisted.internet import task
+
+from smbproxy4 import logger
+from smbproxy4 import settings
+from smbproxy4.fs_cache import FSCache
+from smbproxy4.lru_cache import ExpiringLRUCache
+from metadata_proxy.metadata_loader import replace_listed_file
+
+
+class TestExpiringLRUCache(TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cache = ExpiringLRUCache(2, clock=self.clock.seconds)
+
+    def test_get(self):
+        assert self.cache.get('a') is None
+        self.cache.set('a', 1, 10)
+        assert self.cache.get('a') == 1
+        assert (self.cache.hits, self.cache.misses) == (1, 1)
+        assert self.cache.hit_ratio() == 0.5
+
+    def test_expiry(self):
+        self.cache.set('a', 1, 10)
+        self.clock.advance(9)
+        assert self.cache.get('a') == 1
+        self.clock.advance(1)
+        assert self.cache.get('a') is None
+        assert self.cache.expirations == 1
+        assert len(self.cache) == 0
+
+    def test_lru_eviction(self):
+        self.cache.set('a', 1, 10)
+        self.cache.set('b', 2, 10)
+        # 'a' becomes the most recently used
+        self.cache.get('a')
+        self.cache.set('c', 3, 10)
+
+        assert self.cache.get('b') is None
+        assert self.cache.get('a') == 1
+        assert self.cache.get('c') == 3
+        assert self.cache.evictions == 1
+
+    def test_invalidate(self):
+        self.cache.set('a', 1, 10)
+        self.cache.invalidate('a')
+        self.cache.invalidate('b')
+        assert self.cache.get('a') is None
+
+    def test_update(self):
+        self.cache.set('a', 1, 10)
+        self.cache.update('a', lambda v: v + 1)
+        self.cache.update('b', lambda v: v + 1)
+        assert self.cache.get('a') == 2
+        assert self.cache.get('b') is None
+
+        # The expiry time doesn't change
+        self.clock.advance(10)
+        assert self.cache.get('a') is None
+
+
+class TestFSCacheMetadataCache(TestCase):
+    def setUp(self):
+        self.fscache = FSCache(settings)
+        self.log = logger.logger.new()
+        self.share_name = '\\\\HOST\\SHARE'
+
+    def cache(self, kind, path, data):
+        full_path = self.fscache.full_path_from_sharename(self.share_name, path)
+        self.fscache.metadata_cache.set((kind, full_path), data, self.fscache.metadata_cache.clock() + 60)
+
+    def test_cached_metadata_needs_no_io(self):
+        metadata = {'exists': True, 'metadata': {'isfile': True}}
+        self.cache('file_metadata', u'dir\\file', metadata)
+
+        results = []
+        self.fscache.get_metadata_async(self.share_name, u'dir\\file', self.log).addCallback(results.append)
+        assert results == [metadata]
+
+    def test_invalidate_metadata(self):
+        self.cache('file_metadata', u'dir\\file', {'exists': True})
+        self.cache('list_dir', u'dir', {'files': [u'file'], 'files_metadata': {}})
+        self.cache('file_metadata', u'dir\\other_file', {'exists': True})
+
+        self.fscache.invalidate_metadata(self.share_name, u'dir\\file')
+        assert len(self.fscache.metadata_cache) == 1
+
+    def test_written_file_without_mtime(self):
+        # An older gateway doesn't return the mtime of the written file: its metadata is fetched again
+        metadata = {'exists': True, 'metadata': {'isfile': True, 'st_size': 10, 'st_mtime': 1000.0}}
+        self.cache('file_metadata', u'dir\\file', metadata)
+        self.cache('list_dir', u'dir', {'files': [u'file'], 'files_metadata': {u'file': metadata}})
+
+        self.fscache.update_written_file_metadata(self.share_name, u'dir\\file', metadata, 20, None, self.log)
+        assert len(self.fscache.metadata_cache) == 0
+
+    def test_replace_listed_file(self):
+        metadata = {'exists': True, 'metadata': {'isfile': True, 'st_size': 10}}
+        listing = {'files': [u'File', u'other'], 'files_metadata': {u'File': metadata, u'other': metadata}}
+
+        # Paths are case insensitive: the entry keeps its name
+        written = {'exists': True, 'metadata': {'isfile': True, 'st_size': 20}}
+        new_listing, name = replace_listed_file(listing, u'file', written)
+        assert name == u'File'
+        assert new_listing['files'] == [u'File', u'other']
+        assert new_listing['files_metadata'][u'File'] is written
+        # The original listing isn't modified
+        assert listing['files_metadata'][u'File'] is metadata
+
+        new_listing, _ = replace_listed_file(listing, u'FILE', {'exists': False, 'metadata': {}})
+        assert new_listing == {'files': [u'other'], 'files_metadata': {u'other': metadata}}
+
+        # The listing stored in the redis DB has no files_metadata
+        new_listing, name = replace_listed_file({'files': [u'other']}, u'new', written)
+        assert (new_listing, name) == ({'files': [u'other', u'new']}, u'new')
@@ -0,0 +1,92 @@
+# coding: utf-8
+
+# Copyright Luna Technology 2016
+# Matthieu Riviere <mriviere@luna-technology.com>
+
+import struct
+from unittest import TestCase
+
+from nmb.nmb_structs import DirectTCPSessionMessage, NMBError, NMBReceiveBuffer
+
+
+def nmb_frame(payload):
+    return struct.pack('>I', len(payload)) + payload
+
+
+class TestNMBReceiveBuffer(TestCase):
+    def setUp(self):
+        self.buf = NMBReceiveBuffer()
+
+    def test_peek(self):
+        self.buf.append('abc')
+        self.buf.append('defg')
+
+        assert len(self.buf) == 7
+        assert self.buf.peek(2) == 'ab'
+        assert self.buf.peek(5) == 'abcde'
+        assert self.buf.peek(50) == 'abcdefg'
+
+        # Peeking doesn't consume anything
+        assert len(self.buf) == 7
+
+    def test_pop_keeps_whole_chunks(self):
+        chunk1 = 'abc'
+        chunk2 = 'defg'
+        self.buf.append(chunk1)
+        self.buf.append(chunk2)
+
+        pieces = self.buf.pop(4)
+        assert pieces[0] is chunk1
+        assert ''.join(pieces) == 'abcd'
+
+        assert self.buf.pop(3) == ['efg']
+        assert len(self.buf) == 0
+
+    def test_pop_too_much(self):
+        self.buf.append('abc')
+        self.assertRaises(NMBError, self.buf.pop, 4)
+
+
+class TestDirectTCPSessionMessageDecodeFromBuffer(TestCase):
+    def test_decode_split_frames(self):
+        buf = NMBReceiveBuffer()
+        data = nmb_frame('hello') + nmb_frame('world!')
+
+        # Feed the data one byte at a time
+        decoded = []
+        for c in data:
+            buf.append(c)
+            message = DirectTCPSessionMessage()
+            length = message.decode_from_buffer(buf)
+            if length > 0:
+                decoded.append(message)
+
+        assert [m.data.tobytes() for m in decoded] == ['hello', 'world!']
+        assert [''.join(m.raw_chunks) for m in decoded] == [nmb_frame('hello'), nmb_frame('world!')]
+        assert len(buf) == 0
+
+    def test_decode_single_chunk_is_a_view(self):
+        buf = NMBReceiveBuffer()
+        chunk = nmb_frame('payload')
+        buf.append(chunk)
+
+        message = DirectTCPSessionMessage()
+        assert message.decode_from_buffer(buf) == len(chunk)
+        assert message.raw_chunks[0] is chunk
+        assert isinstance(message.data, memoryview)
+        assert message.data[:3] == 'pay'
+
+    def test_decode_incomplete(self):
+        buf = NMBReceiveBuffer()
+        buf.append(nmb_frame('payload')[:-1])
+
+        message = DirectTCPSessionMessage()
+        assert message.decode_from_buffer(buf) == 0
+        assert len(buf) == 10
+
+    def test_decode_invalid_header(self):
+        buf = NMBReceiveBuffer()
+        buf.append('\xff\x00\x00\x01a')
+
+        message = DirectTCPSessionMessage()
+        self.assertRaises(NMBError, message.decode_from_buffer, buf)
@@ -0,0 +1,80 @@
+# coding: utf-8
+
+# Copyright Luna Technology 2016
+# Matthieu Riviere <mriviere@luna-technology.com>
+
+from unittest import TestCase
+
+from twisted.internet import defer
+
+from smbproxy4.packet_scheduler import PacketScheduler
+
+
+class TestPacketScheduler(TestCase):
+    def setUp(self):
+        self.started = []
+        self.pending = {}
+
+        def process(item):
+            self.started.append(item)
+            if item.startswith('slow'):
+                self.pending[item] = defer.Deferred()
+                return self.pending[item]
+            return None
+
+        self.scheduler = PacketScheduler(process)
+
+    def test_independent_packets(self):
+        self.scheduler.submit('slow1', ['a'])
+        self.scheduler.submit('fast1', ['b'])
+        self.scheduler.submit('slow2', ['c'])
+
+        assert self.started == ['slow1', 'fast1', 'slow2']
+        assert len(self.scheduler) == 2
+
+    def test_dependent_packets_keep_their_order(self):
+        self.scheduler.submit('slow1', ['a'])
+        self.scheduler.submit('slow2', ['a', 'b'])
+        self.scheduler.submit('fast1', ['b'])
+        self.scheduler.submit('fast2', ['c'])
+
+        assert self.started == ['slow1', 'fast2']
+
+        self.pending['slow1'].callback(None)
+        assert self.started == ['slow1', 'fast2', 'slow2']
+
+        self.pending['slow2'].callback(None)
+        assert self.started == ['slow1', 'fast2', 'slow2', 'fast1']
+        assert len(self.scheduler) == 0
+
+    def test_barrier(self):
+        self.scheduler.submit('slow1', ['a'])
+        self.scheduler.submit('fast1', [], barrier=True)
+        self.scheduler.submit('fast2', ['b'])
+
+        assert self.started == ['slow1']
+
+        self.pending['slow1'].callback(None)
+        assert self.started == ['slow1', 'fast1', 'fast2']
+
+    def test_max_running(self):
+        self.scheduler.max_running = 1
+        self.scheduler.submit('slow1', ['a'])
+        self.scheduler.submit('slow2', ['b'])
+
+        assert self.started == ['slow1']
+
+        self.pending['slow1'].callback(None)
+        assert self.started == ['slow1', 'slow2']
+
+    def test_deep_queue(self):
+        self.scheduler.submit('slow1', ['a'])
+        for i in xrange(10000):
+            self.scheduler.submit('fast%d' % i, ['a', 'b%d' % (i % 10)])
+        self.scheduler.submit('fast', ['c'])
+        assert self.started == ['slow1', 'fast']
+
+        self.pending['slow1'].callback(None)
+        assert self.started[2:] == ['fast%d' % i for i in xrange(10000)]
+        assert len(self.scheduler) == 0
+        assert self.scheduler.key_queues == {}
@@ -0,0 +1,32 @@
+# coding: utf-8
+
+# Copyright Luna Technology 2016
+# Matthieu Riviere <mriviere@luna-technology.com>
+
+from unittest import TestCase
+
+from twisted.internet import task
+
+from smbproxy4.reactor_lag import ReactorLagMonitor
+
+
+class TestReactorLagMonitor(TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.monitor = ReactorLagMonitor(interval=0.5, clock=self.clock)
+        self.monitor.start()
+
+    def tearDown(self):
+        self.monitor.stop()
+
+    def test_no_lag(self):
+        self.clock.pump([0.5] * 4)
+        assert self.monitor.get_stats() == {'last_lag': 0.0, 'max_lag': 0.0}
+
+    def test_lag(self):
+        # The reactor was blocked for 2 seconds
+        self.clock.advance(2.5)
+        assert self.monitor.last_lag == 2.0
+
+        self.clock.advance(0.5)
+        assert self.monitor.get_stats() == {'last_lag': 0.0, 'max_lag': 2.0}
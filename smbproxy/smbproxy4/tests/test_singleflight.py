@@ -0,0 +1,79 @@
+# coding: utf-8
+
+# Copyright Luna Technology 2016
+# Matthieu Riviere <mriviere@luna-technology.com>
+
+from unittest import TestCase
+
+from twisted.internet import defer
+
+from smbproxy4.singleflight import SingleFlight
+
+
+class TestSingleFlight(TestCase):
+    def setUp(self):
+        self.singleflight = SingleFlight('test')
+        self.operations = []
+
+    def operation(self, value):
+        d = defer.Deferred()
+        self.operations.append((value, d))
+        return d
+
+    def results_of(self, d):
+        results = []
+        d.addBoth(results.append)
+        return results
+
+    def test_concurrent_calls_share_the_operation(self):
+        first = self.results_of(self.singleflight.run('key', self.operation, 1))
+        second = self.results_of(self.singleflight.run('key', self.operation, 2))
+        other = self.results_of(self.singleflight.run('other key', self.operation, 3))
+
+        assert [value for value, _ in self.operations] == [1, 3]
+        assert (self.singleflight.total_started, self.singleflight.total_coalesced) == (2, 1)
+
+        self.operations[0][1].callback('result')
+        assert first == ['result']
+        assert second == ['result']
+        assert other == []
+        assert self.singleflight.in_flight.keys() == ['other key']
+
+        # Once the operation is done, it runs again
+        self.singleflight.run('key', self.operation, 4)
+        assert len(self.operations) == 3
+
+    def test_errors_are_sent_to_all_callers(self):
+        first = self.results_of(self.singleflight.run('key', self.operation, 1))
+        second = self.results_of(self.singleflight.run('key', self.operation, 2))
+
+        self.operations[0][1].errback(RuntimeError('Download failed'))
+        for results in (first, second):
+            assert results[0].check(RuntimeError)
+            results[0].trap(RuntimeError)
+        assert self.singleflight.in_flight == {}
+
+    def test_synchronous_operation(self):
+        results = self.results_of(self.singleflight.run('key', lambda: 'result'))
+        assert results == ['result']
+        assert self.singleflight.in_flight == {}
+
+    def test_cancellation(self):
+        first_deferred = self.singleflight.run('key', self.operation, 1)
+        first = self.results_of(first_deferred)
+        second_deferred = self.singleflight.run('key', self.operation, 2)
+        second = self.results_of(second_deferred)
+        operation = self.operations[0][1]
+
+        # Cancelling one caller doesn't cancel the operation
+        first_deferred.cancel()
+        assert first[0].check(defer.CancelledError)
+        first[0].trap(defer.CancelledError)
+        assert not operation.called
+
+        # But it's cancelled when no caller is left
+        second_deferred.cancel()
+        assert second[0].check(defer.CancelledError)
+        second[0].trap(defer.CancelledError)
+        assert operation.called
+        assert self.singleflight.in_flight == {}
@@ -0,0 +1,76 @@
+# coding: utf-8
+
+# Copyright Luna Technology 2016
+# Matthieu Riviere <mriviere@luna-technology.com>
+
+import struct
+from unittest import TestCase
+
+from smb.smb_structs import ProtocolError
+from smb.smb2_constants import SMB2_COM_CLOSE, SMB2_COM_CREATE, SMB2_COM_READ, SMB2_FLAGS_ASYNC_COMMAND
+from smbproxy4.smb2_dispatcher import SMB2Dispatcher, SMB2_CLOSE_REQUEST, parse_smb2_message
+
+
+def smb2_message(command, mid=1, flags=0, pid=2, tid=3, body='', next_command_offset=0):
+    header = struct.pack(
+        '<4sHHIHHIIQIIQ16s',
+        '\xFESMB', 64, 1, 0, command, 1, flags, next_command_offset, mid, pid, tid, 4, '\0' * 16
+    )
+    return header + body
+
+
+class TestParseSMB2Message(TestCase):
+    def test_sync_header(self):
+        data = smb2_message(SMB2_COM_READ, mid=7, body='body')
+        length, message = parse_smb2_message(memoryview(data))
+
+        assert length == len(data)
+        assert (message.command, message.mid, message.pid, message.tid, message.session_id) == \
+            (SMB2_COM_READ, 7, 2, 3, 4)
+        assert message.data.tobytes() == 'body'
+
+    def test_async_header(self):
+        data = smb2_message(SMB2_COM_CREATE, flags=SMB2_FLAGS_ASYNC_COMMAND, pid=0x1234, tid=0x5678)
+        _, message = parse_smb2_message(data)
+
+        assert message.async_id == 0x567800001234
+        assert (message.pid, message.tid) == (0, 0)
+
+    def test_compound_message(self):
+        first = smb2_message(SMB2_COM_CREATE, body='\0' * 16, next_command_offset=80)
+        data = first + smb2_message(SMB2_COM_READ)
+
+        length, message = parse_smb2_message(memoryview(data))
+        assert length == 80
+        assert len(message.data) == 16
+
+    def test_invalid_header(self):
+        self.assertRaises(ProtocolError, parse_smb2_message, '\xFFSMB' + '\0' * 60)
+        self.assertRaises(ProtocolError, parse_smb2_message, smb2_message(SMB2_COM_READ)[:63])
+
+
+class TestSMB2Dispatcher(TestCase):
+    def test_dispatch(self):
+        dispatcher = SMB2Dispatcher()
+
+        class Handlers(object):
+            @dispatcher.handler(SMB2_COM_CLOSE, SMB2_CLOSE_REQUEST)
+            def on_close(self, message, body):
+                return body.file_id
+
+        body = struct.pack('<HHI16s', 24, 0, 0, 'f' * 16)
+        _, message = parse_smb2_message(memoryview(smb2_message(SMB2_COM_CLOSE, body=body)))
+        assert dispatcher.dispatch(Handlers(), message) == 'f' * 16
+
+        _, message = parse_smb2_message(smb2_message(SMB2_COM_READ))
+        assert dispatcher.dispatch(Handlers(), message, default='default') == 'default'
+
+    def test_truncated_body(self):
+        dispatcher = SMB2Dispatcher()
+
+        @dispatcher.handler(SMB2_COM_CLOSE, SMB2_CLOSE_REQUEST)
+        def on_close(target, message, body):
+            return body
+
+        _, message = parse_smb2_message(smb2_message(SMB2_COM_CLOSE, body='\0' * 8))
+        self.assertRaises(ProtocolError, dispatcher.dispatch, None, message)
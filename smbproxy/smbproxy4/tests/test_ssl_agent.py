@@ -0,0 +1,62 @@
+# coding: utf-8
+
+# Copyright Luna Technology 2016
+# Matthieu Riviere <mriviere@luna-technology.com>
+
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.trial.unittest import TestCase
+from twisted.web import resource
+from twisted.web import server
+import treq
+
+from smbproxy4 import ssl_agent
+
+
+class OkResource(resource.Resource):
+    isLeaf = True
+
+    def render_POST(self, request):
+        return 'OK'
+
+
+class TestMonitoredHTTPConnectionPool(TestCase):
+    def setUp(self):
+        self.port = reactor.listenTCP(0, server.Site(OkResource()), interface='127.0.0.1')
+        self.url = 'http://127.0.0.1:%d/' % self.port.getHost().port
+        self.pool = ssl_agent.create_pool(max_persistent_per_host=2)
+
+        self.initial_stats = dict(ssl_agent.connection_stats)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.pool.closeCachedConnections()
+        yield self.port.stopListening()
+
+    def stat(self, name):
+        return ssl_agent.connection_stats[name] - self.initial_stats[name]
+
+    @defer.inlineCallbacks
+    def post(self):
+        response = yield treq.post(self.url, pool=self.pool)
+        content = yield treq.content(response)
+        defer.returnValue(content)
+
+    @defer.inlineCallbacks
+    def test_sequential_requests_reuse_the_connection(self):
+        for _ in range(3):
+            content = yield self.post()
+            assert content == 'OK'
+
+        assert self.stat('requested') == 3
+        assert self.stat('created') == 1
+
+    @defer.inlineCallbacks
+    def test_concurrent_requests_open_connections(self):
+        yield defer.gatherResults([self.post() for _ in range(2)])
+        assert self.stat('created') == 2
+
+        # Both connections were kept
+        yield defer.gatherResults([self.post() for _ in range(2)])
+        assert self.stat('requested') == 4
+        assert self.stat('created') == 2
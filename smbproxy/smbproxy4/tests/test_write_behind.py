@@ -0,0 +1,212 @@
+# coding: utf-8
+
+# Copyright Luna Technology 2016
+# Matthieu Riviere <mriviere@luna-technology.com>
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from twisted.internet import defer, task
+
+from smbproxy4 import write_behind
+from smbproxy4.interval_set import IntervalSet
+from smbproxy4.write_behind import WriteBehindJournal, WriteBehindQueue
+from test_fs_cache import FakeThreads
+
+
+class HeldThreads(object):
+    """Runs the functions sent to a thread when run() is called"""
+    def __init__(self):
+        self.calls = []
+
+    def deferToThread(self, f, *args, **kwargs):
+        d = defer.Deferred()
+        self.calls.append((f, args, kwargs, d))
+        return d
+
+    def run(self):
+        f, args, kwargs, d = self.calls.pop(0)
+        defer.maybeDeferred(f, *args, **kwargs).chainDeferred(d)
+
+
+class TestWriteBehindJournal(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        real_threads, write_behind.threads = write_behind.threads, FakeThreads
+        self.addCleanup(setattr, write_behind, 'threads', real_threads)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_pending_entries(self):
+        journal = WriteBehindJournal(self.directory)
+        assert journal.open() == []
+        journal.add(u'\\\\host\\share', u'a.txt')
+        journal.add(u'\\\\host\\share', u'b.txt')
+        journal.add(u'\\\\host\\share', u'A.TXT')
+        journal.done(u'\\\\host\\share', u'b.txt')
+
+        with open(journal.path, 'rb') as fh:
+            assert WriteBehindJournal.read_entries(fh) == [(u'\\\\host\\share', u'a.txt')]
+
+        # The journal is emptied once nothing is pending
+        journal.done(u'\\\\host\\share', u'a.txt')
+        assert os.path.getsize(journal.path) == 0
+        journal.close()
+
+    def test_take_over_left_journals(self):
+        left_path = os.path.join(self.directory, 'journal-1.log')
+        with open(left_path, 'wb') as fh:
+            fh.write('{"op": "add", "share_name": "\\\\\\\\host\\\\share", "path": "a.txt"}\n')
+            fh.write('{"op": "add", "share_name": "\\\\\\\\host\\\\share", "path": "b.txt"}\n')
+            fh.write('{"op": "done", "share_name": "\\\\\\\\host\\\\share", "path": "a.txt"}\n')
+            # Interrupted by a crash
+            fh.write('{"op": "add", "share_')
+
+        journal = WriteBehindJournal(self.directory)
+        assert journal.open() == [(u'\\\\host\\share', u'b.txt')]
+        assert not os.path.exists(left_path)
+        journal.close()
+
+        # The next process takes them over in turn
+        journal = WriteBehindJournal(self.directory)
+        journal.path = os.path.join(self.directory, 'journal-2.log')
+        assert journal.open() == [(u'\\\\host\\share', u'b.txt')]
+        journal.close()
+
+    def test_entries_are_synced_in_batches(self):
+        write_behind.threads = HeldThreads()
+        journal = WriteBehindJournal(self.directory)
+        journal.open()
+        synced = []
+        journal.add(u'\\\\host\\share', u'a.txt').addCallback(synced.append)
+        # Added while the first one is synced: they wait for the next batch
+        journal.add(u'\\\\host\\share', u'b.txt').addCallback(synced.append)
+        journal.add(u'\\\\host\\share', u'c.txt').addCallback(synced.append)
+        journal.add(u'\\\\host\\share', u'A.TXT').addCallback(synced.append)
+        assert len(write_behind.threads.calls) == 1
+
+        write_behind.threads.run()
+        assert synced == [None]
+        assert len(write_behind.threads.calls) == 1
+        write_behind.threads.run()
+        assert synced == [None] * 4
+        assert write_behind.threads.calls == []
+
+        with open(journal.path, 'rb') as fh:
+            assert len(WriteBehindJournal.read_entries(fh)) == 3
+        journal.close()
+
+
+class TestWriteBehindQueue(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        real_threads, write_behind.threads = write_behind.threads, FakeThreads
+        self.addCleanup(setattr, write_behind, 'threads', real_threads)
+        self.journal = WriteBehindJournal(self.directory)
+        self.clock = task.Clock()
+        self.write_backs = []
+        self.dirty_ranges = []
+        self.base_versions = []
+        self.queue = WriteBehindQueue(
+            self.journal, self.write_back, max_concurrent=2, retry_delay=5, clock=self.clock)
+        self.queue.start()
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.directory)
+
+    def write_back(self, share_name, path, dirty_ranges, base_version):
+        d = defer.Deferred()
+        self.write_backs.append((path, d))
+        self.dirty_ranges.append(dirty_ranges)
+        self.base_versions.append(base_version)
+        return d
+
+    def test_bounded_concurrency(self):
+        for path in (u'a', u'b', u'c'):
+            self.queue.enqueue(u'share', path)
+
+        assert [path for path, _ in self.write_backs] == [u'a', u'b']
+        assert self.queue.is_pending(u'share', u'C')
+
+        self.write_backs[0][1].callback(None)
+        assert [path for path, _ in self.write_backs] == [u'a', u'b', u'c']
+        assert not self.queue.is_pending(u'share', u'a')
+        assert self.journal.pending.keys() == [(u'share', u'b'), (u'share', u'c')]
+
+    def test_retry(self):
+        self.queue.enqueue(u'share', u'a')
+        self.write_backs[0][1].errback(RuntimeError('Gateway unreachable'))
+        assert self.queue.is_pending(u'share', u'a')
+
+        self.clock.advance(5)
+        self.write_backs[1][1].errback(RuntimeError('Gateway unreachable'))
+
+        # The delay doubles
+        self.clock.advance(5)
+        assert len(self.write_backs) == 2
+        self.clock.advance(5)
+        assert len(self.write_backs) == 3
+
+        self.write_backs[2][1].callback(None)
+        assert not self.queue.is_pending(u'share', u'a')
+        assert self.queue.total_retries == 2
+
+    def test_written_again_while_running(self):
+        self.queue.enqueue(u'share', u'a')
+        self.queue.enqueue(u'share', u'a')
+        assert len(self.write_backs) == 1
+
+        self.write_backs[0][1].callback(None)
+        assert len(self.write_backs) == 2
+        self.write_backs[1][1].callback(None)
+        assert not self.queue.is_pending(u'share', u'a')
+
+    def test_dirty_ranges(self):
+        self.queue.enqueue(u'share', u'a', IntervalSet([(0, 10)]))
+        # Written again while being written back: only the new ranges are written back next time
+        self.queue.enqueue(u'share', u'a', IntervalSet([(100, 110)]))
+        self.queue.enqueue(u'share', u'a', IntervalSet([(105, 120)]))
+        self.write_backs[0][1].callback(None)
+        assert self.dirty_ranges == [IntervalSet([(0, 10)]), IntervalSet([(100, 120)])]
+
+        # A failed write-back is retried with its ranges, merged with the new ones
+        self.queue.enqueue(u'share', u'b', IntervalSet([(0, 10)]))
+        self.write_backs[2][1].errback(RuntimeError('Gateway unreachable'))
+        self.queue.enqueue(u'share', u'b', IntervalSet([(20, 30)]))
+        self.clock.advance(5)
+        assert self.dirty_ranges[3] == IntervalSet([(0, 10), (20, 30)])
+
+        # Unless one of the writes needs the whole file
+        self.write_backs[3][1].errback(RuntimeError('Gateway unreachable'))
+        self.queue.enqueue(u'share', u'b')
+        self.clock.advance(10)
+        assert self.dirty_ranges[4] is None
+
+    def test_base_version(self):
+        self.queue.enqueue(u'share', u'a', IntervalSet([(0, 10)]), (1024, 1456000000.0))
+        # Written again while being written back: the new ranges apply to the version being written
+        self.queue.enqueue(u'share', u'a', IntervalSet([(100, 110)]), (1024, 1456000000.0))
+        self.write_backs[0][1].callback(None)
+        assert self.base_versions == [(1024, 1456000000.0), None]
+
+        # Coalesced before being written back: the ranges of both apply to the first version
+        self.queue.enqueue(u'share', u'b', IntervalSet([(0, 10)]), (1024, 1456000000.0))
+        self.write_backs[2][1].errback(RuntimeError('Gateway unreachable'))
+        self.queue.enqueue(u'share', u'b', IntervalSet([(20, 30)]), (1024, 1456000050.0))
+        self.clock.advance(5)
+        assert self.base_versions[3] == (1024, 1456000000.0)
+
+    def test_discard(self):
+        self.queue.enqueue(u'share', u'a')
+        discarded = []
+        self.queue.discard(u'share', u'a').addCallback(discarded.append)
+
+        # Waits for the write-back in progress
+        assert discarded == []
+        self.write_backs[0][1].callback(None)
+        assert discarded == [None]
+        assert self.journal.pending == {}
@@ -0,0 +1,420 @@
+# coding: utf-8
+
+# Copyright Luna Technology 2016
+# Matthieu Riviere <mriviere@luna-technology.com>
+
+"""Write-behind of the written files
+
+When a written file is closed, it's added to the journal and the CLOSE is answered right away. WriteBehindQueue
+writes the file back to the control server later, with a bounded number of concurrent uploads, and retries until it
+succeeds. Until then, the local version of the file is the authoritative one: it must not be replaced by the one of
+the control server.
+"""
+
+import collections
+import errno
+import fcntl
+import glob
+import json
+import os
+
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import threads
+from twisted.python import failure
+
+import logger
+from interval_set import IntervalSet
+from statsd_logging import StatsdClient
+
+
+def write_back_key(share_name, path):
+    # Paths are case insensitive
+    return share_name.lower(), path.lower()
+
+
+def merge_dirty_ranges(a, b):
+    """Merges two IntervalSets of dirty ranges, where None means the whole file"""
+    if a is None or b is None:
+        return None
+    merged = a.copy()
+    merged.update(b)
+    return merged
+
+
+class WriteBehindJournal(object):
+    """
+    The files still to be written back, persisted in a directory so that they survive a restart of the proxy.
+
+    Each process appends to its own journal file (journal-<pid>.log), which it keeps locked. A line is a JSON
+    entry: {"op": "add", ...} when a file has to be written back, {"op": "done", ...} once it has been. On open, the
+    journals whose process is gone (their lock is free) are taken over.
+
+    The entries are written and synced in a thread, one batch at a time: the entries added while a batch is synced
+    go in the next one, with a single fsync.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, 'journal-%d.log' % os.getpid())
+        self.fh = None
+
+        # key -> (share_name, path) of the files still to be written back
+        self.pending = collections.OrderedDict()
+
+        # The lines of the next batch (None to empty the journal), and the Deferreds to fire once it's synced
+        self.queued_lines = []
+        self.queued_waiters = []
+        # The Deferreds to fire once the batch being written is synced, or None if there isn't one
+        self.writing_waiters = None
+
+    def open(self):
+        """
+        Opens the journal of this process, and takes over the journals that were left behind.
+        :return: the list of (share_name, path) still to be written back
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        self.fh = open(self.path, 'ab')
+        fcntl.flock(self.fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        for journal_path in sorted(glob.glob(os.path.join(self.directory, 'journal-*.log'))):
+            if journal_path != self.path:
+                self.take_over(journal_path)
+
+        return self.pending.values()
+
+    def take_over(self, journal_path):
+        with open(journal_path, 'rb') as fh:
+            try:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    # Its process is still running
+                    return
+                raise
+
+            lines = []
+            for share_name, path in self.read_entries(fh):
+                key = write_back_key(share_name, path)
+                if key not in self.pending:
+                    lines.append(self.entry_line('add', share_name, path))
+                    self.pending[key] = (share_name, path)
+            # Before anything else runs: no need for a thread
+            self.write_lines(lines)
+
+            # Everything is in our journal now
+            os.unlink(journal_path)
+
+    @staticmethod
+    def read_entries(fh):
+        """
+        :return: the list of (share_name, path) added to a journal file and not done
+        """
+        pending = collections.OrderedDict()
+        for line in fh:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # The last line of a journal can be incomplete if its process crashed while writing it
+                logger.logger.new().msg('Skipping invalid write-behind journal entry: %r' % line, level=logger.WARN)
+                continue
+
+            key = write_back_key(entry['share_name'], entry['path'])
+            if entry['op'] == 'add':
+                pending[key] = (entry['share_name'], entry['path'])
+            elif entry['op'] == 'done':
+                pending.pop(key, None)
+        return pending.values()
+
+    @staticmethod
+    def entry_line(op, share_name, path):
+        return json.dumps({'op': op, 'share_name': share_name, 'path': path}) + '\n'
+
+    def write_lines(self, lines):
+        for line in lines:
+            if line is None:
+                self.fh.truncate(0)
+            else:
+                self.fh.write(line)
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+
+    def append(self, *lines):
+        """
+        :return: a Deferred that fires once the lines are synced to the disk
+        """
+        self.queued_lines.extend(lines)
+        d = defer.Deferred()
+        self.queued_waiters.append(d)
+        if self.writing_waiters is None:
+            self.write_queued()
+        return d
+
+    def write_queued(self):
+        lines, self.queued_lines = self.queued_lines, []
+        self.writing_waiters, self.queued_waiters = self.queued_waiters, []
+        threads.deferToThread(self.write_lines, lines).addBoth(self.written)
+
+    def written(self, result):
+        waiters, self.writing_waiters = self.writing_waiters, None
+        if self.queued_lines:
+            self.write_queued()
+
+        for d in waiters:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(None)
+
+    def flushed(self):
+        """
+        :return: a Deferred that fires once all the lines appended so far are synced to the disk
+        """
+        d = defer.Deferred()
+        if self.queued_lines:
+            self.queued_waiters.append(d)
+        elif self.writing_waiters is not None:
+            self.writing_waiters.append(d)
+        else:
+            d.callback(None)
+        return d
+
+    def add(self, share_name, path):
+        """
+        :return: a Deferred that fires once the file is in the journal on disk
+        """
+        key = write_back_key(share_name, path)
+        if key in self.pending:
+            # Its entry may still be on its way to the disk
+            return self.flushed()
+        self.pending[key] = (share_name, path)
+        return self.append(self.entry_line('add', share_name, path))
+
+    def done(self, share_name, path):
+        """
+        :return: a Deferred that fires once the entry is on disk. If it doesn't make it, the file is only written back
+        once more after a restart.
+        """
+        key = write_back_key(share_name, path)
+        if key not in self.pending:
+            return defer.succeed(None)
+        del self.pending[key]
+        lines = [self.entry_line('done', share_name, path)]
+
+        # Don't let the journal grow forever
+        if not self.pending:
+            lines.append(None)
+        return self.append(*lines)
+
+    def close(self):
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+
+
+class PendingWriteBack(object):
+    def __init__(self, share_name, path):
+        self.share_name = share_name
+        self.path = path
+
+        # The ranges to write back (an IntervalSet), or None for the whole file
+        self.dirty_ranges = IntervalSet()
+        # The (size, mtime) of the version of the file on the control server the ranges apply to, if known
+        self.base_version = None
+
+        self.attempts = 0
+        self.running = False
+        # Set when the file is written again while it's being written back: it has to be written back once more
+        self.rewritten = False
+        self.retry_call = None
+
+        # Deferreds to fire once the file doesn't need to be written back any more
+        self.waiters = []
+
+
+class WriteBehindQueue(object):
+    """
+    Writes back the files of the journal in the background.
+
+    A file closed again before it has been written back is only written back once, with the dirty ranges of both.
+    A failed write-back is retried after retry_delay seconds, doubled at each attempt up to MAX_RETRY_DELAY.
+
+    The dirty ranges aren't journaled: after a restart, the files of the journal are written back whole.
+    """
+    MAX_RETRY_DELAY = 300
+
+    def __init__(self, journal, write_back, max_concurrent=4, retry_delay=5, clock=reactor):
+        """
+        :param journal: a WriteBehindJournal
+        :param write_back: called with (share_name, path, dirty ranges or None, base version or None), returns a
+        Deferred that fails if the file wasn't written back
+        """
+        self.journal = journal
+        self.write_back = write_back
+        self.retry_delay = retry_delay
+        self.clock = clock
+
+        self.semaphore = defer.DeferredSemaphore(max_concurrent)
+
+        # key -> PendingWriteBack
+        self.pending = {}
+
+        self.total_queued = 0
+        self.total_coalesced = 0
+        self.total_written = 0
+        self.total_retries = 0
+
+        self.stats_client = StatsdClient.get()
+
+    def start(self):
+        """Resumes the write-backs left in the journal"""
+        for share_name, path in self.journal.open():
+            self.enqueue(share_name, path)
+
+    def is_pending(self, share_name, path):
+        """Whether the local version of a file hasn't been written back yet"""
+        return write_back_key(share_name, path) in self.pending
+
+    def enqueue(self, share_name, path, dirty_ranges=None, base_version=None):
+        """
+        Schedules the write-back of a file.
+        :return: a Deferred that fires once it's in the journal
+        :param dirty_ranges: the IntervalSet of the modified ranges of the file, or None to write back all of it
+        :param base_version: the (size, mtime) of the version of the file on the control server that dirty_ranges
+        apply to
+        """
+        key = write_back_key(share_name, path)
+        journaled = self.journal.add(share_name, path)
+        self.total_queued += 1
+
+        write_back = self.pending.get(key)
+        if write_back is not None:
+            self.total_coalesced += 1
+            self.stats_client.incr('write_behind.coalesced')
+            write_back.dirty_ranges = merge_dirty_ranges(write_back.dirty_ranges, dirty_ranges)
+            if write_back.running:
+                # The new ranges apply to the version being written, which isn't known yet
+                write_back.rewritten = True
+            elif write_back.base_version is None:
+                write_back.base_version = base_version
+            # Otherwise, the control server still has the version of the first write: the merged ranges apply to it
+            return journaled
+
+        write_back = PendingWriteBack(share_name, path)
+        write_back.dirty_ranges = dirty_ranges
+        write_back.base_version = base_version
+        self.pending[key] = write_back
+        self.stats_client.incr('write_behind.queued')
+        self.schedule(key)
+        return journaled
+
+    def schedule(self, key):
+        self.semaphore.run(self.run_write_back, key)
+
+    @defer.inlineCallbacks
+    def run_write_back(self, key):
+        write_back = self.pending.get(key)
+        if write_back is None:
+            # Discarded while waiting
+            return
+
+        write_back.retry_call = None
+        write_back.running = True
+        write_back.rewritten = False
+        write_back.attempts += 1
+
+        # The writes made from now on go to the next write-back. They apply to the version written now, which isn't
+        # known yet.
+        dirty_ranges, write_back.dirty_ranges = write_back.dirty_ranges, IntervalSet()
+        base_version, write_back.base_version = write_back.base_version, None
+        try:
+            yield self.write_back(write_back.share_name, write_back.path, dirty_ranges, base_version)
+        except Exception:
+            succeeded = False
+            write_back.dirty_ranges = merge_dirty_ranges(dirty_ranges, write_back.dirty_ranges)
+            write_back.base_version = base_version
+        else:
+            succeeded = True
+        finally:
+            write_back.running = False
+
+        if self.pending.get(key) is not write_back:
+            # Discarded while running
+            self.fire_waiters(write_back)
+            return
+
+        if write_back.rewritten:
+            # Whatever happened, the file has to be written back again
+            write_back.attempts = 0
+            self.schedule(key)
+        elif succeeded:
+            self.total_written += 1
+            self.stats_client.incr('write_behind.written')
+            del self.pending[key]
+            self.journal_done(write_back.share_name, write_back.path)
+            self.fire_waiters(write_back)
+        else:
+            self.total_retries += 1
+            self.stats_client.incr('write_behind.retried')
+            delay = min(self.retry_delay * 2 ** (write_back.attempts - 1), self.MAX_RETRY_DELAY)
+            write_back.retry_call = self.clock.callLater(delay, self.schedule, key)
+
+    def journal_done(self, share_name, path):
+        def log_error(error):
+            # The file is written back once more after a restart
+            logger.logger.new().msg("Error: couldn't journal that %s on %s was written back: %s" % (
+                path, share_name, error.getTraceback()), level=logger.WARN)
+        self.journal.done(share_name, path).addErrback(log_error)
+
+    @staticmethod
+    def fire_waiters(write_back):
+        waiters, write_back.waiters = write_back.waiters, []
+        for d in waiters:
+            d.callback(None)
+
+    def wait(self, share_name, path):
+        """
+        :return: a Deferred that fires once a file doesn't need to be written back any more
+        """
+        write_back = self.pending.get(write_back_key(share_name, path))
+        if write_back is None:
+            return defer.succeed(None)
+
+        d = defer.Deferred()
+        write_back.waiters.append(d)
+        return d
+
+    def discard(self, share_name, path):
+        """
+        Cancels the write-back of a file (eg. because it's deleted).
+        :return: a Deferred that fires once the write-back in progress, if any, is over
+        """
+        key = write_back_key(share_name, path)
+        write_back = self.pending.pop(key, None)
+        if write_back is None:
+            return defer.succeed(None)
+
+        self.journal_done(share_name, path)
+
+        if write_back.retry_call is not None and write_back.retry_call.active():
+            write_back.retry_call.cancel()
+
+        if not write_back.running:
+            self.fire_waiters(write_back)
+            return defer.succeed(None)
+
+        d = defer.Deferred()
+        write_back.waiters.append(d)
+        return d
+
+    def get_stats(self):
+        return {
+            'pending': len(self.pending),
+            'running': len([w for w in self.pending.values() if w.running]),
+            'total_queued': self.total_queued,
+            'total_coalesced': self.total_coalesced,
+            'total_written': self.total_written,
+            'total_retries': self.total_retries,
+        }